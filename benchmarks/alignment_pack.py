@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# cost of keeping pagan's results, copying the five files for each gene family
+# into the alignments directory (what align used to do) against appending them
+# to a pack file, and of reading the nucleotide alignments back (what scaffold
+# does) from separate files against streaming them from the pack
+#
+#   python benchmarks/alignment_pack.py [num_families]
+
+import os
+import sys
+import time
+import glob
+import random
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from cStringIO import StringIO
+
+from Bio import SeqIO
+
+from glutton.pack import PackWriter, PackReader, PACK_NAME
+from glutton.utils import tmpfile
+
+
+EXTS = ('protein', 'nucleotide', 'queries', 'reference', 'tree')
+
+def fasta(num_seqs, length) :
+    return ''.join([ ">seq%d\n%s\n" % (i, ''.join([ random.choice('ACGT-') for j in range(length) ])) for i in range(num_seqs) ])
+
+# the files pagan leaves for one gene family
+def job_files(directory) :
+    files = {}
+
+    for ext in EXTS :
+        files[ext] = os.path.join(directory, 'job.' + ext)
+
+    nucleotide = fasta(10, 1500)
+
+    with open(files['nucleotide'], 'w') as f :
+        f.write(nucleotide)
+
+    for ext in ('protein', 'queries', 'reference') :
+        with open(files[ext], 'w') as f :
+            f.write(nucleotide[:len(nucleotide) / 3])
+
+    with open(files['tree'], 'w') as f :
+        f.write("(%s);" % ','.join([ "seq%d:0.1" % i for i in range(10) ]))
+
+    return files
+
+def copy_files(directory, files) :
+    dst = tmpfile(directory=directory, suffix='.protein')
+
+    for ext in EXTS :
+        shutil.copyfile(files[ext], dst[:-8] + '.' + ext)
+
+def read_files(directory) :
+    count = 0
+
+    for fname in glob.glob(os.path.join(directory, 'glutton*.nucleotide')) :
+        count += len(list(SeqIO.parse(fname, 'fasta')))
+
+    return count
+
+def read_pack(directory) :
+    count = 0
+    pack = PackReader(directory)
+
+    for name, data in pack.stream('nucleotide') :
+        count += len(list(SeqIO.parse(StringIO(data), 'fasta')))
+
+    pack.close()
+
+    return count
+
+def drop_caches() :
+    try :
+        with open('/proc/sys/vm/drop_caches', 'w') as f :
+            f.write('3\n')
+
+        return True
+
+    except IOError :
+        return False
+
+def timed(f, *args) :
+    start = time.time()
+    f(*args)
+    return time.time() - start
+
+def main() :
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    work = tempfile.mkdtemp()
+    files = job_files(work)
+
+    loose = os.path.join(work, 'loose')
+    packs = os.path.join(work, 'packs')
+    os.mkdir(loose)
+
+    writer = PackWriter(packs, 'benchmark')
+
+    copy = timed(lambda : [ copy_files(loose, files) for i in range(num_families) ])
+    append = timed(lambda : [ writer.append(PACK_NAME % i, files) for i in range(num_families) ])
+    append_nosync = timed(lambda : [ writer.append(PACK_NAME % i, files, sync=False) for i in range(num_families) ])
+
+    writer.close()
+
+    print "%d gene families" % num_families
+    print "%-32s %12s" % ('callback', 'ms/family')
+    print "%-32s %12.3f" % ('copy 5 files', copy * 1e3 / num_families)
+    print "%-32s %12.3f" % ('pack append (fsync)', append * 1e3 / num_families)
+    print "%-32s %12.3f" % ('pack append (no fsync)', append_nosync * 1e3 / num_families)
+    print
+
+    # the pack has every family twice now, start again with one copy
+    shutil.rmtree(packs)
+    writer = PackWriter(packs, 'benchmark')
+
+    for i in range(num_families) :
+        writer.append(PACK_NAME % i, files, sync=False)
+
+    writer.close()
+
+    cold = drop_caches()
+
+    print "%-32s %12s %12s" % ('scaffold read', 'total (s)', 'files')
+    print "%-32s %12.3f %12d" % ('separate files', timed(read_files, loose), len(os.listdir(loose)))
+
+    drop_caches()
+
+    print "%-32s %12.3f %12d" % ('pack', timed(read_pack, packs), len(os.listdir(packs)))
+
+    if not cold :
+        print "(page cache not dropped, run as root for cold reads)"
+
+    shutil.rmtree(work)
+
+if __name__ == '__main__' :
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# prank jobs per second with the thread and process executors as the number
+# of workers grows, prank is a stub that copies its input so the time is
+# spent in the python side of each job (writing input, parsing output)
+#
+#   python benchmarks/executor_scaling.py [num_jobs] [max_workers]
+
+import os
+import sys
+import time
+import stat
+import shutil
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from multiprocessing import cpu_count
+
+from glutton.utils import set_threads, set_executor
+from glutton.queue import WorkQueue
+from glutton.job import PrankJob
+
+from glt_startup import make_families
+from prank_commits import STUB_PRANK
+
+
+def run(executor, workers, families) :
+    set_executor(executor)
+    set_threads(workers)
+
+    lock = threading.Lock()
+    done = [0]
+
+    def _callback(job) :
+        # what GluttonDB.job_callback does with the results
+        lock.acquire()
+        done[0] += len(open(job.alignment).read()) > 0
+        lock.release()
+
+    start = time.time()
+
+    q = WorkQueue()
+
+    for gf in families :
+        q.enqueue(PrankJob(_callback, gf))
+
+    q.join()
+
+    elapsed = time.time() - start
+
+    assert done[0] == len(families)
+
+    return len(families) / elapsed
+
+def main() :
+    num_jobs    = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+
+    bindir = tempfile.mkdtemp()
+    prank = os.path.join(bindir, 'prank')
+
+    with open(prank, 'w') as f :
+        f.write(STUB_PRANK)
+
+    os.chmod(prank, stat.S_IRWXU)
+    os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+
+    # larger families than usual, so there is more to parse
+    families = [ gf for gf in make_families(num_jobs * 2).values() if len(gf) > 2 ][:num_jobs]
+
+    print "%d jobs, %d cores" % (len(families), cpu_count())
+    print "%8s %18s %18s" % ('workers', 'thread (jobs/s)', 'process (jobs/s)')
+
+    workers = 1
+
+    while workers <= max_workers :
+        print "%8d %18.1f %18.1f" % (workers, run('thread', workers, families), run('process', workers, families))
+        sys.stdout.flush()
+        workers *= 2
+
+    shutil.rmtree(bindir)
+
+if __name__ == '__main__' :
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# per-lookup latency of alignment/tree reads from a synthetic reference
+#
+#   python benchmarks/glt_lookup.py [num_families] [num_lookups] [threads]
+
+import os
+import sys
+import time
+import random
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from glutton.db import GluttonDB
+from glutton.genefamily import Gene, GeneFamily, read_alignment_as_genefamily
+from glutton.utils import tmpfile, rm_f
+
+
+def random_seq(length) :
+    return ''.join([ random.choice('ACGT') for _ in range(length) ])
+
+def make_reference(fname, num_families) :
+    db = GluttonDB()
+    db.fname = fname
+    db.data = {}
+
+    for i in range(num_families) :
+        gf = GeneFamily([ Gene("name%d_%d" % (i, j), random_seq(random.randint(100, 600) * 3), id="gene%d_%d" % (i, j)) for j in range(random.randint(2, 5)) ], id="genefamily%d" % i)
+        db.data[gf.id] = gf
+
+    db.metadata = {
+        'glutton-version'   : 0.1,
+        'program-name'      : 'prank',
+        'program-version'   : 'benchmark',
+        'species-name'      : 'synthetic',
+        'species-release'   : 1,
+        'download-time'     : time.time(),
+        'data-file'         : 'synthetic_1_data.json',
+        'nucleotide'        : True,
+        'database-name'     : 'ensembl'
+      }
+
+    # alignments first, as they would be in a real build
+    z = ZipFile(fname, 'w', compression=ZIP_DEFLATED, allowZip64=True)
+    z.close()
+    z = ZipFile(fname, 'a', compression=ZIP_DEFLATED, allowZip64=True)
+
+    for famid in db.data :
+        z.writestr(db._famid_to_alignment(famid), ''.join([ g.format('fasta') for g in db.data[famid] ]))
+        z.writestr(db._famid_to_tree(famid), "(%s);" % ','.join([ "%s:0.1" % g.id for g in db.data[famid] ]))
+
+    z.close()
+
+    db._write()
+
+# what get_alignment did before the archive was indexed
+def zipfile_lookup(fname, famid, lock) :
+    lock.acquire()
+
+    z = ZipFile(fname, 'r')
+    listing = z.namelist()
+
+    assert (famid + '.align') in listing and (famid + '.tree') in listing
+
+    alignment = read_alignment_as_genefamily(z.open(famid + '.align'), famid)
+    alignment.set_tree(z.read(famid + '.tree'))
+
+    z.close()
+    lock.release()
+
+    return alignment
+
+def timed(label, func, famids, threads) :
+    chunks = [ famids[i::threads] for i in range(threads) ]
+
+    def _work(chunk) :
+        for famid in chunk :
+            func(famid)
+
+    workers = [ threading.Thread(target=_work, args=(c,)) for c in chunks ]
+
+    start = time.time()
+
+    for w in workers :
+        w.start()
+
+    for w in workers :
+        w.join()
+
+    elapsed = time.time() - start
+
+    print "%-32s %8d lookups %8.3f s %10.1f us/lookup" % (label, len(famids), elapsed, 1e6 * elapsed / len(famids))
+
+def main() :
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    num_lookups  = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    threads      = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    fname = tmpfile(suffix='.glt')
+
+    print "building reference with %d gene families..." % num_families
+    make_reference(fname, num_families)
+    print "%s is %.1f MB" % (fname, os.path.getsize(fname) / 1e6)
+
+    db = GluttonDB(fname)
+    famids = [ random.choice(db.data.keys()) for _ in range(num_lookups) ]
+    lock = threading.Lock()
+
+    timed("zipfile (1 thread)", lambda f : zipfile_lookup(fname, f, lock), famids[:20], 1)
+    timed("zipfile (%d threads)" % threads, lambda f : zipfile_lookup(fname, f, lock), famids[:20], threads)
+
+    timed("raw index (1 thread)", db.get_raw_alignment, famids, 1)
+    timed("raw index (%d threads)" % threads, db.get_raw_alignment, famids, threads)
+
+    timed("get_alignment (1 thread)", db.get_alignment, famids, 1)
+    timed("get_alignment (%d threads)" % threads, db.get_alignment, famids, threads)
+
+    rm_f(fname)
+
+if __name__ == '__main__' :
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# time and memory needed to open a reference with the json and indexed data files
+#
+#   python benchmarks/glt_startup.py [num_families]
+
+import os
+import sys
+import time
+import json
+import random
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zipfile import ZipFile, ZIP_DEFLATED
+
+from glutton.db import GluttonDB
+from glutton.genefamily import Gene, GeneFamily, glutton_to_json
+from glutton.utils import tmpfile, rm_f
+
+
+_pool = ''.join([ random.choice('ACGT') for _ in range(1 << 20) ])
+
+def random_seq(length) :
+    start = random.randint(0, len(_pool) - length)
+    return _pool[start : start + length]
+
+def make_families(num_families) :
+    data = {}
+
+    for i in range(num_families) :
+        gf = GeneFamily([ Gene("name%d_%d" % (i, j), random_seq(random.randint(100, 600) * 3), id="gene%d_%d" % (i, j)) for j in range(random.randint(1, 6)) ], id="genefamily%d" % i)
+        data[gf.id] = gf
+
+    return data
+
+def make_metadata(data_file) :
+    return {
+        'glutton-version'   : 0.1,
+        'program-name'      : 'prank',
+        'program-version'   : 'benchmark',
+        'species-name'      : 'synthetic',
+        'species-release'   : 1,
+        'download-time'     : time.time(),
+        'data-file'         : data_file,
+        'nucleotide'        : True,
+        'database-name'     : 'ensembl'
+      }
+
+# data file as written before the indexed format existed
+def write_json_reference(fname, data) :
+    z = ZipFile(fname, 'w', compression=ZIP_DEFLATED, allowZip64=True)
+    z.writestr('manifest.json', json.dumps(make_metadata('synthetic_1_data.json')))
+    z.writestr('synthetic_1_data.json', json.dumps(glutton_to_json(data)))
+    z.close()
+
+def write_indexed_reference(fname, data) :
+    db = GluttonDB()
+    db.fname = fname
+    db.data = data
+    db.metadata = make_metadata(None)
+    db._set_data_format(db.species, db.release)
+
+    ZipFile(fname, 'w').close()
+    db._write()
+
+def rss_mb() :
+    try :
+        for line in open('/proc/self/status') :
+            if line.startswith('VmRSS:') :
+                return int(line.split()[1]) / 1024.0
+
+    except IOError :
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+# run in a separate process so the rss only includes the database
+def measure(fname) :
+    before = rss_mb()
+
+    start = time.time()
+    db = GluttonDB(fname)
+    opened = time.time() - start
+
+    famid = db.data.keys()[0]
+    start = time.time()
+    db.get_genefamily(famid)
+    first = time.time() - start
+
+    print json.dumps([opened, first, rss_mb() - before])
+
+def main() :
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 30000
+
+    print "generating %d gene families..." % num_families
+    data = make_families(num_families)
+
+    fnames = { 'json' : tmpfile(suffix='.glt'), 'indexed' : tmpfile(suffix='.glt') }
+
+    write_json_reference(fnames['json'], data)
+    write_indexed_reference(fnames['indexed'], data)
+
+    del data
+
+    for fmt in ('json', 'indexed') :
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--measure', fnames[fmt]])
+        opened, first, rss = json.loads(out.strip().split('\n')[-1])
+
+        print "%-8s %7.1f MB file  open %8.3f s  first family %8.3f ms  rss +%7.1f MB" % \
+            (fmt, os.path.getsize(fnames[fmt]) / 1e6, opened, first * 1e3, rss)
+
+        rm_f(fnames[fmt])
+
+if __name__ == '__main__' :
+    if len(sys.argv) == 3 and sys.argv[1] == '--measure' :
+        measure(sys.argv[2])
+    else :
+        main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# prank results committed per second as the number of threads grows, using a
+# stub prank that copies its input, comparing the archive writer thread with
+# appending to the archive from each job callback while holding the lock
+#
+#   python benchmarks/prank_commits.py [num_families] [max_threads]
+
+import os
+import sys
+import time
+import stat
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zipfile import ZipFile
+
+from glutton.db import GluttonDB
+from glutton.utils import set_threads, rm_f
+from glutton.queue import WorkQueue
+
+from glt_startup import make_families, make_metadata
+
+
+STUB_PRANK = """#!/bin/sh
+for a in "$@" ; do
+    case $a in
+        -d=*) d=${a#-d=} ;;
+        -o=*) o=${a#-o=} ;;
+    esac
+done
+cp "$d" "$o.best.nuc.fas"
+cp "$d" "$o.best.pep.fas"
+echo "(a:0.1,b:0.1);" > "$o.best.dnd"
+"""
+
+# what GluttonDB.job_callback did before the writer thread
+class LockedCallbackDB(GluttonDB) :
+    def job_callback(self, job) :
+        self.lock.acquire()
+        self._progress()
+
+        if job.success() :
+            z = ZipFile(self.fname, 'a', compression=self.compression, allowZip64=True)
+            z.write(job.alignment, arcname = self._famid_to_alignment(job.input.id))
+            z.write(job.tree,      arcname = self._famid_to_tree(job.input.id))
+            z.close()
+
+        self.lock.release()
+
+    def _perform_alignments(self) :
+        unaligned = self._get_unaligned_families()
+
+        self.q = WorkQueue()
+        self.total_jobs = len(unaligned)
+        self.complete_jobs = -1
+        self._progress()
+
+        from glutton.job import PrankJob
+
+        for i in unaligned :
+            self.q.enqueue(PrankJob(self.job_callback, self.data[i]))
+
+        self.q.join()
+
+def run(cls, template, threads) :
+    fname = template + '.%s.%d.glt' % (cls.__name__, threads)
+    shutil.copyfile(template, fname)
+
+    set_threads(threads)
+
+    db = cls(fname)
+    start = time.time()
+    db._perform_alignments()
+    elapsed = time.time() - start
+
+    rm_f(fname)
+
+    return db.total_jobs / elapsed
+
+def main() :
+    num_families = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    max_threads  = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    bindir = tempfile.mkdtemp()
+    prank = os.path.join(bindir, 'prank')
+
+    with open(prank, 'w') as f :
+        f.write(STUB_PRANK)
+
+    os.chmod(prank, stat.S_IRWXU)
+    os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+
+    template = os.path.join(bindir, 'template.glt')
+
+    db = GluttonDB()
+    db.fname = template
+    db.data = make_families(num_families)
+    db.metadata = make_metadata(None)
+    db._set_data_format(db.species, db.release)
+    ZipFile(template, 'w').close()
+    db._write()
+
+    results = []
+    threads = 1
+
+    while threads <= max_threads :
+        locked = run(LockedCallbackDB, template, threads)
+        writer = run(GluttonDB, template, threads)
+        results.append((threads, locked, writer))
+        threads *= 2
+
+    print >> sys.stderr, ""
+    print "%8s %20s %20s" % ('threads', 'locked (commits/s)', 'writer (commits/s)')
+
+    for threads,locked,writer in results :
+        print "%8d %20.1f %20.1f" % (threads, locked, writer)
+
+    shutil.rmtree(bindir)
+
+if __name__ == '__main__' :
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# cost of saving progress in an align project as it grows, rewriting the
+# progress files (what flush() does) against appending one result to the
+# journal (what happens after each pagan job)
+#
+#   python benchmarks/progress_journal.py [max_contigs]
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from glutton.info import GluttonInformation
+
+
+class FakeDB(object) :
+    pass
+
+def project(num_contigs) :
+    directory = tempfile.mkdtemp()
+    info = GluttonInformation(directory, None, FakeDB())
+
+    queries = [ info.get_query_from_contig('sample', "contig%d" % i) for i in range(num_contigs) ]
+
+    info.update_query_gene_mapping(dict([ (q, ("gene%d" % (i / 3), '+')) for i,q in enumerate(queries) ]))
+
+    for i in range(num_contigs / 10) :
+        info.put_genefamily2filename("family%d" % i, "glutton%06d" % i)
+
+    return directory, info
+
+def main() :
+    max_contigs = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    print "%10s %16s %16s %16s" % ('contigs', 'flush (ms)', 'journal (ms)', 'load (ms)')
+
+    num_contigs = 1000
+
+    while num_contigs <= max_contigs :
+        directory, info = project(num_contigs)
+
+        start = time.time()
+        info.flush()
+        flush = time.time() - start
+
+        repeats = 100
+        start = time.time()
+
+        for i in range(repeats) :
+            info.put_genefamily2filename("extra%d" % i, "glutton%06d" % i)
+
+        journal = (time.time() - start) / repeats
+
+        info.release_all()
+
+        start = time.time()
+        GluttonInformation(directory, None, FakeDB()).release_all()
+        load = time.time() - start
+
+        print "%10d %16.2f %16.2f %16.2f" % (num_contigs, flush * 1e3, journal * 1e3, load * 1e3)
+        sys.stdout.flush()
+
+        shutil.rmtree(directory)
+        num_contigs *= 10
+
+if __name__ == '__main__' :
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# per-job overhead of WorkQueue, with jobs that do nothing, how long join()
+# takes to return after the last job has finished and how much cpu an idle
+# queue uses
+#
+#   python benchmarks/queue_overhead.py [num_jobs] [max_workers]
+
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from glutton.utils import set_threads
+from glutton.queue import WorkQueue
+from glutton.job import Job
+
+
+class NoopJob(Job) :
+    def __init__(self, callback) :
+        super(NoopJob, self).__init__(callback)
+
+    def _run(self) :
+        return 0
+
+    def _get_filenames(self) :
+        return []
+
+def cpu_time() :
+    t = os.times()
+    return t[0] + t[1]
+
+def overhead(workers, num_jobs) :
+    set_threads(workers)
+
+    lock = threading.Lock()
+    last = [0.0]
+
+    def _callback(job) :
+        lock.acquire()
+        last[0] = time.time()
+        lock.release()
+
+    start = time.time()
+
+    q = WorkQueue()
+
+    for _ in range(num_jobs) :
+        q.enqueue(NoopJob(_callback))
+
+    q.join()
+
+    end = time.time()
+
+    return ((end - start) / num_jobs) * 1e6, (end - last[0]) * 1e3
+
+def idle(workers, seconds=2.0) :
+    set_threads(workers)
+
+    q = WorkQueue()
+
+    before = cpu_time()
+    time.sleep(seconds)
+    used = cpu_time() - before
+
+    q.join()
+
+    return (used / seconds) * 100
+
+def main() :
+    num_jobs    = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    print "%d no-op jobs" % num_jobs
+    print "%8s %16s %16s %16s" % ('workers', 'us per job', 'join (ms)', 'idle cpu (%)')
+
+    workers = 1
+
+    while workers <= max_workers :
+        per_job, drain = overhead(workers, num_jobs)
+        print "%8d %16.1f %16.1f %16.2f" % (workers, per_job, drain, idle(workers))
+        sys.stdout.flush()
+        workers *= 2
+
+if __name__ == '__main__' :
+    main()
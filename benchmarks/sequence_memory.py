@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# memory used by a synthetic reference held as genes with string sequences
+# (as Gene did before sequences were packed) and with packed sequences
+#
+#   python benchmarks/sequence_memory.py [num_genes]
+
+import os
+import sys
+import time
+import json
+import random
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from glutton.genefamily import Gene, GeneFamily
+
+from glt_startup import rss_mb
+
+
+# what Gene looked like before, a __dict__ per gene and a str per sequence
+class StringGene(object) :
+    def __init__(self, name, sequence=None, id=None) :
+        self.name = name
+        self.sequence = sequence
+        self.id = id
+
+class StringGeneFamily(list) :
+    def __init__(self, genes=[], id=None) :
+        list.__init__(self, genes)
+        self.id = id
+        self.tree = None
+
+def sequences(num_genes) :
+    random.seed(num_genes)
+
+    # occasional ambiguous bases, as in real references
+    for i in range(num_genes) :
+        seq = ''.join([ random.choice('ACGT') for _ in range(random.randint(100, 800) * 3) ])
+
+        if (i % 50) == 0 :
+            seq = seq[:30] + 'NNN' + seq[33:]
+
+        yield seq
+
+def measure(mode, num_genes) :
+    gene_class, family_class = (Gene, GeneFamily) if mode == 'packed' else (StringGene, StringGeneFamily)
+
+    # sequences are generated one at a time, so (as when reading the 
+    # reference) the only copy that stays in memory is in the gene
+    before = rss_mb()
+    elapsed = 0.0
+
+    data = {}
+    genes = []
+    bases = 0
+
+    for i,seq in enumerate(sequences(num_genes)) :
+        bases += len(seq)
+
+        start = time.time()
+        genes.append(gene_class("name%d" % i, seq, id="gene%d" % i))
+        elapsed += (time.time() - start)
+
+        if len(genes) == 5 :
+            data["genefamily%d" % i] = family_class(genes, id="genefamily%d" % i)
+            genes = []
+
+    if genes :
+        data["genefamily%d" % num_genes] = family_class(genes, id="genefamily%d" % num_genes)
+
+    del seq, genes
+    used = rss_mb() - before
+
+    # read everything back once, as extract_all does
+    start = time.time()
+    total = sum([ len(g.sequence) for gf in data.itervalues() for g in gf ])
+    unpack = time.time() - start
+
+    assert total == bases
+
+    print json.dumps([bases, used, elapsed, unpack])
+
+def main() :
+    num_genes = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    print "%d genes" % num_genes
+
+    for mode in ('string', 'packed') :
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--measure', mode, str(num_genes)])
+        bases, used, elapsed, unpack = json.loads(out.strip().split('\n')[-1])
+
+        print "%-8s %8.1f Mbases  rss +%7.1f MB  (%5.2f bytes/base)  create %6.2f s  read all %6.2f s" % \
+            (mode, bases / 1e6, used, (used * 1024 * 1024) / bases, elapsed, unpack)
+
+if __name__ == '__main__' :
+    if len(sys.argv) == 4 and sys.argv[1] == '--measure' :
+        measure(sys.argv[2], int(sys.argv[3]))
+    else :
+        main()
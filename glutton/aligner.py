@@ -1,23 +1,57 @@
 import collections
-import shutil
 import sys
+import time
 import threading
 
 from glutton.db import GluttonDB, GluttonDBError, GluttonDBFileError
 from glutton.localsearch import All_vs_all_search
-from glutton.utils import tmpfile, num_threads, get_log, rm_f, check_dir, md5
-from glutton.queue import WorkQueue
-from glutton.job import PaganJob
+from glutton.utils import num_threads, get_log, rm_f, check_dir, md5
+from glutton.batch import work_queue
+from glutton.job import PaganJob, BlastJob, JobError
 from glutton.genefamily import Gene, biopy_to_gene, seqlen
-from glutton.info import GluttonInformation, GluttonParameters
+from glutton.info import GluttonInformation, GluttonParameters, SPLIT
+from glutton.costmodel import CostModel
+from glutton.lease import LEASE_TIME
+from glutton.pack import PackWriter, PACK_DIR, PACK_NAME, remove_packs
 
-from os.path import isfile, basename, join
+from os.path import isfile, join
 
 from Bio import SeqIO
 
 
+BLASTX_LEASE = 'blastx'
+
+# what pagan jobs need, read when the job is prepared by a worker (see 
+# PaganJob.prepare()) rather than when it is enqueued, contigs are shared 
+# between threads so the ones on the other strand are copies
+class FamilyInputs(object) :
+    def __init__(self, db, contigs) :
+        self.db = db
+        self.contigs = contigs
+
+    def _queries(self, query_ids) :
+        return [ self.contigs[contigid].reverse_complemented() if strand == '-' else self.contigs[contigid] for contigid,strand in query_ids ]
+
+    def _reference(self, famid) :
+        alignment = self.db.get_alignment(famid)
+        return alignment, alignment.get_tree()
+
+    def load(self, name, query_ids) :
+        try :
+            alignment, tree = self._reference(name)
+
+        except (GluttonDBError, GluttonDBFileError), e :
+            raise JobError(str(e))
+
+        return self._queries(query_ids), alignment, tree
+
+# for gene families without an alignment, contigs are aligned to each gene
+class GeneInputs(FamilyInputs) :
+    def _reference(self, geneid) :
+        return [ self.db.get_gene(geneid) ], None
+
 class Aligner(object) :
-    def __init__(self, top_level_directory, reference_fname, min_length, min_hitidentity, min_hitlength, max_evalue, batch_size, min_alignidentity, min_alignoverlap) :
+    def __init__(self, top_level_directory, reference_fname, min_length, min_hitidentity, min_hitlength, max_evalue, batch_size, min_alignidentity, min_alignoverlap, lease_time=LEASE_TIME) :
         self.directory = join(top_level_directory, 'alignments')
         self.min_length = min_length # glutton
         self.min_hitidentity = min_hitidentity # blast 
@@ -35,6 +69,10 @@ class Aligner(object) :
         self.lock = threading.Lock()
         self.complete_jobs = 0
         self.total_jobs = 0
+        self.split_pending = {}    # gene family id -> number of its genes not aligned yet
+
+        # how often to check on gene families other processes are aligning
+        self.poll_interval = min(60, lease_time / 4.0)
 
         self.log = get_log()
 
@@ -44,9 +82,19 @@ class Aligner(object) :
 
         self.resume = self.param.able_to_resume()
 
-        self.info = GluttonInformation(self.directory, self.param, self.db, resume=self.resume)
+        self.info = GluttonInformation(self.directory, self.param, self.db, resume=self.resume, lease_time=lease_time)
         self.param.set_full_checksum()
 
+        # pagan's output files, see glutton/pack.py
+        if not self.resume :
+            remove_packs(join(self.directory, PACK_DIR))
+
+        self.pack = PackWriter(join(self.directory, PACK_DIR), self.info.leases.owner)
+
+        # so that other processes started on this project can resume
+        if not self.resume :
+            self.param.flush()
+
     def _read_contigs(self) :
         contigs = {}
 
@@ -84,48 +132,26 @@ class Aligner(object) :
 
         rm_f(self.cleanup_files)
 
+        self.pack.close()
         self.info.flush()
+        self.info.release_all()
         self.param.flush()
 
-    def _correct_strand(self, contig, strand) :
-        if strand == '-' :
-            contig.reverse_complement()
-
-        return contig
-
     def align(self) :
         self.log.info("starting alignment procedure")
 
-        # convert the names of the contigs to something no program can complain about
-        # + filter out the ones that could never have a long enough alignment
-        contigs = self._read_contigs()
-
-        pending_contigs = [ contigs[i] for i in self.info.pending_queries() ]
-
-        self.log.info("%d contigs have not been assigned to genes..." % len(pending_contigs))
+        # only one process assigns contigs to genes, any others started on the
+        # same project wait for it to finish
+        if not self.info.leases.acquire(BLASTX_LEASE) :
+            self.log.info("waiting for another process to assign contigs to genes...")
+            self.info.leases.wait(BLASTX_LEASE, self.poll_interval)
 
-        # depending on when the program was terminated this step may be complete or partially
-        # complete 
-        if pending_contigs :
-            db_fname = self.db.extract_all()
-            self.cleanup_files.append(db_fname)
+        try :
+            self.info.refresh()
+            contigs = self._assign_contigs()
 
-            # do an all vs all search of contigs vs database of transcripts
-            # return a dict of tmp ids with gene ids
-            self.info.update_query_gene_mapping(
-                self.search.process(
-                    db_fname, 
-                    pending_contigs,
-                    self.db.nucleotide,
-                    self.min_hitidentity,
-                    self.min_hitlength,
-                    self.max_evalue)
-                )
-
-            rm_f(db_fname)
-
-        # save intermediate results
-        self.info.flush()
+        finally :
+            self.info.release(BLASTX_LEASE)
 
         # use the database to convert the mapping from tmp id -> gene
         # to gene family -> list of (tmp id, strands)
@@ -143,100 +169,257 @@ class Aligner(object) :
 
 
         # queue all the alignments up using a work queue and pagan
-        self.q = WorkQueue()
+        costmodel = CostModel()
+        self.q = work_queue(costmodel)
 
         self.total_jobs = len(genefamily_contig_map) - self.info.len_genefamily2filename()
         self.complete_jobs = -1
         self._progress()
 
-        for famid in self.sort_keys_by_complexity(genefamily_contig_map) :
+        # gene families that other processes are aligning
+        deferred = []
+
+        for famid in self.sort_keys_by_complexity(genefamily_contig_map, contigs, costmodel) :
             # ignore the jobs that have already been run
             if self.info.in_genefamily2filename(famid) :
                 continue
 
+            if self.info.claim(famid) :
+                self._enqueue(famid, genefamily_contig_map, contigs, costmodel)
+
+            elif self.info.in_genefamily2filename(famid) :
+                self._progress()
+
+            else :
+                deferred.append(famid)
+
+        # if another process stops before finishing, its leases expire and
+        # the gene families it was aligning can be claimed here
+        while deferred :
+            self.log.debug("%d gene families are being aligned by other processes..." % len(deferred))
+            time.sleep(self.poll_interval)
+
+            # our results are in the journal, read theirs
+            self.info.refresh()
+
+            tmp = []
+
+            for famid in deferred :
+                if self.info.in_genefamily2filename(famid) :
+                    self._progress()
+
+                elif self.info.claim(famid) :
+                    self._enqueue(famid, genefamily_contig_map, contigs, costmodel)
+
+                elif self.info.in_genefamily2filename(famid) :
+                    self._progress()
+
+                else :
+                    tmp.append(famid)
+
+            deferred = tmp
+
+        self.log.debug("waiting for job queue to drain...")
+
+        try :
+            self.q.join()
+
+        finally :
+            # save all the results again
+            self.pack.close()
+            self.info.flush()
+            self.info.release_all()
+
+    # finish jobs written by align --emit-jobs, as if they had just been run
+    def collect(self, results) :
+        blastx = [ (ret,job) for ret,job in results if isinstance(job, BlastJob) ]
+        pagan = [ (ret,job) for ret,job in results if not isinstance(job, BlastJob) ]
+
+        if blastx :
+            self.info.update_query_gene_mapping(
+                self.search.collect(
+                    blastx,
+                    self.db.nucleotide,
+                    self.min_hitidentity,
+                    self.min_hitlength,
+                    self.max_evalue)
+                )
+
+        if pagan :
+            self.total_jobs = len(pagan)
+
+            for ret,job in pagan :
+                famid = getattr(job, 'split_from', None)
+
+                if famid is not None :
+                    self.split_pending[famid] = self.split_pending.get(famid, 0) + 1
+            self.complete_jobs = -1
+            self._progress()
+
+            for ret,job in pagan :
+                job.callback = self.job_callback
+                job.finish(ret)
+
+        self.pack.close()
+        self.info.flush()
+        self.info.release_all()
+
+    def _assign_contigs(self) :
+        # convert the names of the contigs to something no program can complain about
+        # + filter out the ones that could never have a long enough alignment
+        contigs = self._read_contigs()
+
+        pending_contigs = [ contigs[i] for i in self.info.pending_queries() ]
+
+        self.log.info("%d contigs have not been assigned to genes..." % len(pending_contigs))
+
+        # depending on when the program was terminated this step may be complete or partially
+        # complete 
+        if pending_contigs :
+            db_fname, prebuilt = self.db.get_proteome()
+
+            if not prebuilt :
+                self.cleanup_files.append(db_fname)
+
+            # the results refer to contigs by query id, so these need to be
+            # on disk in case they are collected by another process (--emit-jobs)
+            self.info.sync()
+
+            # do an all vs all search of contigs vs database of transcripts
+            # the gene assignments from each job are saved as it finishes
             try :
-                # get the alignment and tree from the database
-                alignment = self.db.get_alignment(famid)
-                tree = alignment.get_tree()
-
-                # get contigs
-                job_contigs = [ self._correct_strand(contigs[contigid], strand) for contigid,strand in genefamily_contig_map[famid] ]
-
-                # queue the job
-                self.q.enqueue(
-                    PaganJob(
-                        self.job_callback,
-                        job_contigs,
-                        famid,
-                        alignment,
-                        tree,
-                        self.min_alignidentity,
-                        self.min_alignoverlap)
-                    )
-
-                # avoid the split code later in the loop...
-                continue
+                self.search.process(
+                        db_fname, 
+                        pending_contigs,
+                        self.db.nucleotide,
+                        self.min_hitidentity,
+                        self.min_hitlength,
+                        self.max_evalue,
+                        prebuilt,
+                        callback=self.info.update_query_gene_mapping)
+
+            finally :
+                if not prebuilt :
+                    rm_f(db_fname)
 
-            except GluttonDBError, gde :
-                # this means we have never heard of this gene family
-                self.log.warn(str(gde))
+        # save intermediate results
+        self.info.flush()
+
+        return contigs
+
+    # jobs only have the ids of what they need, the workers read the alignments
+    # and contigs in parallel (see FamilyInputs), the enqueuing thread only
+    # checks the alignment is in the database
+    def _enqueue(self, famid, genefamily_contig_map, contigs, costmodel) :
+        try :
+            self.db.check_alignment(famid)
+
+            job = PaganJob(
+                    self.job_callback,
+                    FamilyInputs(self.db, contigs),
+                    famid,
+                    genefamily_contig_map[famid],
+                    self.min_alignidentity,
+                    self.min_alignoverlap)
+
+            job.predicted = self._predict(famid, genefamily_contig_map[famid], contigs, costmodel)
+
+            # queue the job
+            self.q.enqueue(job)
+
+            # avoid the split code later...
+            return
+
+        except GluttonDBError, gde :
+            # this means we have never heard of this gene family
+            self.log.warn(str(gde))
+            self.info.release(famid)
+            return
+
+        except GluttonDBFileError, gdfe :
+            # this means we have heard of the gene family, but the
+            # alignment files were missing...
+            self.log.warn(str(gdfe))
+
+        # okay, the gene family was not aligned for some reason
+        # instead we will split the gene family into constituent genes
+        # and handle each one separately...
+        #
+        # (the lease on the gene family is kept until the end)
+
+        self.log.warn("gene family was not aligned, breaking down into separate genes...")
+
+        # collect contigs by gene
+        gene2contigs = collections.defaultdict(list)
+
+        for contigid,strand in genefamily_contig_map[famid] :
+            try :
+                geneid = self.info.query_to_gene(contigid)
+
+            except KeyError : # this should be impossible
+                self.log.warn("no gene assignment for %s" % contigid)
                 continue
 
-            except GluttonDBFileError, gdfe :
-                # this means we have heard of the gene family, but the
-                # alignment files were missing...
-                self.log.warn(str(gdfe))
+            gene2contigs[geneid].append((contigid, strand))
 
-            # okay, the gene family was not aligned for some reason
-            # instead we will split the gene family into constituent genes
-            # and handle each one separately...
+        # run each gene separately
+        jobs = []
 
-            self.log.warn("gene family was not aligned, breaking down into separate genes...")
-            self.total_jobs += (len(genefamily_contig_map[famid]) - 1)
+        for geneid in gene2contigs :
+            try :
+                length = len(self.db.get_gene(geneid))
 
-            # collect contigs by gene
-            gene2contigs = collections.defaultdict(list)
+            except GluttonDBError, gde :
+                self.log.warn(str(gde))
+                continue
 
-            for contigid,strand in genefamily_contig_map[famid] :
-                try :
-                    geneid = self.info.query_to_gene(contigid)
+            job = PaganJob(
+                    self.job_callback,
+                    GeneInputs(self.db, contigs),
+                    geneid,
+                    gene2contigs[geneid],
+                    self.min_alignidentity,
+                    self.min_alignoverlap)
 
-                except KeyError : # this should be impossible
-                    self.log.warn("no gene assignment for %s" % contigid)
-                    continue
+            job.predicted = costmodel.predict(job.jobtype, (len(gene2contigs[geneid]) + 1, sum([ len(contigs[contigid]) for contigid,strand in gene2contigs[geneid] ]) + length))
+            job.split_from = famid
 
-                gene2contigs[geneid].append((contigid, strand))
+            jobs.append(job)
 
-            # run each gene separately
-            for geneid in gene2contigs :
-                try :
-                    alignment = [ self.db.get_gene(geneid) ]
+        # the gene family is done once all of its genes are (see job_callback),
+        # until then the lease stops other processes from splitting it again
+        if not jobs :
+            self.info.put_genefamily2filename(famid, SPLIT)
+            self._progress()
+            return
 
-                except GluttonDBError, gde :
-                    self.log.warn(str(gde))
-                    continue
+        self.lock.acquire()
+        self.total_jobs += (len(jobs) - 1)
+        self.split_pending[famid] = len(jobs)
+        self.lock.release()
 
-                # queue the job
-                self.q.enqueue(
-                    PaganJob(
-                        self.job_callback,
-                        [ self._correct_strand(contigs[contigid], strand) for contigid,strand in gene2contigs[geneid] ],
-                        geneid,
-                        alignment,
-                        None,
-                        self.min_alignidentity,
-                        self.min_alignoverlap)
-                    )
+        for job in jobs :
+            self.q.enqueue(job)
 
+    # the cost model's prediction using the number and length of the contigs
+    # + the gene family they are aligned to (the same as PaganJob.features(),
+    # without reading the alignment)
+    def _predict(self, famid, query_ids, contigs, costmodel) :
+        try :
+            num_genes = self.db._family_size(famid)
+            length = self.db._family_length(famid)
 
-        self.log.debug("waiting for job queue to drain...")
-        self.q.join()
+        except KeyError :
+            num_genes = length = 0
 
-        # save all the results again
-        self.info.flush()
+        num_contigs = len(query_ids)
+        contig_length = sum([ len(contigs[contigid]) for contigid,strand in query_ids ])
 
-    def sort_keys_by_complexity(self, d) :
-        return [ k for l,k,v in sorted([ (len(v), k, v) for k,v in d.items() ], reverse=True) ]
+        return costmodel.predict('PaganJob', (num_contigs + num_genes, contig_length + length))
+
+    # most expensive first, according to the cost model
+    def sort_keys_by_complexity(self, d, contigs, costmodel) :
+        return [ k for c,k in sorted([ (self._predict(k, d[k], contigs, costmodel), k) for k in d ], reverse=True) ]
 
     def _progress(self) :
         self.lock.acquire()
@@ -262,23 +445,44 @@ class Aligner(object) :
         self._progress()
 
         if job.success() :
-            dst = tmpfile(directory=self.directory, suffix='.protein')
-            dst_base = basename(dst)[:-8]
-
-            self.log.debug("cp %s %s" % (job.protein_alignment, dst))
-            shutil.copyfile(job.protein_alignment, dst)
-            
-            shutil.copyfile(job.query_fname, dst[:-8] + '.queries')
-            shutil.copyfile(job.alignment_fname, dst[:-8] + '.reference')
-            
+            name = PACK_NAME % job.genefamily
+            files = { 'protein'   : job.protein_alignment,
+                      'queries'   : job.query_fname,
+                      'reference' : job.alignment_fname }
+
             if job.tree_fname :
-                shutil.copyfile(job.tree_fname, dst[:-8] + '.tree')
+                files['tree'] = job.tree_fname
 
             if self.db.nucleotide :
-                self.log.debug("cp %s %s" % (job.nucleotide_alignment, dst[:-8] + '.nucleotide'))
-                shutil.copyfile(job.nucleotide_alignment, dst[:-8] + '.nucleotide')
+                files['nucleotide'] = job.nucleotide_alignment
+
+            # in the pack before the progress files say it is done
+            self.log.debug("packing %s as %s" % (' '.join(sorted(files.values())), name))
+            self.pack.append(name, files)
         
-            self.info.put_genefamily2filename(job.genefamily, dst_base)
+            self.info.put_genefamily2filename(job.genefamily, name)
         else :
-            self.info.put_genefamily2filename(job.genefamily)
+            self.info.put_genefamily2filename(job.genefamily, reason=job.reason)
+
+        famid = getattr(job, 'split_from', None)
+
+        if famid is not None :
+            self._split_done(famid)
+
+    # one of the genes of a gene family that was split up has been aligned
+    def _split_done(self, famid) :
+        self.lock.acquire()
+
+        try :
+            self.split_pending[famid] -= 1
+            done = (self.split_pending[famid] == 0)
+
+            if done :
+                del self.split_pending[famid]
+
+        finally :
+            self.lock.release()
+
+        if done :
+            self.info.put_genefamily2filename(famid, SPLIT)
 
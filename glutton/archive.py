@@ -0,0 +1,500 @@
+import mmap
+import struct
+import zlib
+import json
+import zipfile
+import threading
+import Queue
+import time
+import os
+import re
+
+from os.path import exists
+
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+
+from glutton.utils import get_log
+
+
+# version 1 archives are plain zip files, version 2 archives have an index
+# member that is located using the zip file comment
+GLT_FORMAT_VERSION = 2
+INDEX_FNAME = 'index.json'
+INDEX_MAGIC = 'glutton-index'
+
+ALIGNMENT_EXT = '.align'
+TREE_EXT = '.tree'
+
+class GluttonArchiveError(Exception) :
+    pass
+
+# the index maps member name -> [header offset, compressed size, size, compression type]
+# and also records how many bytes of the central directory it covers, members
+# appended after the index was written are found by reading the remainder of the
+# central directory (zip files opened in append mode rewrite the central directory
+# in the same order, so the prefix stays valid)
+def _parse_central_directory(buf, start, end, concat) :
+    pos = start
+
+    while pos < end :
+        centdir = struct.unpack(zipfile.structCentralDir, buf[pos : pos + zipfile.sizeCentralDir])
+
+        if centdir[zipfile._CD_SIGNATURE] != zipfile.stringCentralDir :
+            raise GluttonArchiveError("bad magic number in central directory")
+
+        pos += zipfile.sizeCentralDir
+        name = buf[pos : pos + centdir[zipfile._CD_FILENAME_LENGTH]]
+        pos += centdir[zipfile._CD_FILENAME_LENGTH]
+        extra = buf[pos : pos + centdir[zipfile._CD_EXTRA_FIELD_LENGTH]]
+        pos += (centdir[zipfile._CD_EXTRA_FIELD_LENGTH] + centdir[zipfile._CD_COMMENT_LENGTH])
+
+        header_offset = centdir[zipfile._CD_LOCAL_HEADER_OFFSET]
+        compress_size = centdir[zipfile._CD_COMPRESSED_SIZE]
+        file_size     = centdir[zipfile._CD_UNCOMPRESSED_SIZE]
+
+        # zip64 entries keep the real values in the extra field
+        if 0xffffffff in (header_offset, compress_size, file_size) :
+            x = ZipInfo(name)
+            x.extra = extra
+            x.header_offset = header_offset
+            x.compress_size = compress_size
+            x.file_size = file_size
+            x._decodeExtra()
+            header_offset, compress_size, file_size = x.header_offset, x.compress_size, x.file_size
+
+        yield name, [header_offset + concat, compress_size, file_size, centdir[zipfile._CD_COMPRESS_TYPE]]
+
+class GluttonArchive(object) :
+    def __init__(self, fname) :
+        self.fname = fname
+        self.log = get_log()
+        self.members = {}   # name -> [header offset, compressed size, size, compression type]
+        self.aligned = set()  # gene families with both alignment and tree files
+        self.version = 1
+
+        self.f = open(self.fname, 'rb')
+
+        try :
+            self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._read_directory()
+
+        except (ValueError, EnvironmentError, struct.error, zipfile.BadZipfile), e :
+            self.f.close()
+            raise GluttonArchiveError("could not read %s (%s)" % (self.fname, str(e)))
+
+    def _read_directory(self) :
+        endrec = zipfile._EndRecData(self.f)
+
+        if not endrec :
+            raise GluttonArchiveError("%s is not a zip file" % self.fname)
+
+        size_cd = endrec[zipfile._ECD_SIZE]
+        offset_cd = endrec[zipfile._ECD_OFFSET]
+        concat = endrec[zipfile._ECD_LOCATION] - size_cd - offset_cd
+
+        if endrec[zipfile._ECD_SIGNATURE] == zipfile.stringEndArchive64 :
+            concat -= (zipfile.sizeEndCentDir64 + zipfile.sizeEndCentDir64Locator)
+
+        self.concat = concat
+        self.cd_start = offset_cd + concat
+        self.cd_size = size_cd
+
+        cd_covered = self._read_index(endrec[zipfile._ECD_COMMENT])
+        changes = []
+
+        for name,info in _parse_central_directory(self.mm, self.cd_start + cd_covered, self.cd_start + self.cd_size, self.concat) :
+            self.members[name] = info
+            changes.append(name)
+
+        # only look at what has been added since the index was written
+        for name in changes :
+            stem,ext = os.path.splitext(name)
+
+            if (ext in (ALIGNMENT_EXT, TREE_EXT)) and ((stem + ALIGNMENT_EXT) in self.members) and ((stem + TREE_EXT) in self.members) :
+                self.aligned.add(stem)
+
+    # returns the number of bytes of the central directory covered by the index
+    def _read_index(self, comment) :
+        fields = comment.split()
+
+        if len(fields) != 3 or fields[0] != INDEX_MAGIC :
+            return 0
+
+        try :
+            version = int(fields[1])
+            header_offset = int(fields[2]) + self.concat
+            index = json.loads(self._read_at(header_offset, *self._local_sizes(header_offset)))
+            covered = index['cd-size']
+
+            if covered > self.cd_size :
+                raise GluttonArchiveError("index covers more than the central directory")
+
+            if (covered != self.cd_size) and (self.mm[self.cd_start + covered : self.cd_start + covered + 4] != zipfile.stringCentralDir) :
+                raise GluttonArchiveError("index does not match central directory")
+
+        except (ValueError, KeyError, TypeError, struct.error, zlib.error, GluttonArchiveError), e :
+            self.log.warn("ignoring index in %s (%s)" % (self.fname, str(e)))
+            return 0
+
+        self.version = version
+        self.members = dict([ (str(k), [v[0] + self.concat] + v[1:]) for k,v in index['members'].iteritems() ])
+        self.aligned = set([ str(famid) for famid in index.get('aligned', []) ])
+
+        # older indices did not record this
+        if 'aligned' not in index :
+            return 0
+
+        return covered
+
+    # the central directory is authoritative for sizes, but the index member
+    # needs to be read before we have looked at it, so use the local header
+    def _local_sizes(self, header_offset) :
+        fheader = struct.unpack(zipfile.structFileHeader, self.mm[header_offset : header_offset + zipfile.sizeFileHeader])
+        return fheader[zipfile._FH_COMPRESSED_SIZE], fheader[zipfile._FH_COMPRESSION_METHOD]
+
+    def _data_offset(self, header_offset) :
+        fheader = struct.unpack(zipfile.structFileHeader, self.mm[header_offset : header_offset + zipfile.sizeFileHeader])
+
+        if fheader[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader :
+            raise GluttonArchiveError("bad magic number for file header")
+
+        return header_offset + zipfile.sizeFileHeader + fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH]
+
+    def _read_at(self, header_offset, compress_size, compress_type) :
+        start = self._data_offset(header_offset)
+        data = self.mm[start : start + compress_size]
+
+        if compress_type == ZIP_DEFLATED :
+            return zlib.decompress(data, -15)
+
+        elif compress_type == ZIP_STORED :
+            return data
+
+        raise GluttonArchiveError("unsupported compression type (%d)" % compress_type)
+
+    def __contains__(self, name) :
+        return name in self.members
+
+    def __len__(self) :
+        return len(self.members)
+
+    def names(self) :
+        return self.members.keys()
+
+    def info(self, name) :
+        return self.members[name]
+
+    # slicing the mmap does not move a shared file position, so this is safe
+    # to call from multiple threads without a lock
+    def read(self, name) :
+        try :
+            header_offset, compress_size, file_size, compress_type = self.members[name]
+
+        except KeyError :
+            raise GluttonArchiveError("'%s' not found in %s" % (name, self.fname))
+
+        return self._read_at(header_offset, compress_size, compress_type)
+
+    # read part of a member, only possible if the member was stored uncompressed
+    def read_range(self, name, offset, length) :
+        try :
+            header_offset, compress_size, file_size, compress_type = self.members[name]
+
+        except KeyError :
+            raise GluttonArchiveError("'%s' not found in %s" % (name, self.fname))
+
+        if compress_type != ZIP_STORED :
+            raise GluttonArchiveError("'%s' is compressed, cannot read a range" % name)
+
+        if offset + length > file_size :
+            raise GluttonArchiveError("range (%d, %d) is outside of '%s'" % (offset, length, name))
+
+        start = self._data_offset(header_offset) + offset
+
+        return self.mm[start : start + length]
+
+    def close(self) :
+        self.mm.close()
+        self.f.close()
+
+# (re)write the index for fname, this should be done after all the
+# other members have been written, i.e. when the database is flushed
+def write_index(fname) :
+    a = GluttonArchive(fname)
+    concat = a.concat
+    index = {
+        'cd-size' : a.cd_size,
+        'members' : dict([ (k, [v[0] - concat] + v[1:]) for k,v in a.members.iteritems() ]),
+        'aligned' : sorted(a.aligned)
+      }
+    a.close()
+
+    z = ZipFile(fname, 'a', compression=ZIP_DEFLATED, allowZip64=True)
+    header_offset = z.fp.tell() - concat
+    z.writestr(INDEX_FNAME, json.dumps(index))
+    z.comment = "%s %d %d" % (INDEX_MAGIC, GLT_FORMAT_VERSION, header_offset)
+    z.close()
+
+# before a batch is appended to the archive, everything needed to undo or redo it 
+# is written to a journal, if we crash while the archive is being modified then 
+# the original central directory is restored and the batch is written again
+#
+# journal format: json header line, original central directory + end record, member data
+def _journal_fname(fname) :
+    return fname + '.journal'
+
+def _fsync(fname) :
+    fd = os.open(fname, os.O_RDONLY)
+
+    try :
+        os.fsync(fd)
+
+    finally :
+        os.close(fd)
+
+def _append_compressed(z, name, data, crc, file_size, compress_type) :
+    zinfo = ZipInfo(filename=name, date_time=time.localtime(time.time())[:6])
+    zinfo.compress_type = compress_type
+    zinfo.external_attr = 0600 << 16
+    zinfo.file_size = file_size
+    zinfo.compress_size = len(data)
+    zinfo.CRC = crc
+    zinfo.header_offset = z.fp.tell()
+
+    z._writecheck(zinfo)
+    z._didModify = True
+
+    z.fp.write(zinfo.FileHeader(zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT))
+    z.fp.write(data)
+    z.fp.flush()
+
+    z.filelist.append(zinfo)
+    z.NameToInfo[zinfo.filename] = zinfo
+
+def compress_member(name, data, compress_type=ZIP_DEFLATED, level=zlib.Z_DEFAULT_COMPRESSION) :
+    crc = zlib.crc32(data) & 0xffffffff
+
+    if compress_type == ZIP_DEFLATED :
+        co = zlib.compressobj(level, zlib.DEFLATED, -15)
+        compressed = co.compress(data) + co.flush()
+    else :
+        compressed = data
+
+    return (name, compressed, crc, len(data), compress_type)
+
+def append_members(fname, members) :
+    journal = _journal_fname(fname)
+
+    z = ZipFile(fname, 'a', allowZip64=True)
+
+    try :
+        z.fp.seek(0, os.SEEK_END)
+        end = z.fp.tell()
+        z.fp.seek(z.start_dir)
+        tail = z.fp.read(end - z.start_dir)
+        z.fp.seek(z.start_dir)
+
+        header = {
+            'start-dir' : z.start_dir,
+            'tail-size' : len(tail),
+            'members'   : [ (name, len(data), crc, file_size, compress_type) for name,data,crc,file_size,compress_type in members ]
+          }
+
+        with open(journal, 'wb') as f :
+            f.write(json.dumps(header) + '\n')
+            f.write(tail)
+
+            for name,data,crc,file_size,compress_type in members :
+                f.write(data)
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        for m in members :
+            _append_compressed(z, *m)
+
+    finally :
+        z.close()
+
+    _fsync(fname)
+    os.remove(journal)
+
+def recover_journal(fname) :
+    journal = _journal_fname(fname)
+
+    if not exists(journal) :
+        return False
+
+    log = get_log()
+
+    with open(journal, 'rb') as f :
+        try :
+            header = json.loads(f.readline())
+            tail = f.read(header['tail-size'])
+            members = []
+
+            for name,length,crc,file_size,compress_type in header['members'] :
+                data = f.read(length)
+
+                if len(data) != length :
+                    raise ValueError("truncated member %s" % name)
+
+                members.append((str(name), data, crc, file_size, compress_type))
+
+            if len(tail) != header['tail-size'] :
+                raise ValueError("truncated central directory")
+
+        except (ValueError, KeyError, TypeError), e :
+            # we crashed before the journal was complete, so the archive was not touched
+            log.warn("discarding incomplete journal %s (%s)" % (journal, str(e)))
+            os.remove(journal)
+            return False
+
+    log.warn("%s was not closed properly, restoring %d files from %s" % (fname, len(members), journal))
+
+    with open(fname, 'r+b') as f :
+        f.seek(header['start-dir'])
+        f.write(tail)
+        f.truncate()
+
+    append_members(fname, members)
+
+    return True
+
+class GluttonArchiveWriter(threading.Thread) :
+    # appends to an archive from a single thread, members are compressed by the 
+    # caller (so multiple threads can do it at the same time) and committed in batches
+    def __init__(self, fname, batch_size=100, interval=10.0) :
+        super(GluttonArchiveWriter, self).__init__(name='ArchiveWriter')
+        self.setDaemon(True)
+
+        self.fname = fname
+        self.batch_size = batch_size
+        self.interval = interval
+        self.log = get_log()
+
+        self.q = Queue.Queue()
+        self.commits = 0
+        self.committed_members = 0
+        self.error = None
+
+        self.start()
+
+    # members is a list of (name, contents) that will be committed in the same batch
+    def put(self, members) :
+        if self.error :
+            raise GluttonArchiveError("writer stopped: %s" % str(self.error))
+
+        self.q.put([ compress_member(name, data) for name,data in members ])
+
+    def close(self) :
+        self.q.put(None)
+        self.join()
+
+        if self.error :
+            raise GluttonArchiveError("writer stopped: %s" % str(self.error))
+
+    def _commit(self, batch) :
+        if not batch :
+            return
+
+        append_members(self.fname, batch)
+
+        self.commits += 1
+        self.committed_members += len(batch)
+        self.log.debug("committed %d files to %s" % (len(batch), self.fname))
+
+    def run(self) :
+        batch = []
+        deadline = None
+        finished = False
+
+        while not finished :
+            timeout = None if deadline is None else max(0, deadline - time.time())
+
+            try :
+                members = self.q.get(timeout=timeout) if timeout != 0 else self.q.get_nowait()
+
+                if members is None :
+                    finished = True
+                else :
+                    batch += members
+
+                    if deadline is None :
+                        deadline = time.time() + self.interval
+
+            except Queue.Empty :
+                pass
+
+            if finished or (len(batch) >= self.batch_size) or (deadline and time.time() >= deadline) :
+                try :
+                    self._commit(batch)
+
+                except Exception, e :
+                    self.log.error("could not write to %s (%s)" % (self.fname, str(e)))
+                    self.error = e
+                    return
+
+                batch = []
+                deadline = None
+
+# so that genefamily10 sorts after genefamily9
+def natural_key(s) :
+    return [ int(t) if t.isdigit() else t for t in re.split('(\d+)', s) ]
+
+# copy the latest version of each member from src to dst (not including the index), 
+# gene family members are written in order of family id with the alignment next
+# to the tree, everything else comes first
+#
+#   compression_level is a function of member name returning 0 (stored) or 1-9 
+#   (deflated at that level), None means leave it how it is
+#   keep is a function of member name returning False if it should be dropped
+def compact_archive(src, dst, compression_level, keep=lambda name : True) :
+    a = GluttonArchive(src)
+
+    families = []
+    others = []
+
+    for name in a.names() :
+        if (name == INDEX_FNAME) or not keep(name) :
+            continue
+
+        stem,ext = os.path.splitext(name)
+
+        if ext in (ALIGNMENT_EXT, TREE_EXT) :
+            families.append((natural_key(stem), ext != ALIGNMENT_EXT, name))
+        else :
+            others.append(name)
+
+    order = sorted(others) + [ name for key,is_tree,name in sorted(families) ]
+
+    z = ZipFile(dst, 'w', allowZip64=True)
+
+    try :
+        for name in order :
+            header_offset, compress_size, file_size, compress_type = a.info(name)
+            level = compression_level(name)
+
+            # avoid decompressing + compressing again if nothing would change
+            if (level is None) or ((level == 0) and (compress_type == ZIP_STORED)) :
+                start = a._data_offset(header_offset)
+                fheader = struct.unpack(zipfile.structFileHeader, a.mm[header_offset : header_offset + zipfile.sizeFileHeader])
+                crc = fheader[zipfile._FH_CRC]
+
+                # crc is in a data descriptor after the file
+                if fheader[zipfile._FH_GENERAL_PURPOSE_FLAG_BITS] & 0x08 :
+                    crc = zlib.crc32(a.read(name)) & 0xffffffff
+
+                _append_compressed(z, name, a.mm[start : start + compress_size], crc, file_size, compress_type)
+                continue
+
+            m = compress_member(name, a.read(name), ZIP_STORED, 0) if level == 0 else compress_member(name, a.read(name), ZIP_DEFLATED, level)
+            _append_compressed(z, *m)
+
+    finally :
+        z.close()
+        a.close()
+
+    write_index(dst)
+
+    return len(order)
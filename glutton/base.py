@@ -1,20 +1,67 @@
 import os
+import errno
+import signal
+import threading
 import subprocess
 
 from sys import exit
 from os.path import isfile
 
-from glutton.utils import get_log, get_binary_path
+from glutton.utils import get_log, get_binary_path, get_job_timeout
 
 
+# returned by _execute() when the program exited normally, but did not
+# create the files it should have
+MISSING_OUTPUT = 256
+
 class ExternalToolError(Exception) :
     pass
 
+# programs that are running in this process, each one is started in its own 
+# process group so it can be stopped along with anything it runs, without 
+# signalling glutton's process group
+_running = set()
+_running_lock = threading.Lock()
+
+# this is called from signal handlers, so it does not take the lock
+def kill_running_programs(sig=signal.SIGINT) :
+    for p in list(_running) :
+        try :
+            os.killpg(p.pid, sig)
+
+        except OSError, ose :
+            # already exited
+            if ose.errno != errno.ESRCH :
+                raise
+
 class ExternalTool(object) :
+    # programs that can read their input from stdin and write their results
+    # to stdout, see _execute()
+    streams = False
+
     def __init__(self, location=None) :
         self.binary_location = get_binary_path(self.name) if not location else location
         self.log = get_log()
 
+        # wall-clock limit in seconds, programs still running after this long
+        # are killed (set here so it goes wherever the job is run)
+        self.timeout = get_job_timeout(self.name)
+        self.timed_out = False
+        self.process = None
+
+        self.reset_usage()
+
+    # tools are sent to worker processes with their jobs, loggers do not pickle
+    def __getstate__(self) :
+        state = self.__dict__.copy()
+        del state['log']
+        state['process'] = None
+        return state
+
+    def __setstate__(self, state) :
+        self.__dict__.update(state)
+        self.log = get_log()
+
     @property
     def name(self) :
         return type(self).__name__.lower()
@@ -23,29 +70,187 @@ class ExternalTool(object) :
     def version(self) :
         raise NotImplementedError()
 
-    def _execute(self, parameters, expected_outfiles) :
+    # resources used by the programs run since this was called (cpu is in
+    # seconds, maxrss in kilobytes, the largest of any one program, reads 
+    # and writes are blocks of filesystem I/O)
+    def reset_usage(self) :
+        self.usage = { 'cpu' : 0.0, 'maxrss' : 0, 'reads' : 0, 'writes' : 0 }
+
+    def _add_usage(self, ru) :
+        self.usage['cpu'] += ru.ru_utime + ru.ru_stime
+        self.usage['maxrss'] = max(self.usage['maxrss'], ru.ru_maxrss)
+        self.usage['reads'] += ru.ru_inblock
+        self.usage['writes'] += ru.ru_oublock
+
+    # write the chunks of data to the program's stdin, in a thread so that
+    # the program can write its output as it reads its input (if the program
+    # exits without reading everything the rest is dropped)
+    def _feed(self, p, stdin) :
+        try :
+            for data in stdin :
+                p.stdin.write(data)
+
+        except IOError, ioe :
+            if ioe.errno != errno.EPIPE :
+                self.log.warn("error writing to %s (%s)" % (self.name, str(ioe)))
+
+        finally :
+            try :
+                p.stdin.close()
+
+            except IOError :
+                pass
+
+    def _read(self, f, callback) :
+        fd = f.fileno()
+
+        while True :
+            try :
+                data = os.read(fd, 65536)
+
+            except OSError, ose :
+                if ose.errno == errno.EINTR :
+                    continue
+
+                raise
+
+            if not data :
+                break
+
+            callback(data)
+
+        f.close()
+
+    # the same as p.communicate(), but the program is waited for with wait4() 
+    # so its resource usage (including anything it ran and waited for) is 
+    # known, getrusage(RUSAGE_CHILDREN) would include every program run by 
+    # any thread
+    #
+    # with on_output, each line of stdout is passed to it as soon as it has 
+    # been read and what is returned is stderr
+    def _communicate(self, p, stdin=None, on_output=None) :
+        chunks = []
+        threads = []
+
+        if stdin is not None :
+            threads.append(threading.Thread(target=self._feed, args=(p, stdin)))
+
+        if on_output :
+            threads.append(threading.Thread(target=self._read, args=(p.stderr, chunks.append)))
+
+        for t in threads :
+            t.setDaemon(True)
+            t.start()
+
+        if on_output :
+            partial = [ '' ]
+
+            def lines(data) :
+                data = partial[0] + data
+                end = data.rfind('\n') + 1
+                partial[0] = data[end:]
+
+                for line in data[:end].splitlines() :
+                    on_output(line)
+
+            self._read(p.stdout, lines)
+
+            if partial[0] :
+                on_output(partial[0])
+
+        else :
+            self._read(p.stdout, chunks.append)
+
+        for t in threads :
+            t.join()
+
+        while True :
+            try :
+                pid, status, ru = os.wait4(p.pid, 0)
+                break
+
+            except OSError, ose :
+                if ose.errno != errno.EINTR :
+                    raise
+
+        # so the Popen object does not try to wait for it
+        p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+
+        self._add_usage(ru)
+
+        return ''.join(chunks)
+
+    # kill the program (and anything it started) if it is running in this process
+    def kill(self) :
+        p = self.process
+
+        if not p :
+            return
+
+        try :
+            os.killpg(p.pid, signal.SIGKILL)
+
+        except OSError, ose :
+            if ose.errno != errno.ESRCH :
+                raise
+
+    def _timeout(self) :
+        self.log.warn("%s did not finish within %d seconds, killing it" % (self.name, self.timeout))
+        self.timed_out = True
+        self.kill()
+
+    # stdin is an iterable of strings for the program to read, on_output see
+    # _communicate()
+    def _execute(self, parameters, expected_outfiles, stdin=None, on_output=None) :
         returncode = 0
         output = ""
+        timer = None
+
+        self.timed_out = False
 
         self.log.debug(' '.join([self.binary_location] + parameters))
 
+        _running_lock.acquire()
+
         try :
-            output = subprocess.check_output(
+            p = subprocess.Popen(
                                 [self.binary_location] + parameters, 
-                                stderr=subprocess.STDOUT,
-                                close_fds=True
+                                stdin=subprocess.PIPE if stdin is not None else None,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE if on_output else subprocess.STDOUT,
+                                close_fds=True,
+                                preexec_fn=os.setpgrp
                                 )
+            _running.add(p)
+            self.process = p
+
+        finally :
+            _running_lock.release()
+
+        if self.timeout :
+            timer = threading.Timer(self.timeout, self._timeout)
+            timer.setDaemon(True)
+            timer.start()
+
+        try :
+            output = self._communicate(p, stdin, on_output)
+            returncode = p.returncode
+
+        finally :
+            if timer :
+                timer.cancel()
 
-        except subprocess.CalledProcessError, cpe :
-            returncode = cpe.returncode
-            output = cpe.output
+            _running_lock.acquire()
+            _running.discard(p)
+            self.process = None
+            _running_lock.release()
 
         # some program misbehave, so be careful to check the expected output
         # and change returncode as necessary
         if returncode == 0 :
             missing = [o for o in expected_outfiles if not isfile(o)]
             if len(missing) != 0 :
-                returncode = 256
+                returncode = MISSING_OUTPUT
                 output = "the following files were missing : %s" % ' '.join(missing)
 
         return returncode, output
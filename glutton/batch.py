@@ -0,0 +1,304 @@
+import os
+import json
+import glob
+import shutil
+import hashlib
+import tempfile
+import threading
+import cPickle
+
+from os.path import join, basename, dirname, abspath, isfile, isdir
+
+from glutton.utils import get_log, tmpfile, tmpdir, rm_f, get_emit_jobs
+from glutton.queue import WorkQueue
+from glutton.job import JobError
+from glutton.costmodel import CostModel
+
+
+# build and align can write their jobs to a directory instead of running them
+# (--emit-jobs DIR), for clusters where the batch scheduler only accepts array
+# jobs:
+#
+#   glutton build --emit-jobs DIR ...
+#   glutton run-job DIR/1.jobs          one per bundle, e.g. DIR/$SLURM_ARRAY_TASK_ID.jobs
+#   glutton collect DIR
+#
+# jobs are grouped into bundles predicted to take about --chunk-time seconds
+# (longest first, as they are queued), run-job runs a bundle with a work queue
+# so it uses as many cores as it is given and writes the results next to it,
+# collect passes the results to the callbacks that build or align would have
+# called if they had run the jobs themselves
+#
+# bundles are self-contained, files that the jobs read but do not create
+# (e.g. the blast database) are copied into DIR
+#
+# align has two steps, so it emits jobs twice: first blastx, then (after the
+# blastx results have been collected) pagan
+
+BATCH_VERSION = 1
+MANIFEST_FNAME = 'manifest.json'
+SHARED_DIR = 'shared'
+JOBS_EXT = '.jobs'
+RESULTS_EXT = '.results'
+
+CHUNK_TIME = 3600
+UNPREDICTED_COST = 60  # seconds, for jobs the cost model does not know about
+
+class BatchError(Exception) :
+    pass
+
+# raised by join() once the jobs are written, so the command stops there
+class JobsEmitted(Exception) :
+    def __init__(self, directory, num_jobs, num_bundles) :
+        super(JobsEmitted, self).__init__("wrote %d jobs in %d bundles to %s" % (num_jobs, num_bundles, directory))
+
+        self.directory = directory
+        self.num_jobs = num_jobs
+        self.num_bundles = num_bundles
+
+def _dump(fname, data) :
+    tmp = tmpfile(directory=dirname(abspath(fname)))
+
+    with open(tmp, 'wb') as f :
+        cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+
+    os.chmod(tmp, 0644)
+    os.rename(tmp, fname)
+
+def _load(fname) :
+    try :
+        with open(fname, 'rb') as f :
+            data = cPickle.load(f)
+
+    except (IOError, EOFError, cPickle.UnpicklingError), e :
+        raise BatchError("could not read %s (%s)" % (fname, str(e)))
+
+    if data.get('version') != BATCH_VERSION :
+        raise BatchError("%s was written by a different version of glutton" % fname)
+
+    return data
+
+# bundles in directory that have not been collected
+def pending_bundles(directory) :
+    return glob.glob(join(directory, '*' + JOBS_EXT))
+
+def write_manifest(directory, command, arguments) :
+    with open(join(directory, MANIFEST_FNAME), 'w') as f :
+        f.write(json.dumps({ 'version' : BATCH_VERSION, 'command' : command, 'arguments' : arguments }, sort_keys=True, indent=4, separators=(',', ': ')))
+
+# what build and align queue their jobs on
+def work_queue(costmodel=None) :
+    emit = get_emit_jobs()
+
+    if emit :
+        return BatchQueue(*emit)
+
+    return WorkQueue(costmodel=costmodel)
+
+# looks enough like a WorkQueue for build and align
+class BatchQueue(object) :
+    def __init__(self, directory, chunk_time=CHUNK_TIME) :
+        self.directory = directory
+        self.chunk_time = chunk_time
+        self.log = get_log()
+
+        self.jobs = []
+        self.running = True
+
+        if isdir(self.directory) and pending_bundles(self.directory) :
+            raise BatchError("%s contains jobs that have not been collected (see collect command)" % self.directory)
+
+    def enqueue(self, job) :
+        self.jobs.append(job)
+
+    def stop(self) :
+        self.running = False
+
+    # if nothing was queued (e.g. everything was in the alignment cache)
+    # the command carries on as normal
+    def join(self) :
+        self.running = False
+
+        if not self.jobs :
+            return
+
+        self._prepare()
+
+        bundles = self._chunk()
+
+        self._write(bundles)
+
+        raise JobsEmitted(self.directory, len(self.jobs), len(bundles))
+
+    # jobs are written with everything they need to run, jobs that cannot
+    # be prepared are left out (they are run the next time jobs are emitted)
+    def _prepare(self) :
+        jobs = []
+
+        for job in self.jobs :
+            try :
+                job.prepare()
+
+            except JobError, je :
+                self.log.error("could not prepare %s (%s)" % (str(job), str(je)))
+                continue
+
+            jobs.append(job)
+
+        self.jobs = jobs
+
+    def _chunk(self) :
+        bundles = [[]]
+        total = 0.0
+
+        for job in self.jobs :
+            cost = job.predicted if job.predicted is not None else UNPREDICTED_COST
+
+            if bundles[-1] and (total + cost) > self.chunk_time :
+                bundles.append([])
+                total = 0.0
+
+            bundles[-1].append(job)
+            total += cost
+
+        return bundles
+
+    def _write(self, bundles) :
+        if not isdir(self.directory) :
+            os.makedirs(self.directory)
+
+        shared = {}
+
+        for i,bundle in enumerate(bundles) :
+            files = {}
+
+            for job in bundle :
+                for fname in job.shared_files() :
+                    if fname not in shared :
+                        shared[fname] = self._copy(fname)
+
+                    files[fname] = shared[fname]
+
+            _dump(join(self.directory, "%d%s" % (i + 1, JOBS_EXT)), { 'version' : BATCH_VERSION, 'shared' : files, 'jobs' : bundle })
+
+        self.log.info("copied %d shared files to %s" % (len(shared), self.directory))
+
+    # files from the same directory are kept together, so that a blast
+    # database can still be found from the name of its fasta file
+    def _copy(self, fname) :
+        d = join(SHARED_DIR, hashlib.sha1(dirname(abspath(fname))).hexdigest())
+
+        if not isdir(join(self.directory, d)) :
+            os.makedirs(join(self.directory, d))
+
+        shutil.copyfile(fname, join(self.directory, d, basename(fname)))
+
+        return join(d, basename(fname))
+
+def results_fname(bundle_fname) :
+    if not bundle_fname.endswith(JOBS_EXT) :
+        raise BatchError("%s is not a bundle of jobs (expected %s extension)" % (bundle_fname, JOBS_EXT))
+
+    return bundle_fname[:-len(JOBS_EXT)] + RESULTS_EXT
+
+# run the jobs in a bundle, for each one save the return code, the job
+# and the files it created
+def run_bundle(fname) :
+    log = get_log()
+    out = results_fname(fname)
+
+    if isfile(out) :
+        log.info("%s has already been run" % fname)
+        return
+
+    bundle = _load(fname)
+    mapping = dict([ (f, join(dirname(abspath(fname)), rel)) for f,rel in bundle['shared'].iteritems() ])
+
+    results = []
+    lock = threading.Lock()
+
+    def _callback(job) :
+        files = job.output_files()
+
+        # the real return code, so collect records why the job failed
+        # (e.g. MISSING_OUTPUT), not just that it did
+        ret = 0 if job.success() else (job.returncode or 1)
+
+        lock.acquire()
+        results.append((ret, job, files))
+        lock.release()
+
+    log.info("running %d jobs from %s" % (len(bundle['jobs']), fname))
+
+    costmodel = CostModel()
+    q = WorkQueue(costmodel=costmodel)
+
+    for job in bundle['jobs'] :
+        job.callback = _callback
+        job.localise(mapping)
+        q.enqueue(job)
+
+    q.join()
+
+    costmodel.save()
+
+    # jobs that were killed have no result, they are run again the
+    # next time the jobs are emitted
+    _dump(out, { 'version' : BATCH_VERSION, 'results' : results })
+
+    log.info("wrote %d results to %s" % (len(results), out))
+
+# the results of the bundles in directory that have been run, iterating
+# gives (return code, job) with the job's files back in a local directory,
+# so that Job.finish() can be called as if the job had just been run
+class BatchResults(object) :
+    def __init__(self, directory) :
+        self.directory = directory
+        self.log = get_log()
+
+        fname = join(self.directory, MANIFEST_FNAME)
+
+        if not isfile(fname) :
+            raise BatchError("%s does not contain jobs written with --emit-jobs" % self.directory)
+
+        manifest = json.loads(open(fname).read())
+
+        if manifest.get('version') != BATCH_VERSION :
+            raise BatchError("%s was written by a different version of glutton" % fname)
+
+        self.command = manifest['command']
+        self.arguments = manifest['arguments']
+
+        self.bundles = [ f for f in sorted(pending_bundles(self.directory)) if isfile(results_fname(f)) ]
+        self.not_run = len(pending_bundles(self.directory)) - len(self.bundles)
+
+        self.job_dir = tempfile.mkdtemp(prefix='glutton', dir=tmpdir())
+        self.results = []
+
+        # jobs' files have the same names (see glutton/scratch.py), so each
+        # job needs its own directory
+        for f in self.bundles :
+            for ret, job, files in _load(results_fname(f))['results'] :
+                job.restore_files(files, tempfile.mkdtemp(dir=self.job_dir))
+                self.results.append((ret, job))
+
+        self.log.info("read %d results from %d bundles in %s" % (len(self.results), len(self.bundles), self.directory))
+
+    def __len__(self) :
+        return len(self.results)
+
+    def __iter__(self) :
+        return iter(self.results)
+
+    # once the results have been collected, they are deleted (along with
+    # everything else if every bundle has been collected)
+    def cleanup(self) :
+        shutil.rmtree(self.job_dir, ignore_errors=True)
+
+        for f in self.bundles :
+            rm_f([ f, results_fname(f) ])
+
+        if not pending_bundles(self.directory) :
+            shutil.rmtree(join(self.directory, SHARED_DIR), ignore_errors=True)
+            rm_f(join(self.directory, MANIFEST_FNAME))
+
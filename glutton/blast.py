@@ -1,5 +1,5 @@
 from glutton.base import ExternalTool
-from glutton.utils import get_log
+from glutton.utils import get_log, fasta_records
 
 from collections import namedtuple, defaultdict
 from sys import exit
@@ -21,6 +21,8 @@ BlastResult = namedtuple('BlastResult', ["qseqid",
                                          "bitscore"])
 
 class Blast(ExternalTool) :
+    streams = True
+
     def __init__(self) :
         super(Blast, self).__init__()
 
@@ -64,31 +66,46 @@ class Blast(ExternalTool) :
 
         return BlastResult(*[ casts[i](v) for i,v in enumerate(s.split(",")) ])
 
-    def run(self, query, database, outfile) :
-        parameters = [
+    def _add_result(self, line) :
+        line = line.strip()
+
+        if line == "" :
+            return
+
+        try :
+            self._results.append(self.parse_result(line))
+
+        except (ValueError, TypeError) :
+            self.log.warn("bad line returned by %s (%s)" % (self.name, line))
+
+    def _parameters(self, query, database, outfile, threads) :
+        return [
             "-query", query,
             "-db", database,
             "-out", outfile,
             "-max_target_seqs", "1",
-            "-outfmt", "10"
+            "-outfmt", "10",
+            "-num_threads", str(threads)
             ]
 
-        returncode, output = self._execute(parameters, [])
+    def run(self, query, database, outfile, threads=1) :
+        returncode, output = self._execute(self._parameters(query, database, outfile, threads), [])
 
         with open(outfile) as f :
             for line in f :
-                line = line.strip()
+                self._add_result(line)
 
-                if line == "" :
-                    continue
-
-                try :
-                    self._results.append(self.parse_result(line))
+        return returncode
 
-                except ValueError :
-                    self.log.warn("bad line returned by %s (%s)" % (self.name, line))
-                    continue
+    # queries are written to blast's stdin and results are parsed as blast
+    # writes them to stdout, nothing is written to the filesystem
+    def run_stream(self, queries, database, threads=1) :
+        returncode, output = self._execute(self._parameters("-", database, "-", threads), [], 
+                                           stdin=fasta_records(queries), 
+                                           on_output=self._add_result)
 
+        if returncode != 0 :
+            self.log.debug("%s returncode=%d\n%s" % (self.name, returncode, output))
 
         return returncode
 
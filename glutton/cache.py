@@ -0,0 +1,213 @@
+import os
+import json
+import hashlib
+import threading
+
+from glutton.archive import ALIGNMENT_EXT, TREE_EXT
+from glutton.genefamily import rename_alignment, rename_tree
+from glutton.utils import get_log, tmpfile, rm_f
+
+
+# an alignment cache shared between reference builds, most gene families are
+# identical between ensembl releases (and between related species) so there is
+# no need to run prank on them again
+#
+# entries are keyed by a hash of the prank version and the family's sequences,
+# gene ids are different in every build, so they are replaced with canonical
+# ids (based on sorted sequence order) before anything is written to the cache
+# and swapped back when an entry is used
+
+CACHE_VERSION = 1
+CANONICAL_ID = 'seq%d'
+STATS_FNAME = 'stats.json'
+
+class AlignmentCacheError(Exception) :
+    pass
+
+class AlignmentCache(object) :
+    def __init__(self, directory, max_size, program_version) :
+        self.directory = directory
+        self.max_size = max_size            # bytes
+        self.program_version = program_version
+
+        self.log = get_log()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.isdir(self.directory) :
+            try :
+                os.makedirs(self.directory)
+
+            except OSError, ose :
+                raise AlignmentCacheError(str(ose))
+
+        self.size = sum([ size for path,size,mtime in self._entries() ])
+
+        self.log.info("alignment cache %s contains %.1f MB (limit %.1f MB)" % \
+                (self.directory, self.size / 1e6, self.max_size / 1e6))
+
+    # (path, size, mtime) for every file in the cache
+    def _entries(self) :
+        for dirpath,dirnames,filenames in os.walk(self.directory) :
+            for f in filenames :
+                if not f.endswith((ALIGNMENT_EXT, TREE_EXT)) :
+                    continue
+
+                path = os.path.join(dirpath, f)
+
+                try :
+                    st = os.stat(path)
+
+                except OSError :
+                    continue
+
+                yield path, st.st_size, st.st_mtime
+
+    # (path without extension, size, mtime, files) for every entry, an entry's
+    # alignment and tree are evicted together, it was last used when either was
+    def _grouped_entries(self) :
+        groups = {}
+
+        for path,size,mtime in self._entries() :
+            stem = os.path.splitext(path)[0]
+            total,latest,files = groups.get(stem, (0, 0, []))
+            groups[stem] = (total + size, max(latest, mtime), files + [path])
+
+        return [ (stem, size, mtime, files) for stem,(size,mtime,files) in groups.iteritems() ]
+
+    # genes sorted by sequence, identical sequences are interchangeable
+    # so it does not matter how ties are broken
+    def _canonical(self, genefamily) :
+        genes = sorted(genefamily, key=lambda g : (g.sequence, g.id))
+
+        h = hashlib.sha1()
+        h.update("glutton-cache %d\n%s\n" % (CACHE_VERSION, self.program_version))
+
+        for g in genes :
+            h.update(g.sequence)
+            h.update('\n')
+
+        to_canonical = dict([ (g.id, CANONICAL_ID % i) for i,g in enumerate(genes) ])
+        from_canonical = dict([ (v,k) for k,v in to_canonical.iteritems() ])
+
+        return h.hexdigest(), to_canonical, from_canonical
+
+    def _path(self, key) :
+        return os.path.join(self.directory, key[:2], key)
+
+    # returns (alignment, tree) with the ids of the genes in genefamily, or None
+    def get(self, genefamily) :
+        key, to_canonical, from_canonical = self._canonical(genefamily)
+        path = self._path(key)
+
+        try :
+            alignment = open(path + ALIGNMENT_EXT).read()
+            tree = open(path + TREE_EXT).read()
+
+            # mtime is used for lru eviction
+            os.utime(path + ALIGNMENT_EXT, None)
+            os.utime(path + TREE_EXT, None)
+
+        except (IOError, OSError) :
+            self.lock.acquire()
+            self.misses += 1
+            self.lock.release()
+
+            return None
+
+        self.lock.acquire()
+        self.hits += 1
+        self.lock.release()
+
+        return rename_alignment(alignment, from_canonical), rename_tree(tree, from_canonical)
+
+    def put(self, genefamily, alignment, tree) :
+        key, to_canonical, from_canonical = self._canonical(genefamily)
+        path = self._path(key)
+
+        # an alignment without a tree can be left by an earlier put that was
+        # interrupted, so it is written again
+        if os.path.exists(path + ALIGNMENT_EXT) and os.path.exists(path + TREE_EXT) :
+            return
+
+        if not os.path.isdir(os.path.dirname(path)) :
+            try :
+                os.makedirs(os.path.dirname(path))
+
+            except OSError :
+                # another process got there first
+                if not os.path.isdir(os.path.dirname(path)) :
+                    raise
+
+        alignment = rename_alignment(alignment, to_canonical)
+        tree = rename_tree(tree, to_canonical)
+
+        # the alignment is renamed into place first, an entry only exists
+        # once the tree file does
+        for data,ext in ((alignment, ALIGNMENT_EXT), (tree, TREE_EXT)) :
+            tmp = tmpfile(data, directory=os.path.dirname(path))
+            os.rename(tmp, path + ext)
+
+        self.lock.acquire()
+
+        try :
+            self.size += (len(alignment) + len(tree))
+
+            if self.size > self.max_size :
+                self._evict()
+
+        finally :
+            self.lock.release()
+
+    # remove least recently used entries until we are 10% under the limit,
+    # so that this does not happen on every put when the cache is full
+    def _evict(self) :
+        entries = sorted(self._grouped_entries(), key=lambda x : x[2])
+        target = self.max_size * 0.9
+
+        self.size = sum([ size for stem,size,mtime,files in entries ])
+
+        for stem,size,mtime,files in entries :
+            if self.size <= target :
+                break
+
+            # the tree first, so the entry is gone before its alignment is
+            rm_f(sorted(files, key=lambda f : not f.endswith(TREE_EXT)))
+            self.size -= size
+
+            if (stem + TREE_EXT) in files :
+                self.evictions += 1
+
+        self.log.info("evicted %d alignments from cache, %.1f MB remaining" % (self.evictions, self.size / 1e6))
+
+    def hit_rate(self) :
+        total = self.hits + self.misses
+        return (self.hits / float(total)) if total else 0.0
+
+    # hit/miss counters are kept across builds
+    def flush(self) :
+        fname = os.path.join(self.directory, STATS_FNAME)
+
+        self.lock.acquire()
+
+        try :
+            stats = json.loads(open(fname).read())
+
+        except (IOError, ValueError) :
+            stats = {}
+
+        for k,v in (('hits', self.hits), ('misses', self.misses), ('evictions', self.evictions)) :
+            stats[k] = stats.get(k, 0) + v
+
+        tmp = tmpfile(json.dumps(stats), directory=self.directory)
+        os.rename(tmp, fname)
+
+        self.hits = self.misses = self.evictions = 0
+
+        self.lock.release()
+
+        return stats
+
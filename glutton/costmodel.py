@@ -0,0 +1,169 @@
+import os
+import json
+import math
+import heapq
+import threading
+
+from glutton.utils import get_log
+
+
+# predicts how long a job will take from the number of sequences and their
+# total length, the model is fitted per job type from previous runs:
+#
+#   log(time) = a + b * log(num sequences) + c * log(total length)
+#
+# with a small ridge penalty towards a prior, so it still gives a sensible
+# ordering before there is much data (or when all the data looks the same)
+
+COSTMODEL_VERSION = 2       # 2: PaganJob's reference length is without gaps
+MAX_OBSERVATIONS = 10000    # per job type, oldest are dropped
+RIDGE = 1.0
+
+# time proportional to (number of sequences * total length)
+PRIOR = [ math.log(1e-6), 1.0, 1.0 ]
+
+def default_costmodel_fname() :
+    return os.path.join(os.path.expanduser('~'), '.glutton', 'costmodel.json')
+
+def _solve(A, b) :
+    # gaussian elimination with partial pivoting, A is small and (because
+    # of the ridge penalty) positive definite
+    n = len(b)
+    M = [ A[i][:] + [b[i]] for i in range(n) ]
+
+    for col in range(n) :
+        pivot = max(range(col, n), key=lambda r : abs(M[r][col]))
+        M[col], M[pivot] = M[pivot], M[col]
+
+        for r in range(col + 1, n) :
+            f = M[r][col] / M[col][col]
+
+            for c in range(col, n + 1) :
+                M[r][c] -= f * M[col][c]
+
+    x = [0.0] * n
+
+    for r in range(n - 1, -1, -1) :
+        x[r] = (M[r][n] - sum([ M[r][c] * x[c] for c in range(r + 1, n) ])) / M[r][r]
+
+    return x
+
+def _row(features) :
+    num_sequences, total_length = features
+    return [ 1.0, math.log(max(num_sequences, 1)), math.log(max(total_length, 1)) ]
+
+class CostModel(object) :
+    def __init__(self, fname=None) :
+        self.fname = fname or default_costmodel_fname()
+        self.log = get_log()
+        self.lock = threading.Lock()
+
+        self.observations = {}      # job type -> [ (num sequences, total length, seconds), ... ]
+        self.coefficients = {}      # job type -> [a, b, c]
+        self.added = 0
+
+        self._load()
+
+    def _load(self) :
+        try :
+            data = json.loads(open(self.fname).read())
+
+        except IOError :
+            return
+
+        except ValueError :
+            self.log.warn("could not read cost model from %s, starting again" % self.fname)
+            return
+
+        if data.get('version') != COSTMODEL_VERSION :
+            return
+
+        self.observations = data['observations']
+
+        for jobtype in self.observations :
+            self._fit(jobtype)
+
+        self.log.info("read cost model from %s (%s)" % \
+            (self.fname, ', '.join([ "%s: %d jobs" % (k, len(v)) for k,v in sorted(self.observations.items()) ])))
+
+    def save(self) :
+        if not self.added :
+            return
+
+        self.lock.acquire()
+
+        try :
+            d = os.path.dirname(self.fname)
+
+            if d and not os.path.isdir(d) :
+                os.makedirs(d)
+
+            tmp = self.fname + '.tmp%d' % os.getpid()
+
+            with open(tmp, 'w') as f :
+                f.write(json.dumps({ 'version' : COSTMODEL_VERSION, 'observations' : self.observations }))
+
+            os.rename(tmp, self.fname)
+            self.added = 0
+
+        except (IOError, OSError), e :
+            self.log.warn("could not save cost model to %s (%s)" % (self.fname, str(e)))
+
+        finally :
+            self.lock.release()
+
+    def _fit(self, jobtype) :
+        k = len(PRIOR)
+
+        A = [ [ (RIDGE if i == j else 0.0) for j in range(k) ] for i in range(k) ]
+        b = [ RIDGE * PRIOR[i] for i in range(k) ]
+
+        for num_sequences, total_length, seconds in self.observations.get(jobtype, []) :
+            x = _row((num_sequences, total_length))
+            y = math.log(max(seconds, 1e-3))
+
+            for i in range(k) :
+                b[i] += x[i] * y
+
+                for j in range(k) :
+                    A[i][j] += x[i] * x[j]
+
+        self.coefficients[jobtype] = _solve(A, b)
+
+    def add(self, jobtype, features, seconds) :
+        self.lock.acquire()
+
+        obs = self.observations.setdefault(jobtype, [])
+        obs.append(list(features) + [seconds])
+
+        if len(obs) > MAX_OBSERVATIONS :
+            del obs[:len(obs) - MAX_OBSERVATIONS]
+
+        self.added += 1
+
+        self.lock.release()
+
+    # refit with everything added since the model was read
+    def update(self) :
+        self.lock.acquire()
+
+        for jobtype in self.observations :
+            self._fit(jobtype)
+
+        self.lock.release()
+
+    # predicted time in seconds
+    def predict(self, jobtype, features) :
+        coeff = self.coefficients.get(jobtype, PRIOR)
+        return math.exp(sum([ c * x for c,x in zip(coeff, _row(features)) ]))
+
+# time taken to run jobs in the given order on a number of workers,
+# each job starts on the first worker to become free
+def makespan(costs, workers) :
+    finish = [0.0] * max(workers, 1)
+
+    for cost in costs :
+        heapq.heappush(finish, heapq.heappop(finish) + cost)
+
+    return max(finish)
+
@@ -1,4 +1,5 @@
-from zipfile import ZipFile, ZIP_DEFLATED
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+from array import array
 from sys import exit, stderr
 from os.path import exists
 import tempfile
@@ -7,14 +8,26 @@ import logging
 import threading
 import time
 import json
+import shutil
+import hashlib
+import collections
+
+from cStringIO import StringIO
 
 import glutton
 from glutton.ensembl_downloader import EnsemblDownloader, EnsemblDownloadError, get_ensembl_download_method
-from glutton.genefamily import ensembl_to_glutton, glutton_to_json, json_to_glutton, Gene, GeneFamily, read_alignment_as_genefamily
-from glutton.utils import tmpfile, get_log, md5
-from glutton.queue import WorkQueue
+from glutton.genefamily import ensembl_to_glutton, glutton_to_json, json_to_glutton, Gene, GeneFamily, read_alignment_as_genefamily, \
+                              genefamily_to_record, record_to_genefamily, bad_genefamily, genefamily_signature, \
+                              rename_alignment, rename_tree
+from glutton.archive import GluttonArchive, GluttonArchiveWriter, GluttonArchiveError, write_index, recover_journal, compact_archive, natural_key, \
+                           GLT_FORMAT_VERSION
+from glutton.cache import AlignmentCache, AlignmentCacheError
+from glutton.utils import tmpfile, get_log, md5, rm_f, get_binary_path
+from glutton.batch import work_queue
+from glutton.costmodel import CostModel
 from glutton.job import PrankJob
 from glutton.prank import Prank
+from glutton.blast import Blast
 
 
 class GluttonImportantFileNotFoundError(Exception) :
@@ -29,6 +42,13 @@ class GluttonDBError(Exception) :
 class GluttonDBBuildError(Exception) :
     pass
 
+# the proteome could not be kept next to the archive, fasta is the extracted
+# sequences (if they were) in a temporary file
+class GluttonDBProteomeError(Exception) :
+    def __init__(self, msg, fasta=None) :
+        super(GluttonDBProteomeError, self).__init__(msg)
+        self.fasta = fasta
+
 metadata_keys = [
     'glutton-version',
     'program-name',
@@ -43,15 +63,159 @@ metadata_keys = [
 
 MANIFEST_FNAME = 'manifest.json'
 
+# the translated reference and its blast database live next to the archive
+PROTEOME_SUFFIX = '.proteome'
+PROTEOME_FASTA = 'proteome.fasta'
+PROTEOME_CHECKSUM = 'checksum'
+
+# shards are built from copies of the same download, these must be the same in every shard
+shard_metadata_keys = [
+    'species-name',
+    'species-release',
+    'database-name',
+    'nucleotide',
+    'program-name',
+    'program-version',
+    'data-format',
+    'data-file'
+  ]
+
+# 'json' is the original data file, a single json object containing every gene family
+# 'indexed' is a stored (uncompressed) member of separately compressed gene families
+# with a small index saying where each one starts
+DATA_FORMAT = 'indexed'
+
+# decoded gene families kept by GluttonDBFamilies, the least recently used
+# are dropped so memory does not grow with the size of the reference
+FAMILY_CACHE_SIZE = 1024
+
+class GluttonDBFamilies(object) :
+    # read-only, dict-like view of the gene families in an indexed data file
+    # only the index is kept in memory, a gene family is decoded when it is
+    # accessed and the most recently used are cached
+    def __init__(self, archive, data_fname, index) :
+        self.archive = archive
+        self.data_fname = data_fname
+
+        self.famids = index['families']
+        self.position = dict([ (famid, i) for i,famid in enumerate(self.famids) ])
+        self.offsets = array('L', index['offsets'])     # len(famids) + 1, last is the end of the last record
+        self.counts = array('L', index['counts'])       # number of genes in each family
+        self.lengths = array('L', index['lengths']) if 'lengths' in index else None   # total sequence length of each family
+
+        # gene ids are only needed to map blast hits back to families, so keep 
+        # them as a single string until they are used
+        self._genes = index['genes']
+        self.starts = None                              # index into self.genes for each family
+
+        self.cache = collections.OrderedDict()
+        self.cache_size = FAMILY_CACHE_SIZE
+        self.lock = threading.Lock()            # workers read families in parallel
+
+    @property
+    def genes(self) :
+        if self.starts is None :
+            starts = array('L', [0])
+
+            for count in self.counts :
+                starts.append(starts[-1] + count)
+
+            self._genes = self._genes.split()
+            self.starts = starts
+
+        return self._genes
+
+    def __len__(self) :
+        return len(self.famids)
+
+    def __iter__(self) :
+        return iter(self.famids)
+
+    def __contains__(self, famid) :
+        return famid in self.position
+
+    def has_key(self, famid) :
+        return famid in self.position
+
+    def keys(self) :
+        return list(self.famids)
+
+    def __getitem__(self, famid) :
+        self.lock.acquire()
+
+        try :
+            gf = self.cache.pop(famid)
+            self.cache[famid] = gf
+            return gf
+
+        except KeyError :
+            pass
+
+        finally :
+            self.lock.release()
+
+        gf = self.decode(famid)
+
+        self.lock.acquire()
+
+        try :
+            self.cache[famid] = gf
+
+            while len(self.cache) > self.cache_size :
+                self.cache.popitem(last=False)
+
+        finally :
+            self.lock.release()
+
+        return gf
+
+    # for one-off access to every family, does not cache the result
+    def decode(self, famid) :
+        return record_to_genefamily(self.raw(famid), famid)
+
+    # compressed record, this is what gets written back to the archive
+    def raw(self, famid) :
+        i = self.position[famid]
+        return self.archive.read_range(self.data_fname, self.offsets[i], self.offsets[i+1] - self.offsets[i])
+
+    def family_size(self, famid) :
+        return self.counts[self.position[famid]]
+
+    def family_length(self, famid) :
+        if self.lengths is None :
+            return sum([ len(gene) for gene in self[famid] ])
+
+        return self.lengths[self.position[famid]]
+
+    def gene_ids(self, famid) :
+        genes = self.genes
+        i = self.position[famid]
+        return genes[self.starts[i] : self.starts[i+1]]
+
+    def num_genes(self) :
+        return sum(self.counts)
+
+    def lookup_table(self) :
+        tmp = {}
+
+        for famid in self.famids :
+            for geneid in self.gene_ids(famid) :
+                tmp[geneid] = famid
+
+        return tmp
+
 class GluttonDB(object) :
     def __init__(self, fname=None) :
         self.fname       = fname
         self.compression = ZIP_DEFLATED
         self.metadata    = None
         self.data        = None     # dict of famid -> GeneFamily obj (list of Genes)
-        self.seq2famid   = None     # dict of geneid -> famid
+        self._seq2famid  = None     # dict of geneid -> famid
         self.dirty       = False
         self.lock        = threading.Lock()
+        self.archive     = None     # read-only view of the archive for alignment lookups
+        self.writer      = None     # thread committing prank results to the archive
+        self.cache       = None     # prank results from previous builds
         self.complete_jobs = 0
         self.total_jobs = 0
 
@@ -95,10 +259,32 @@ class GluttonDB(object) :
     def checksum(self) :
         return md5(self.fname)
 
+    # (i, n) if this archive only contains alignments for the i-th of n shards
+    @property
+    def shard(self) :
+        return tuple(self.metadata['shard']) if 'shard' in self.metadata else None
+
+    # only needed when we have gene ids (e.g. from blast), so build it on demand
+    @property
+    def seq2famid(self) :
+        if self._seq2famid is None :
+            if isinstance(self.data, GluttonDBFamilies) :
+                self._seq2famid = self.data.lookup_table()
+            else :
+                self._seq2famid = self._create_lookup_table(self.data)
+
+        return self._seq2famid
+
     def stop(self) :
         if hasattr(self, "q") :
             self.q.stop()
 
+        # commit whatever alignments have finished
+        self._close_writer()
+
+        if self.cache :
+            self.cache.flush()
+
     def flush(self) :
         if self.dirty :
             self._write()
@@ -109,19 +295,26 @@ class GluttonDB(object) :
     def _read(self) :
         global MANIFEST_FNAME
 
-        z = ZipFile(self.fname, 'r', compression=self.compression)
+        # we might have been killed while writing prank results
+        recover_journal(self.fname)
+
+        try :
+            a = GluttonArchive(self.fname)
+
+        except GluttonArchiveError, gae :
+            raise GluttonDBFileError(str(gae))
     
         def _err(msg) :
-            z.close()
+            a.close()
             raise GluttonImportantFileNotFoundError(msg)
     
         # without the manifest all is lost
         # we need this to get the names of the other
         # XML files
-        if MANIFEST_FNAME not in z.namelist() :
+        if MANIFEST_FNAME not in a :
             _err('manifest not found in %s' % self.fname)
 
-        self.metadata = json.load(z.open(MANIFEST_FNAME))
+        self.metadata = json.loads(a.read(MANIFEST_FNAME))
         
         self.log.info("read manifest - created on %s using glutton version %.1f" % \
             (time.strftime('%d/%m/%y at %H:%M:%S', time.localtime(self.download_time)), \
@@ -130,15 +323,26 @@ class GluttonDB(object) :
         # the data file is the raw data grouped into gene families
         # when we do a local alignment we need to get the gene id
         # of the best hit and find out which gene family it belongs to 
-        if self.metadata['data-file'] not in z.namelist() :
+        if self.metadata['data-file'] not in a :
             _err('data file (%s) not found in %s' % (self.metadata['data-file'], self.fname))
 
-        self.data = json_to_glutton(json.load(z.open(self.metadata['data-file'])))
-        self.seq2famid = self._create_lookup_table(self.data)
+        self._seq2famid = None
 
-        self.log.info("read %d gene families (%d genes)" % (len(self.data), len(self.seq2famid)))
+        if self.metadata.get('data-format', 'json') == 'indexed' :
+            if self.metadata['data-index-file'] not in a :
+                _err('data index file (%s) not found in %s' % (self.metadata['data-index-file'], self.fname))
 
-        z.close()
+            # the families keep the archive open, this is safe even if the file 
+            # is appended to later because the data file never moves
+            self.data = GluttonDBFamilies(a, self.metadata['data-file'], json.loads(a.read(self.metadata['data-index-file'])))
+            num_genes = self.data.num_genes()
+
+        else :
+            self.data = json_to_glutton(json.loads(a.read(self.metadata['data-file'])))
+            num_genes = len(self.seq2famid)
+            a.close()
+
+        self.log.info("read %d gene families (%d genes)" % (len(self.data), num_genes))
 
     def _create_lookup_table(self, families) :
         tmp = {}
@@ -173,19 +377,125 @@ class GluttonDB(object) :
 
         assert self._valid_manifest(self.metadata)
 
-        z = ZipFile(self.fname, 'a', compression=self.compression)
+        self._close_archive()
+
+        self.metadata['format-version'] = GLT_FORMAT_VERSION
+
+        # databases using the old data file are converted to the indexed format
+        if self.metadata.get('data-format', 'json') != DATA_FORMAT :
+            self._set_data_format(self.species, self.release)
+
+        records, index = self._pack_families()
+
+        z = ZipFile(self.fname, 'a', compression=self.compression, allowZip64=True)
 
-        self._write_to_archive(self.metadata,               z, MANIFEST_FNAME)
-        self._write_to_archive(glutton_to_json(self.data),  z, self.metadata['data-file'])
+        self._write_to_archive(self.metadata,   z, MANIFEST_FNAME)
+        z.writestr(self.metadata['data-file'],  records, compress_type=ZIP_STORED)
+        self._write_to_archive(index,           z, self.metadata['data-index-file'])
 
         z.close()
 
+        # the index must be written last, it records where everything else is
+        write_index(self.fname)
+
         self.dirty = False
 
+    # returns the contents of the data file + its index
+    def _pack_families(self) :
+        records = []
+        index = { 'families' : [], 'offsets' : [0], 'counts' : [], 'lengths' : [], 'genes' : [] }
+        bad_family_count = 0
+
+        for famid in sorted(self.data) :
+            # families are never modified after download, so avoid decoding 
+            # them again if they came from an indexed data file
+            if isinstance(self.data, GluttonDBFamilies) :
+                rec = self.data.raw(famid)
+                geneids = self.data.gene_ids(famid)
+                length = self.data.family_length(famid)
+
+            else :
+                if bad_genefamily([ (gene.name, gene.seq) for gene in self.data[famid] ]) :
+                    bad_family_count += 1
+                    continue
+
+                rec = genefamily_to_record(self.data[famid])
+                geneids = [ gene.id for gene in self.data[famid] ]
+                length = sum([ len(gene) for gene in self.data[famid] ])
+
+            records.append(rec)
+            index['families'].append(famid)
+            index['offsets'].append(index['offsets'][-1] + len(rec))
+            index['counts'].append(len(geneids))
+            index['lengths'].append(length)
+            index['genes'] += geneids
+
+        if bad_family_count > 0 :
+            self.log.error("%d bad gene families" % bad_family_count)
+
+        index['genes'] = ' '.join(index['genes'])
+
+        return ''.join(records), index
+
+    # the archive is opened once and shared by all threads calling get_alignment, 
+    # it needs to be reopened if anything was written to the file since
+    def _get_archive(self) :
+        if not self.archive :
+            self.lock.acquire()
+
+            try :
+                if not self.archive :
+                    self.archive = GluttonArchive(self.fname)
+
+            except GluttonArchiveError, gae :
+                raise GluttonDBFileError(str(gae))
+
+            finally :
+                self.lock.release()
+
+        return self.archive
+
+    def _close_archive(self) :
+        if self.archive :
+            self.archive.close()
+            self.archive = None
+
     def _default_datafile(self, species, release) :
-        return "%s_%d_data.json" % (species, release)
+        return "%s_%d_data.bin" % (species, release)
+
+    def _default_indexfile(self, species, release) :
+        return "%s_%d_data_index.json" % (species, release)
+
+    def _set_data_format(self, species, release) :
+        self.metadata['data-format']        = DATA_FORMAT
+        self.metadata['data-file']          = self._default_datafile(species, release)
+        self.metadata['data-index-file']    = self._default_indexfile(species, release)
 
-    def build(self, fname, species, release=None, database_name='ensembl', nucleotide=False, download_only=False) :
+    def _family_size(self, famid) :
+        if isinstance(self.data, GluttonDBFamilies) :
+            return self.data.family_size(famid)
+
+        return len(self.data[famid])
+
+    def _family_length(self, famid) :
+        if isinstance(self.data, GluttonDBFamilies) :
+            return self.data.family_length(famid)
+
+        return sum([ len(gene) for gene in self.data[famid] ])
+
+    # for when every gene family is going to be looked at once, avoids
+    # keeping them all in memory
+    def _decode_genefamily(self, famid) :
+        if isinstance(self.data, GluttonDBFamilies) :
+            return self.data.decode(famid)
+
+        return self.data[famid]
+
+    # the gene families that need aligning
+    def _multigene_families(self) :
+        return set([ famid for famid in self.data if self._family_size(famid) > 1 ])
+
+    def build(self, fname, species, release=None, database_name='ensembl', nucleotide=False, download_only=False, cache_dir=None, cache_size=0, previous_fname=None, shard=None) :
         self.fname = fname
 
         # if the name is specified and the file exists, then that means the 
@@ -206,7 +516,7 @@ class GluttonDB(object) :
             # default name if it was not defined
             if not self.fname :
                 #self.fname = "%s_%d_%s_%s.glt" % (species, release, "nuc" if nucleotide else "pep", get_ensembl_download_method())
-                self.fname = "%s_%d.glt" % (species, release)
+                self.fname = "%s_%d.glt" % (species, release) if not shard else "%s_%d_shard%d_of_%d.glt" % ((species, release) + shard)
                 self.log.info("database filename not specified, using '%s'" % self.fname)
 
             # are we resuming or starting fresh?
@@ -217,6 +527,8 @@ class GluttonDB(object) :
         # either way, read contents into memory
         self._read()
 
+        if shard :
+            self._set_shard(shard)
 
         # not really necessary, but check that the species from cli and in the file
         # are the same + nucleotide
@@ -234,6 +546,7 @@ class GluttonDB(object) :
         # no work to do
         if self.is_complete() : 
             self.log.info("%s is already complete!" % self.fname)
+            self._prepare_proteome()
             return
 
         # don't do the analysis, just exit
@@ -241,45 +554,258 @@ class GluttonDB(object) :
             self.log.info("download complete")
             return
 
+        if cache_dir :
+            try :
+                self.cache = AlignmentCache(cache_dir, cache_size, Prank().version)
+
+            except AlignmentCacheError, ace :
+                raise GluttonDBBuildError("could not use alignment cache (%s)" % str(ace))
+
+        # copy alignments of unchanged families from the previous release
+        reused = self._reuse_alignments(previous_fname) if previous_fname else 0
+
         # build db
-        self._perform_alignments()
+        realigned = self._perform_alignments()
+
+        if previous_fname :
+            self.log.info("%d gene families reused from %s, %d realigned" % (reused, previous_fname, realigned))
         
         # write to disk
         self._write()
 
+        self._prepare_proteome()
+
         self.log.info("finished building %s/%s" % (self.species, self.release))
 
+    # families are matched on their gene names and sequences, if they are the same then
+    # the alignment and tree can be used after renaming the gene ids
+    def _reuse_alignments(self, previous_fname) :
+        previous = GluttonDB(previous_fname)
+
+        if previous.nucleotide != self.nucleotide :
+            raise GluttonDBBuildError("%s and %s do not contain the same sequence type" % (previous_fname, self.fname))
+
+        if previous.metadata['program-version'] != self.metadata['program-version'] :
+            self.log.warn("%s was aligned with %s %s (current version %s)" % \
+                (previous_fname, previous.metadata['program-name'], previous.metadata['program-version'], self.metadata['program-version']))
+
+        signatures = {}
+
+        for famid in previous._get_archive().aligned :
+            if famid in previous.data :
+                signatures[genefamily_signature(previous._decode_genefamily(famid))] = famid
+
+        self.log.info("read %d aligned gene families from %s" % (len(signatures), previous_fname))
+
+        unaligned = self._get_unaligned_families()
+
+        self._close_archive()
+        writer = GluttonArchiveWriter(self.fname)
+        reused = 0
+
+        for famid in unaligned :
+            gf = self._decode_genefamily(famid)
+            sig = genefamily_signature(gf)
+
+            if sig not in signatures :
+                continue
+
+            previous_famid = signatures[sig]
+            mapping = self._gene_id_mapping(previous._decode_genefamily(previous_famid), gf)
+
+            try :
+                alignment, tree = previous.get_raw_alignment(previous_famid)
+
+            except GluttonDBFileError, gdfe :
+                self.log.warn(str(gdfe))
+                continue
+
+            # ids only match if the gene families were not downloaded again
+            if mapping :
+                alignment = rename_alignment(alignment, mapping)
+                tree = rename_tree(tree, mapping)
+
+            writer.put([ (self._famid_to_alignment(famid),  alignment),
+                         (self._famid_to_tree(famid),       tree) ])
+
+            reused += 1
+
+        try :
+            writer.close()
+
+        except GluttonArchiveError, gae :
+            raise GluttonDBBuildError(str(gae))
+
+        previous._close_archive()
+
+        return reused
+
+    # old gene id -> new gene id, only including ids that change
+    # genes with the same name and sequence are interchangeable
+    def _gene_id_mapping(self, old, new) :
+        new_ids = {}
+
+        for gene in new :
+            new_ids.setdefault((gene.name, str(gene.sequence)), []).append(gene.id)
+
+        mapping = {}
+
+        for gene in old :
+            new_id = new_ids[(gene.name, str(gene.sequence))].pop()
+
+            if new_id != gene.id :
+                mapping[gene.id] = new_id
+
+        return mapping
+
     def _get_unaligned_families(self) :
         unaligned = []
+        aligned = self._get_archive().aligned
+        families = self._shard_families() if self.shard else self.data
 
-        z = ZipFile(self.fname, 'r', compression=self.compression)
-        aligned = set([ i.split('.')[0] for i in z.namelist() if i.endswith('.tree') ])
-        z.close()
-
-        for i in self.data :
-            if (i not in aligned) and (len(self.data[i]) > 1) :
+        for i in families :
+            if (i not in aligned) and (self._family_size(i) > 1) :
                 unaligned.append(i)
 
-        self.log.info("found %d unaligned gene families" % len(unaligned))
+        self.log.info("found %d unaligned gene families%s" % (len(unaligned), " (shard %d/%d)" % self.shard if self.shard else ""))
 
         return unaligned
 
+    def _set_shard(self, shard) :
+        if self.shard == shard :
+            return
+
+        if self.shard :
+            raise GluttonDBBuildError("%s contains shard %d/%d, not %d/%d" % ((self.fname,) + self.shard + shard))
+
+        if self._get_archive().aligned :
+            raise GluttonDBBuildError("%s already contains alignments, only an unaligned database can be sharded" % self.fname)
+
+        self.metadata['shard'] = list(shard)
+        self.dirty = True
+        self._write()
+
+    # every n-th multi-gene family in order of id, this only depends on the
+    # ids, so every shard will agree on which families belong to which shard
+    def _shard_families(self) :
+        i,n = self.shard
+        families = sorted(self._multigene_families(), key=natural_key)
+
+        return set(families[i-1::n])
+
+    # returns the number of gene families sent to prank (i.e. not in the cache)
     def _perform_alignments(self) :
         unaligned = self._get_unaligned_families()
+        costmodel = CostModel()
 
         if not hasattr(self, "q") :
-            self.q = WorkQueue()
+            self.q = work_queue(costmodel)
+
+        # longest job first, so the largest families are not left until the end
+        predicted = dict([ (i, costmodel.predict(PrankJob.__name__, (self._family_size(i), self._family_length(i)))) for i in unaligned ])
+        unaligned.sort(key=lambda i : predicted[i], reverse=True)
 
         self.total_jobs = len(unaligned)
         self.complete_jobs = -1
         self._progress()
 
+        self._close_archive()
+        self.writer = GluttonArchiveWriter(self.fname)
+        num_jobs = 0
+
         for i in unaligned :
-            self.q.enqueue(PrankJob(self.job_callback, self.data[i]))
+            if self._align_from_cache(self.data[i]) :
+                continue
+
+            job = PrankJob(self.job_callback, self.data[i])
+            job.predicted = predicted[i]
+
+            self.q.enqueue(job)
+            num_jobs += 1
 
         self.log.debug("waiting for job queue to drain...")
 
-        self.q.join()
+        try :
+            self.q.join()
+
+        finally :
+            # (cache hits are written even if the jobs were emitted)
+            self._close_writer()
+
+        if self.cache :
+            self.log.info("alignment cache: %d hits, %d misses (%.1f%%)" % \
+                (self.cache.hits, self.cache.misses, 100 * self.cache.hit_rate()))
+            self.cache.flush()
+
+        return num_jobs
+
+    # finish jobs written by build --emit-jobs, as if they had just been run
+    def collect(self, results, cache_dir=None, cache_size=0) :
+        if cache_dir :
+            try :
+                self.cache = AlignmentCache(cache_dir, cache_size, Prank().version)
+
+            except AlignmentCacheError, ace :
+                raise GluttonDBBuildError("could not use alignment cache (%s)" % str(ace))
+
+        self.total_jobs = len(results)
+        self.complete_jobs = -1
+        self._progress()
+
+        self._close_archive()
+        self.writer = GluttonArchiveWriter(self.fname)
+
+        try :
+            for ret,job in results :
+                job.callback = self.job_callback
+                job.finish(ret)
+
+        finally :
+            self._close_writer()
+
+        if self.cache :
+            self.cache.flush()
+
+        self._write()
+
+        if self.is_complete() :
+            self._prepare_proteome()
+            self.log.info("finished building %s/%s" % (self.species, self.release))
+
+    # cache hits go straight to the archive writer, as if prank had been run
+    def _align_from_cache(self, genefamily) :
+        if not self.cache :
+            return False
+
+        result = self.cache.get(genefamily)
+
+        if not result :
+            return False
+
+        alignment, tree = result
+
+        self.writer.put([ (self._famid_to_alignment(genefamily.id),  alignment),
+                          (self._famid_to_tree(genefamily.id),       tree) ])
+
+        self.lock.acquire()
+        self._progress()
+        self.lock.release()
+
+        return True
+
+    def _close_writer(self) :
+        if self.writer :
+            self.log.debug("waiting for archive writer...")
+
+            try :
+                self.writer.close()
+
+            except GluttonArchiveError, gae :
+                raise GluttonDBBuildError(str(gae))
+
+            finally :
+                self.log.debug("%d alignments written in %d commits" % (self.writer.committed_members / 2, self.writer.commits))
+                self.writer = None
 
     def _initialise_db(self, species, release, database_name, nucleotide) :
         e = EnsemblDownloader()
@@ -320,7 +846,7 @@ class GluttonDB(object) :
         self.metadata['download-method']    = get_ensembl_download_method()
 
         # other xml files
-        self.metadata['data-file']          = self._default_datafile(species, release)
+        self._set_data_format(species, release)
         
         self.dirty = True
         self._write()
@@ -339,38 +865,151 @@ class GluttonDB(object) :
         self.log.debug("alignment file = %s" % job.alignment)
         self.log.debug("tree file = %s" % job.tree)
 
-        # get a lock on the db
+        # the lock only protects the progress counter, the writer
+        # thread is responsible for getting results into the archive
         self.lock.acquire()
         self.dirty = True
-
         self._progress()
+        self.lock.release()
 
         if job.success() :
-            # write alignment file
-            # write tree file
-            z = ZipFile(self.fname, 'a', compression=self.compression)
-            z.write(job.alignment, arcname = self._famid_to_alignment(job.input.id))
-            z.write(job.tree,      arcname = self._famid_to_tree(job.input.id))
-            z.close()
-        else :
-            if self.q.running :
-                self.log.debug("Could not align gene family (%s)" % job.input.id)
+            # the job's files are deleted once we return, so read them now
+            # (compression happens in this thread too, outside of any lock)
+            alignment = open(job.alignment).read()
+            tree = open(job.tree).read()
 
-        # release lock
-        self.lock.release()
+            self.writer.put([ (self._famid_to_alignment(job.input.id),  alignment),
+                              (self._famid_to_tree(job.input.id),       tree) ])
+
+            if self.cache :
+                try :
+                    self.cache.put(job.input, alignment, tree)
+
+                except (IOError, OSError), e :
+                    self.log.warn("could not add %s to alignment cache (%s)" % (job.input.id, str(e)))
+        else :
+            if (not hasattr(self, "q")) or self.q.running :
+                self.log.debug("Could not align gene family (%s, %s)" % (job.input.id, job.reason))
 
     # this is only used by the aligner to give localsearch a file containing 
     # protein sequences
-    def extract_all(self) :
-        fname = tmpfile()
+    def extract_all(self, fname=None) :
+        fname = fname or tmpfile()
 
         with open(fname, 'w') as f :
             for gf in self.data :
-                for g in self.data[gf] :
+                for g in self._decode_genefamily(gf) :
                     print >> f, g.format('protein' if self.nucleotide else 'fasta').rstrip()
 
         return fname
 
+    @property
+    def proteome_dir(self) :
+        return self.fname + PROTEOME_SUFFIX
+
+    # the proteome only depends on the sequences, not on the alignments
+    def _proteome_checksum(self) :
+        a = self._get_archive()
+        h = hashlib.md5()
+
+        h.update("nucleotide=%s\n" % self.nucleotide)
+        h.update(a.read(self.metadata['data-file']))
+
+        return h.hexdigest()
+
+    def _proteome_is_current(self, checksum) :
+        try :
+            return open(os.path.join(self.proteome_dir, PROTEOME_CHECKSUM)).read().strip() == checksum
+
+        except IOError :
+            return False
+
+    # returns the filename of the proteome + whether it has a prebuilt blast 
+    # database, if it could not be written next to the archive then the caller
+    # gets a temporary file that they need to delete
+    def get_proteome(self) :
+        fname = os.path.join(self.proteome_dir, PROTEOME_FASTA)
+        checksum = self._proteome_checksum()
+
+        if self._proteome_is_current(checksum) :
+            self.log.info("using prebuilt blast database in %s" % self.proteome_dir)
+            return fname, True
+
+        # needed for the temporary blast database too
+        if not get_binary_path('makeblastdb') :
+            raise GluttonDBError("makeblastdb not found, it is needed to create the blast database for %s (is BLAST+ in your PATH?)" % self.fname)
+
+        try :
+            self._build_proteome(checksum)
+            return fname, True
+
+        except GluttonDBProteomeError, gdpe :
+            self.log.warn("could not create %s (%s), using temporary blast database" % (self.proteome_dir, str(gdpe)))
+
+            # do not extract the sequences again
+            if gdpe.fasta :
+                return gdpe.fasta, False
+
+        return self.extract_all(), False
+
+    def _build_proteome(self, checksum) :
+        self.log.info("creating blast database in %s ..." % self.proteome_dir)
+
+        # build in a temporary directory, then rename so that nobody 
+        # sees a partially written database
+        try :
+            tmp = tempfile.mkdtemp(prefix=os.path.basename(self.proteome_dir) + '.', dir=os.path.dirname(os.path.abspath(self.fname)))
+
+        except OSError, ose :
+            raise GluttonDBProteomeError(str(ose))
+
+        fname = None
+
+        try :
+            fname = self.extract_all(os.path.join(tmp, PROTEOME_FASTA))
+            Blast.makedb(fname)
+
+            with open(os.path.join(tmp, PROTEOME_CHECKSUM), 'w') as f :
+                print >> f, checksum
+
+            if os.path.isdir(self.proteome_dir) :
+                shutil.rmtree(self.proteome_dir)
+
+            os.rename(tmp, self.proteome_dir)
+
+        except (OSError, IOError), e :
+            # the sequences can still be used for a temporary blast database
+            if fname :
+                tmp_fname = tmpfile()
+
+                try :
+                    shutil.move(fname, tmp_fname)
+                    fname = tmp_fname
+
+                except (OSError, IOError) :
+                    rm_f(tmp_fname)
+                    fname = None
+
+            raise GluttonDBProteomeError(str(e), fname)
+
+        finally :
+            if os.path.isdir(tmp) :
+                shutil.rmtree(tmp)
+
+    def _prepare_proteome(self) :
+        if self.shard :
+            return
+
+        # align will say why it cannot search the reference
+        if not get_binary_path('makeblastdb') :
+            self.log.warn("makeblastdb not found, not creating blast database for %s" % self.fname)
+            return
+
+        fname, prebuilt = self.get_proteome()
+
+        if not prebuilt :
+            rm_f(fname)
+
     def get_familyid_from_geneid(self, geneid) :
         return self.seq2famid[geneid]
 
@@ -403,47 +1042,65 @@ class GluttonDB(object) :
         if not self.data.has_key(famid) :
             raise GluttonDBError("genefamily with id '%s' not found" % famid)
 
-        def _bail_out(f, lock) :
-            f.close()
-            lock.release()
-
         # situation 1
-        if len(self.data[famid]) == 1 :
+        if self._family_size(famid) == 1 :
             return self.data[famid]
 
         # situation 2
+        alignment_data, tree_data = self.get_raw_alignment(famid)
+
+        alignment = read_alignment_as_genefamily(StringIO(alignment_data), famid)
+        alignment.set_tree(tree_data)
+
+        return alignment
+
+    # raises the same errors get_alignment() would, without reading the alignment
+    def check_alignment(self, famid) :
+        if not self.data.has_key(famid) :
+            raise GluttonDBError("genefamily with id '%s' not found" % famid)
+
+        if self._family_size(famid) == 1 :
+            return
+
+        a = self._get_archive()
+
+        for fname in (self._famid_to_alignment(famid), self._famid_to_tree(famid)) :
+            if fname not in a :
+                raise GluttonDBFileError("'%s' not found" % fname)
+
+    # returns the contents of the alignment and tree files, does not need
+    # the lock as reads from the archive do not share any state
+    def get_raw_alignment(self, famid) :
         alignment_fname = self._famid_to_alignment(famid)
         tree_fname = self._famid_to_tree(famid)
-        
-        self.lock.acquire()
 
-        z = ZipFile(self.fname, 'r')
-        listing = z.namelist()
+        a = self._get_archive()
 
         # check that both files exist
-        if alignment_fname not in listing :
-            _bail_out(z, self.lock)
+        if alignment_fname not in a :
             raise GluttonDBFileError("'%s' not found" % alignment_fname)
 
-        if tree_fname not in listing :
-            _bail_out(z, self.lock)
+        if tree_fname not in a :
             raise GluttonDBFileError("'%s' not found" % tree_fname)
 
-        # read contents
-        alignment = read_alignment_as_genefamily(z.open(alignment_fname), famid)
-        alignment.set_tree(z.read(tree_fname))
-
-        _bail_out(z, self.lock)
+        try :
+            return a.read(alignment_fname), a.read(tree_fname)
 
-        return alignment
+        except GluttonArchiveError, gae :
+            raise GluttonDBFileError(str(gae))
 
+    # the archive index records which gene families have been aligned (and the
+    # archive keeps it up to date as results are appended), so this does not
+    # need to read the archive's contents, 'glutton check' still looks at every
+    # gene family
     def is_complete(self) :
-        return self.sanity_check(suppress_errmsg=True)
+        if self.shard :
+            return self._shard_families() <= self._get_archive().aligned
+
+        return self._multigene_families() <= self._get_archive().aligned
 
     def sanity_check(self, suppress_errmsg=False, human_readable_summary=False, show_all=False) :
-        z = ZipFile(self.fname, 'r')
-        listing = z.namelist()
-        z.close()
+        a = self._get_archive()
 
         insane = False
 
@@ -458,9 +1115,12 @@ class GluttonDB(object) :
 
         bad_genefamilies = []
 
+        # a shard is only expected to contain some of the alignments
+        shard_families = self._shard_families() if self.shard else None
+
 
         for famid in self.data :
-            gf_size = len(self.data[famid])
+            gf_size = self._family_size(famid)
 
             summary['num_genes'] += gf_size
 
@@ -481,25 +1141,28 @@ class GluttonDB(object) :
 
             # .align + .tree expected
             else :
+                if (shard_families is not None) and (famid not in shard_families) :
+                    continue
+
                 alignment_fname = self._famid_to_alignment(famid)
                 tree_fname = self._famid_to_tree(famid)
 
-                if alignment_fname not in listing :
+                if alignment_fname not in a :
                     insane = True
                     summary['error_noalignment'] += 1
                     if not suppress_errmsg :
                         self.log.error("%s not found" % alignment_fname)
 
-                if tree_fname not in listing :
+                if tree_fname not in a :
                     insane = True
                     summary['error_notree'] += 1
                     if not suppress_errmsg :
                         self.log.error("%s not found" % tree_fname)
                 
-                if (alignment_fname not in listing) and (tree_fname not in listing) :
+                if (alignment_fname not in a) and (tree_fname not in a) :
                     summary['error_nofiles'] += 1
 
-                if (alignment_fname not in listing) or (tree_fname not in listing) :
+                if (alignment_fname not in a) or (tree_fname not in a) :
                     bad_genefamilies.append(famid)
 
         if insane :
@@ -517,6 +1180,10 @@ class GluttonDB(object) :
             print "Type:", "nucleotide" if self.nucleotide else "protein"
             print "Downloaded:", time.strftime('%d/%m/%y at %H:%M:%S', time.localtime(self.download_time))
             print "Checksum:", self.checksum
+
+            if self.shard :
+                print "Shard: %d/%d" % self.shard
+
             print ""
             print "Number of genes:", summary['num_genes']
             print "Number of gene families:", len(self.data)
@@ -536,6 +1203,138 @@ class GluttonDB(object) :
 
         return not insane
 
+    # rewrite the archive with a single copy of each file, alignments and trees
+    # are ordered by gene family, compression levels are 0 (stored), 1-9 (deflated)
+    # or None (unchanged)
+    def compact(self, dst=None, alignment_level=None, tree_level=None, data_level=None) :
+        dst = dst or self.fname
+        tmp = dst + '.compact'
+
+        indexed = self.metadata.get('data-format', 'json') == 'indexed'
+
+        def _level(name) :
+            if name.endswith('.align') :
+                return alignment_level
+
+            if name.endswith('.tree') :
+                return tree_level
+
+            # the indexed data file is read one record at a time, so it must be stored
+            if indexed and name == self.metadata['data-file'] :
+                return 0
+
+            return data_level
+
+        # the json data file is left behind when a database is converted to the indexed format
+        def _keep(name) :
+            return not (indexed and name.endswith('_data.json'))
+
+        self._close_archive()
+
+        try :
+            count = compact_archive(self.fname, tmp, _level, _keep)
+
+        except GluttonArchiveError, gae :
+            rm_f(tmp)
+            raise GluttonDBFileError(str(gae))
+
+        os.rename(tmp, dst)
+
+        self.log.info("wrote %d files to %s" % (count, dst))
+
+        return count
+
+    # combine shards built from the same download into a single database,
+    # the shards must have the same manifest and data files and there must
+    # be one of each
+    def merge(self, fname, shard_fnames) :
+        shards = [ GluttonDB(f) for f in shard_fnames ]
+
+        self._check_shards(shards)
+
+        tmp = fname + '.merge'
+        shutil.copyfile(shards[0].fname, tmp)
+
+        self.fname = tmp
+        self._read()
+
+        aligned = set(self._get_archive().aligned)
+        self._close_archive()
+
+        writer = GluttonArchiveWriter(self.fname)
+        count = 0
+
+        for s in shards[1:] :
+            for famid in sorted(s._get_archive().aligned - aligned, key=natural_key) :
+                alignment, tree = s.get_raw_alignment(famid)
+
+                writer.put([ (self._famid_to_alignment(famid),  alignment),
+                             (self._famid_to_tree(famid),       tree) ])
+
+                aligned.add(famid)
+                count += 1
+
+            s._close_archive()
+
+        try :
+            writer.close()
+
+        except GluttonArchiveError, gae :
+            rm_f(tmp)
+            raise GluttonDBFileError(str(gae))
+
+        self.log.info("copied %d alignments from %d shards" % (count, len(shards) - 1))
+
+        del self.metadata['shard']
+        self._write()
+
+        # writing the manifest again left stale copies behind
+        self.compact(dst=fname)
+        rm_f(tmp)
+
+        self.fname = fname
+        self._read()
+
+        if not self.is_complete() :
+            self.log.warn("%s is not complete!" % self.fname)
+            return
+
+        self._prepare_proteome()
+
+    def _check_shards(self, shards) :
+        global shard_metadata_keys
+
+        for s in shards :
+            if not s.shard :
+                raise GluttonDBError("%s is not a shard" % s.fname)
+
+        num_shards = shards[0].shard[1]
+        found = sorted([ s.shard[0] for s in shards ])
+
+        if (found != range(1, num_shards + 1)) or [ s for s in shards if s.shard[1] != num_shards ] :
+            raise GluttonDBError("expected shards 1-%d of %d, found %s" % (num_shards, num_shards, ', '.join([ "%d/%d" % s.shard for s in shards ])))
+
+        def _digest(db, name) :
+            return hashlib.sha1(db._get_archive().read(name)).hexdigest()
+
+        first = shards[0]
+        data_files = [ first.metadata['data-file'] ] + ([ first.metadata['data-index-file'] ] if 'data-index-file' in first.metadata else [])
+        checksums = dict([ (name, _digest(first, name)) for name in data_files ])
+
+        for s in shards[1:] :
+            for k in shard_metadata_keys :
+                if s.metadata.get(k) != first.metadata.get(k) :
+                    raise GluttonDBError("%s and %s have different manifests ('%s' is %s and %s)" % \
+                        (first.fname, s.fname, k, first.metadata.get(k), s.metadata.get(k)))
+
+            for name in data_files :
+                if _digest(s, name) != checksums[name] :
+                    raise GluttonDBError("%s and %s contain different data (%s)" % (first.fname, s.fname, name))
+
+        for s in shards :
+            if not s.is_complete() :
+                self.log.warn("shard %d/%d (%s) is not complete" % (s.shard + (s.fname,)))
+
     def ls(self) :
         z = ZipFile(self.fname, 'r')
         listing = z.namelist()
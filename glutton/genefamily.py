@@ -1,30 +1,41 @@
 import sys
+import re
+import json
+import zlib
+import hashlib
 
 from Bio import SeqIO
 from Bio.Seq import Seq
 from Bio.Alphabet import generic_dna
 from glutton.utils import get_log
+from glutton.sequence import PackedSequence
 
 # maybe this should extend Sequence from biopython?
 class Gene(object) :
-
-    id_counter = 0
+    __slots__ = ('name', 'id', '_sequence')
 
     def __init__(self, name, sequence=None, id=None) :
         self.name = name
         self.sequence = sequence
+        self.id = id
+
+    # sequences are stored packed, but everything else sees a string
+    @property
+    def sequence(self) :
+        return str(self._sequence) if self._sequence is not None else None
 
-        if id :
-            self.id = id
+    @sequence.setter
+    def sequence(self, s) :
+        if (s is None) or isinstance(s, PackedSequence) :
+            self._sequence = s
         else :
-            self.id = "gene%d" % Gene.id_counter
-            Gene.id_counter += 1
+            self._sequence = PackedSequence(s)
 
     def __getitem__(self, i) :
-        return self.sequence[i]
+        return self._sequence[i]
 
     def __getslice__(self, i, j) :
-        return self.sequence[i:j]
+        return self._sequence[i:j]
 
     @property
     def seq(self) :
@@ -72,9 +83,10 @@ class Gene(object) :
     def open_reading_frames(self, strand=False) :
         tmp = []
         newid = self.id + "_orf%d"
+        seq = self.sequence
 
         for i in range(3) :
-            tmp_seq = Gene(self.name, self.sequence[i:], newid % (i + 1))
+            tmp_seq = Gene(self.name, seq[i:], newid % (i + 1))
 
             # TODO make cli options
             if tmp_seq.max_length_orf() > 100 :
@@ -84,22 +96,21 @@ class Gene(object) :
             return tmp
 
         # ORFs on the other strand
-        self.reverse_complement()
+        seq = self.reverse_complemented().sequence
 
         for i in range(3) :
-            tmp_seq = Gene(self.name, self.sequence[i:], newid % (i + 4))
+            tmp_seq = Gene(self.name, seq[i:], newid % (i + 4))
             
             # TODO make cli options
             if tmp_seq.max_length_orf() > 100 :
                 tmp.append(tmp_seq)
 
-        self.reverse_complement()
-
         return tmp
 
     def max_length_orf(self) :
         stop_codons = ('TAA','TAG','TGA')
-        codons = [ self.sequence[i:i+3] for i in range(0, len(self.sequence), 3) ]
+        seq = self.sequence
+        codons = [ seq[i:i+3] for i in range(0, len(seq), 3) ]
         indices = [0]
         max_length = 0
 
@@ -118,37 +129,25 @@ class Gene(object) :
         return max_length * 3
 
     def reverse_complement(self) :
-        self.sequence = self.sequence[::-1]
+        self._sequence = self._sequence.reverse_complement()
 
-        d = {
-            'A':'T',
-            'T':'A',
-            'G':'C',
-            'C':'G',
-            'N':'N'
-        }
-
-        self.sequence = ''.join([ d[i] for i in self.sequence ])
+    # a copy on the other strand, genes can be shared between threads
+    def reverse_complemented(self) :
+        return Gene(self.name, self._sequence.reverse_complement(), self.id)
 
     def __len__(self) :
-        return len(self.sequence)
+        return len(self._sequence)
 
     def __str__(self) :
         return "%s %s" % (self.id, self.name)
 
 class GeneFamily(list) :
-
-    id_counter = 0
+    __slots__ = ('id', 'tree')
 
     def __init__(self, genes=[], id=None) :
         list.__init__(self, genes)
 
-        if id :
-            self.id = id
-        else :
-            self.id = "genefamily%d" % GeneFamily.id_counter
-            GeneFamily.id_counter += 1
-
+        self.id = id
         self.tree = None
 
     def set_tree(self, tree) :
@@ -177,11 +176,22 @@ def read_alignment_as_genefamily(f, name) :
 # these objects, this function converts what it returns
 #   i.e.: [(name, seq),(name, seq), ... ]
 # to gene and genefamily objects
+#
+# ids are assigned after sorting the gene families by their contents, so 
+# every download of the same release gets the same ids regardless of the 
+# order ensembl returned them in (shards built separately need this to merge)
 def ensembl_to_glutton(families) :
     tmp = {}
-    
-    for fam in families :
-        gf = GeneFamily([ Gene(g[0], g[1]) for g in fam ])
+    gene_count = 0
+
+    for i,fam in enumerate(sorted([ sorted([ (g[0], g[1]) for g in fam ]) for fam in families ])) :
+        genes = []
+
+        for genename,geneseq in fam :
+            genes.append(Gene(genename, geneseq, id="gene%d" % gene_count))
+            gene_count += 1
+
+        gf = GeneFamily(genes, id="genefamily%d" % i)
         tmp[gf.id] = gf
     
     return tmp
@@ -206,6 +216,46 @@ def glutton_to_json(families) :
 
     return tmp
 
+def bad_genefamily(genes) :
+    for genename,geneseq in genes :
+        if geneseq == 'Sequenceunavailable' :
+            return True
+
+    return False
+
+# the indexed data file stores each gene family as a separately compressed 
+# record so that a family can be decoded without reading the others
+#   i.e.: [(gene id, name, seq), (gene id, name, seq), ... ]
+def genefamily_to_record(family) :
+    return zlib.compress(json.dumps([ (gene.id, gene.name, gene.seq) for gene in family ]))
+
+def record_to_genefamily(record, famid) :
+    return GeneFamily([ Gene(genename, geneseq, id=geneid) for geneid,genename,geneseq in json.loads(zlib.decompress(record)) ], id=famid)
+
+# identifies a gene family by its contents rather than its id, which is
+# different every time a database is downloaded
+def genefamily_signature(family) :
+    h = hashlib.sha1()
+
+    for genename,geneseq in sorted([ (gene.name, str(gene.sequence)) for gene in family ]) :
+        h.update("%s\t%s\n" % (genename, geneseq))
+
+    return h.hexdigest()
+
+# anything that could be a sequence name in a fasta header or newick tree
+_name_regex = re.compile(r"[^\s>(),:;\[\]]+")
+
+def _rename(s, mapping) :
+    return _name_regex.sub(lambda m : mapping.get(m.group(0), m.group(0)), s)
+
+# replace gene ids in the contents of an alignment (fasta) file, only
+# headers can contain names
+def rename_alignment(alignment, mapping) :
+    return '\n'.join([ _rename(line, mapping) if line.startswith('>') else line for line in alignment.split('\n') ])
+
+def rename_tree(tree, mapping) :
+    return _rename(tree, mapping)
+
 def json_to_glutton(families) :
     tmp = {}
     bad_family_count = 0
@@ -215,14 +265,11 @@ def json_to_glutton(families) :
         #tmp[famid] = GeneFamily([ Gene(*families[famid][geneid], id=geneid) for geneid in families[famid] ], id=famid)
         
         fam = []
-        bad = False
+        bad = bad_genefamily(families[famid].values())
+
+        # if i find this, keep on adding then i can print out the whole family later
         for geneid in families[famid] :
             genename,geneseq = families[famid][geneid]
-
-            # if i find this, keep on adding then i can print out the whole family later
-            if geneseq == 'Sequenceunavailable' :
-                bad = True
-
             fam.append( Gene(genename, geneseq, id=geneid) )
         
         if not bad :
@@ -1,3 +1,4 @@
+import os
 import json
 import threading
 import collections
@@ -8,22 +9,39 @@ from sys import stderr, exit
 from os.path import isfile, join, abspath, basename, isabs
 
 from glutton.db import GluttonDB
-from glutton.utils import get_log, md5, check_dir, string_md5
+from glutton.utils import get_log, md5, check_dir, string_md5, tmpfile, rm_f
 from glutton.table import pretty_print_table
+from glutton.lease import LeaseManager, LEASE_TIME
+from glutton.journal import Journal
 
 
 PARAM_FILE  = 'parameters.json'
 CONTIG_FILE = 'contigs.json'
 BLAST_FILE  = 'blastx.json'
 PAGAN_FILE  = 'pagan.json'
+FAILURE_FILE = 'failures.json'
+LEASE_DIR   = 'leases'
+JOURNAL_DIR = 'journal'
+PROGRESS_LOCK = 'progress'
+JOURNAL_LEASE = 'journal-%s'
+
+# records in our journal before the progress files are rewritten
+COMPACT_RECORDS = 100000
 
 QUERY_ID = 'query'
 
+# gene families that failed before the reason was recorded
+UNKNOWN_REASON = 'unknown'
+
+# gene families that were aligned gene by gene, once all of the genes were,
+# the genes' results are recorded under their own ids
+SPLIT = 'SPLIT'
+
 
 def do_locking(fn) :
-    def thread_safe(*args) :
+    def thread_safe(*args, **kwargs) :
         args[0].lock.acquire()
-        ret = fn(*args)
+        ret = fn(*args, **kwargs)
         args[0].lock.release()
 
         return ret
@@ -39,16 +57,22 @@ class GluttonJSON(object) :
     def __init__(self) :
         self.log = get_log()
 
-    def load(self, fname) :
+    def load(self, fname, verbose=True) :
         if isfile(fname) :
-            self.log.info("found progress file %s ..." % fname)
+            if verbose :
+                self.log.info("found progress file %s ..." % fname)
+
             return json.loads(open(fname).read())
 
         return {}
 
-    def dump(self, fname, data) :
+    # other processes could be reading the file
+    def dump(self, fname, data, pretty=True) :
         if data :
-            open(fname, 'w').write(json.dumps(data, sort_keys=True, indent=4, separators=(',', ': ')))
+            tmp = tmpfile(json.dumps(data, sort_keys=True, indent=4, separators=(',', ': ')) if pretty else \
+                          json.dumps(data, separators=(',', ':')), directory=os.path.dirname(abspath(fname)))
+            os.chmod(tmp, 0644)
+            os.rename(tmp, fname)
 
 class GluttonParameters(GluttonJSON) :
     def __init__(self, project_dir, create=False) :
@@ -197,13 +221,20 @@ class GluttonParameters(GluttonJSON) :
             yield GluttonSample(id=k, contigs=self._abspath(v['contigs']), species=v['species'], bam=self._abspath(v['bam']), checksum=v['checksum'])
 
 class GluttonInformation(GluttonJSON) :
-    def __init__(self, alignments_dir, parameters, db, resume=True) :
+    def __init__(self, alignments_dir, parameters, db, resume=True, lease_time=LEASE_TIME) :
         self.directory = alignments_dir
         self.params = parameters
         self.db = db
 
         check_dir(self.directory)
 
+        # other processes can be working on the same project, see claim()
+        self.leases = LeaseManager(join(self.directory, LEASE_DIR), lease_time)
+
+        # progress is written to the journal as it happens, the progress files
+        # are a snapshot that is only rewritten occasionally, see flush()
+        self.journal = Journal(join(self.directory, JOURNAL_DIR), self.leases.owner)
+
         self.log = get_log()
         self.lock = threading.RLock() # a single function requires this be an RLock over a Lock
 
@@ -214,9 +245,13 @@ class GluttonInformation(GluttonJSON) :
         self.contig_query_map = {}          # file id -> contig id -> query id (file id is provided by the user, called a 'label')
         self.query_gene_map = {}            # query id -> (gene id, +/-) or None
         self.genefamily_filename_map = {}   # gene family id -> filename
+        self.genefamily_failure_map = {}    # gene family id -> why it failed (see glutton/job.py)
+        self.progress_mtime = None          # of the snapshot last read
 
         if resume :
             self.read_progress_files()
+        else :
+            self.discard_progress_files()
 
     @property
     def contig_filename(self) :
@@ -233,15 +268,39 @@ class GluttonInformation(GluttonJSON) :
         global PAGAN_FILE
         return join(self.directory, PAGAN_FILE)
 
+    @property
+    def failure_filename(self) :
+        global FAILURE_FILE
+        return join(self.directory, FAILURE_FILE)
+
+    # everything is in the journal already, this rewrites the progress files
+    # so the journals can be deleted
     def flush(self) :
         self.log.info("flushing data to disk...")
         self.write_progress_files()
         self.log.info("done")
 
+    # the progress files are for different samples or a different reference
+    @do_locking
+    def discard_progress_files(self) :
+        rm_f([ self.contig_filename, self.blast_filename, self.pagan_filename, self.failure_filename ])
+        self.journal.remove(self.journal.others())
+        self.leases.remove(self.leases.completed().keys())
+
     def read_progress_files(self) :
         self.contig_query_map           = self.load(self.contig_filename)
         self.query_gene_map             = self.load(self.blast_filename)
         self.genefamily_filename_map    = self.load(self.pagan_filename)
+        self.genefamily_failure_map     = self.load(self.failure_filename)
+        self.progress_mtime             = self._snapshot_mtime()
+
+        records = self.journal.read_new()
+
+        for r in records :
+            self._replay(r)
+
+        if records :
+            self.log.info("read %d records from journals in %s" % (len(records), self.journal.directory))
 
         if self.contig_query_map :
             self.log.info("read %d contig to query id mappings" % sum([ len(self.contig_query_map[label]) for label in self.contig_query_map ]))
@@ -252,11 +311,163 @@ class GluttonInformation(GluttonJSON) :
         if self.genefamily_filename_map :
             self.log.info("read %d pagan results" % len(self.genefamily_filename_map))
 
+    # progress files are read, merged with what is in memory and written back
+    # with the lease held, so results from other processes are not lost
     @do_locking
     def write_progress_files(self) :
-        self.dump(self.contig_filename,    self.contig_query_map)
-        self.dump(self.blast_filename,     self.query_gene_map)
-        self.dump(self.pagan_filename,     self.genefamily_filename_map)
+        self.leases.wait(PROGRESS_LOCK)
+
+        try :
+            # the journals of processes that wrote the snapshot are gone, so
+            # it must be read even if it looks the same as last time
+            completed = self._merge_progress_files(reload=True)
+
+            self.dump(self.contig_filename,    self.contig_query_map,         pretty=False)
+            self.dump(self.blast_filename,     self.query_gene_map,           pretty=False)
+            self.dump(self.pagan_filename,     self.genefamily_filename_map,  pretty=False)
+            self.dump(self.failure_filename,   self.genefamily_failure_map,   pretty=False)
+
+            self.progress_mtime = self._snapshot_mtime()
+
+            # our journal is in the snapshot, as are the journals of processes
+            # that have stopped (theirs will not be added to again)
+            self.journal.rotate()
+            self.journal.remove([ f for f in self.journal.others() if not self.leases.active(JOURNAL_LEASE % Journal.owner_of(f)) ])
+
+        finally :
+            self.leases.release(PROGRESS_LOCK)
+
+        # these are in pagan.json now
+        self.leases.remove(completed.keys())
+
+    # append to the journal, progress is on disk once this returns (unless 
+    # sync is False, then it is on disk after the next record that is synced)
+    def _record(self, records, sync=True) :
+        if not records :
+            return
+
+        # other processes only delete our journal after this lease expires
+        if not self.leases.holding(JOURNAL_LEASE % self.leases.owner) :
+            self.leases.acquire(JOURNAL_LEASE % self.leases.owner)
+
+        self.journal.append(records, sync)
+
+        if self.journal.records >= COMPACT_RECORDS :
+            self.write_progress_files()
+
+    @do_locking
+    def sync(self) :
+        self.journal.sync()
+
+    # the same rules as _merge_progress_files()
+    def _replay(self, record) :
+        if record[0] == 'contig' :
+            label, contig_id, query_id = record[1:]
+            self.contig_query_map.setdefault(label, {}).setdefault(contig_id, query_id)
+
+        elif record[0] == 'blastx' :
+            query_id, gene = record[1:]
+            self.query_gene_map.setdefault(query_id, gene)
+
+        elif record[0] == 'pagan' :
+            genefamily_id, filename = record[1:]
+
+            if self.genefamily_filename_map.get(genefamily_id, 'FAIL') == 'FAIL' :
+                self.genefamily_filename_map[genefamily_id] = filename
+
+        elif record[0] == 'failure' :
+            genefamily_id, reason = record[1:]
+            self.genefamily_failure_map.setdefault(genefamily_id, reason)
+
+    # read what other processes have done
+    @do_locking
+    def refresh(self) :
+        self._merge_progress_files()
+
+    # our results take precedence, unless we failed and they did not,
+    # returns the results from completed leases
+    def _merge_progress_files(self, reload=False) :
+        for r in self.journal.read_new() :
+            self._replay(r)
+
+        completed = self.leases.completed()
+
+        for genefamily_id,filename in completed.iteritems() :
+            self._replay(('pagan', genefamily_id, filename))
+
+        # the snapshot is only read again if it has been rewritten (unless
+        # reload, mtimes can have a resolution of a second)
+        mtime = self._snapshot_mtime()
+
+        if (mtime == self.progress_mtime) and not reload :
+            return completed
+
+        self.progress_mtime = mtime
+
+        contig_query_map = self.load(self.contig_filename, verbose=False)
+
+        for label in contig_query_map :
+            tmp = self.contig_query_map.setdefault(label, {})
+
+            for contig_id,query_id in contig_query_map[label].iteritems() :
+                tmp.setdefault(contig_id, query_id)
+
+        for query_id,gene in self.load(self.blast_filename, verbose=False).iteritems() :
+            self.query_gene_map.setdefault(query_id, gene)
+
+        for genefamily_id,filename in self.load(self.pagan_filename, verbose=False).iteritems() :
+            if self.genefamily_filename_map.get(genefamily_id, 'FAIL') == 'FAIL' :
+                self.genefamily_filename_map[genefamily_id] = filename
+
+        for genefamily_id,reason in self.load(self.failure_filename, verbose=False).iteritems() :
+            self.genefamily_failure_map.setdefault(genefamily_id, reason)
+
+        return completed
+
+    # returns True if the caller should do the work (e.g. align a gene family),
+    # False if it has been done or another process is doing it
+    @do_locking
+    def claim(self, name) :
+        # another process could have finished it and removed the lease
+        if self._snapshot_mtime() != self.progress_mtime :
+            self._merge_progress_files()
+
+        if name in self.genefamily_filename_map :
+            return False
+
+        if self.leases.acquire(name) :
+            return True
+
+        result = self.leases.result(name)
+
+        if result is not None :
+            self.genefamily_filename_map[name] = result
+
+        return False
+
+    # the progress files are written together, but some can be empty (and so not written),
+    # each is renamed into place so the inode changes even if the mtime does not
+    def _snapshot_mtime(self) :
+        mtimes = []
+
+        for fname in (self.contig_filename, self.blast_filename, self.pagan_filename, self.failure_filename) :
+            try :
+                st = os.stat(fname)
+                mtimes.append((st.st_mtime, st.st_ino, st.st_size))
+
+            except OSError :
+                mtimes.append(None)
+
+        return tuple(mtimes)
+
+    def release(self, name) :
+        self.leases.release(name)
+
+    # anything not in the snapshot stays in our journal, other processes
+    # will add it to the snapshot when our journal lease expires
+    def release_all(self) :
+        self.journal.close()
+        self.leases.stop()
 
     def _set_id_counter(self) :
         tmp = [0]
@@ -291,20 +502,38 @@ class GluttonInformation(GluttonJSON) :
 
         self.contig_query_map[label][contig_id] = new_query_id
 
+        # synced with the blastx results that refer to it
+        self._record([ ('contig', label, contig_id, new_query_id) ], sync=False)
+
         return new_query_id
 
     # query id to gene id
     #   update
     @do_locking
     def update_query_gene_mapping(self, new_dict) :
+        # gene assignments do not change, so only record new ones
+        self._record([ ('blastx', query_id, gene) for query_id,gene in new_dict.iteritems() if query_id not in self.query_gene_map ])
+
         self.query_gene_map.update(new_dict)
 
-    # genefamily id to filename or FAIL
+    # genefamily id to filename or FAIL (and why it failed)
     #   put/get/fail/in
     @do_locking
-    def put_genefamily2filename(self, genefamily_id, filename='FAIL') :
+    def put_genefamily2filename(self, genefamily_id, filename='FAIL', reason=None) :
+        records = [ ('pagan', genefamily_id, filename) ]
+
         self.genefamily_filename_map[genefamily_id] = filename
 
+        if filename == 'FAIL' :
+            self.genefamily_failure_map[genefamily_id] = reason or UNKNOWN_REASON
+            records.append(('failure', genefamily_id, reason or UNKNOWN_REASON))
+        else :
+            self.genefamily_failure_map.pop(genefamily_id, None)
+
+        # in the journal before the lease says it is done
+        self._record(records)
+        self.leases.complete(genefamily_id, filename)
+
     def get_genefamily2filename(self, genefamily_id) :
         return self.genefamily_filename_map[genefamily_id]
 
@@ -356,6 +585,17 @@ class GluttonInformation(GluttonJSON) :
 
         return not_done, failures
 
+    # reason -> number of gene families that failed for that reason
+    @do_locking
+    def failure_reasons(self) :
+        tmp = collections.Counter()
+
+        for i in self.build_genefamily2contigs() :
+            if self.genefamily_filename_map.get(i) == 'FAIL' :
+                tmp[self.genefamily_failure_map.get(i, UNKNOWN_REASON)] += 1
+
+        return tmp
+
     @do_locking
     def alignments_complete(self) :
         genefamily_contig_map = self.build_genefamily2contigs()
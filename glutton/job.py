@@ -1,11 +1,16 @@
 import os
+import threading
+import cPickle
 
-from glutton.utils import get_log, tmpfasta, tmpfasta_orfs, tmpfile, rm_f, threadsafe_io, fasta_stats
+from glutton.utils import get_log, tmpfasta, tmpfasta_orfs, rm_f, threadsafe_io, sequence_stats, openmp_num_threads, get_binary_path, get_job_timeout
+from glutton.base import ExternalTool, MISSING_OUTPUT
+from glutton.scratch import scratch_manager
 from glutton.prank import Prank
 from glutton.pagan import Pagan
 from glutton.blast import Blastx, Tblastx
 
 from abc import abstractmethod
+from glob import glob
 from os.path import basename, isfile, join
 from sys import exit
 
@@ -14,9 +19,65 @@ import time
 
 DEBUG = False
 
+# scratch space to ask for, as a multiple of the total length of the input
+# sequences (inputs, outputs and anything the programs write themselves)
+SCRATCH_FACTOR = 10
+
+# why a job failed, see Job.reason
+TIMEOUT     = 'timeout'     # killed after running for longer than its time limit
+NO_OUTPUT   = 'no-output'   # the program did not create its output files
+ERROR       = 'error'       # anything else
+
 class JobError(Exception) :
     pass
 
+# runs in a worker process, the job comes back with whatever _run() set
+def _run_job(job) :
+    ret = job._run()
+    return ret, job
+
+# replace filenames in the job (and the programs it runs)
+def relocate(obj, mapping) :
+    for k,v in obj.__dict__.items() :
+        if isinstance(v, basestring) and v in mapping :
+            setattr(obj, k, mapping[v])
+
+        elif isinstance(v, ExternalTool) :
+            relocate(v, mapping)
+
+# protects Job.race and Job.reported, jobs and their copies finish in
+# different threads
+_race_lock = threading.Lock()
+
+# a job and its speculative copies (see Job.speculate()), only one of them 
+# has its callback called: the first to succeed or, if none do, the last to 
+# finish, the others are killed (if they are running in this process, 
+# otherwise they run to the end and their results are ignored)
+class Race(object) :
+    def __init__(self, job) :
+        self.jobs = [ job ]
+        self.running = 1
+        self.winner = None
+
+    def add(self, job) :
+        self.jobs.append(job)
+        self.running += 1
+
+    # returns True if job's result is the one to use
+    def finished(self, job, ret) :
+        self.running -= 1
+
+        if self.winner or ((ret != 0) and self.running) :
+            return False
+
+        self.winner = job
+
+        for j in self.jobs :
+            if j is not job :
+                j.kill()
+
+        return True
+
 class Job(object) :
     QUEUED,RUNNING,SUCCESS,FAIL,TERMINATED,INTERNAL_ERROR,NOTHING_TO_DO = range(7)
 
@@ -35,6 +96,52 @@ class Job(object) :
         self.log = get_log()
         self.callback = callback
 
+        self.predicted = None   # seconds, from the cost model
+        self.elapsed = None     # seconds taken by _run()
+        self.threads = 1        # cores given to the job by the queue
+
+        self.retries = 0        # times to run the job again if it fails, set by the queue
+        self.attempts = 0
+        self.reason = None      # TIMEOUT, NO_OUTPUT or ERROR if the job failed
+        self.race = None        # see Race
+        self.reported = False   # the result has been decided, see _report()
+        self.returncode = None  # from _run()
+        self.scratch = None     # directory for the job's files, see _scratch()
+
+    @property
+    def jobtype(self) :
+        return type(self).__name__
+
+    # what the job is working on (e.g. a gene family id), for the metrics
+    @property
+    def name(self) :
+        return None
+
+    # sequences the job was given, name -> list of sequences
+    def inputs(self) :
+        return {}
+
+    # (number of sequences, total length) for the cost model, 
+    # None if this kind of job is not modelled
+    def features(self) :
+        return None
+
+    # the most cores the job can make use of, how many it
+    # actually gets depends on what else is running
+    def max_threads(self) :
+        return 1
+
+    # called by the worker before the job is run (or sent elsewhere to be
+    # run), so that expensive set up happens in parallel instead of in the
+    # thread enqueuing jobs, raises JobError if the job cannot be run
+    def prepare(self) :
+        pass
+
+    # files that _run() reads that are not created by the job itself,
+    # these need to be copied when a job is run on another machine
+    def shared_files(self) :
+        return []
+
     def success(self) :
         if self.state not in (Job.SUCCESS, Job.FAIL, Job.TERMINATED, Job.INTERNAL_ERROR) :
             raise JobError('job has not been run')
@@ -52,15 +159,210 @@ class Job(object) :
 
     def start(self) :
         self.state = Job.RUNNING
+        self.reported = False
 
     def end(self, s) :
         assert s in (Job.SUCCESS, Job.FAIL, Job.TERMINATED, Job.INTERNAL_ERROR), "status should be success, fail or terminated"
         self.state = s
 
-    def run(self) :
+    # the callback, logger and race stay in the parent process
+    def __getstate__(self) :
+        state = self.__dict__.copy()
+        del state['log']
+        del state['callback']
+        del state['race']
+        return state
+
+    def __setstate__(self, state) :
+        self.__dict__.update(state)
+        self.log = get_log()
+        self.callback = None
+        self.race = None
+
+    def _tools(self) :
+        return [ v for v in self.__dict__.values() if isinstance(v, ExternalTool) ]
+
+    # kill whatever the job is running in this process
+    def kill(self) :
+        for t in self._tools() :
+            t.kill()
+
+    # a copy of a running job to race against it, None if it has already
+    # finished (the copy's callback is the same, but see Race)
+    def speculate(self) :
+        _race_lock.acquire()
+
+        try :
+            if self.reported :
+                return None
+
+            copy = cPickle.loads(cPickle.dumps(self, cPickle.HIGHEST_PROTOCOL))
+            copy.state = Job.QUEUED
+            copy.callback = self.callback
+            copy.scratch = None
+
+            if not self.race :
+                self.race = Race(self)
+
+            self.race.add(copy)
+            copy.race = self.race
+
+            return copy
+
+        finally :
+            _race_lock.release()
+
+    # returns False if this is a copy of a job (or the job a copy was made 
+    # of) and the result of another copy is being used instead
+    def _report(self, ret) :
+        _race_lock.acquire()
+
+        try :
+            self.reported = True
+            return self.race.finished(self, ret) if self.race else True
+
+        finally :
+            _race_lock.release()
+
+    # timeouts are not retried, the job would only run out of time again
+    def _retry(self, ret) :
+        return (ret not in (0, -2)) and (self.race is None) and (self.attempts <= self.retries) and not self._timed_out()
+
+    def _timed_out(self) :
+        return any([ t.timed_out for t in self._tools() ])
+
+    def _reason(self, ret) :
+        if self._timed_out() :
+            return TIMEOUT
+        elif ret == MISSING_OUTPUT :
+            return NO_OUTPUT
+
+        return ERROR
+
+    # what was run, how long it took and what it used, one of these is 
+    # written to the metrics file each time the job is run (see glutton/metrics.py)
+    def metrics(self) :
+        usage = { 'cpu' : 0.0, 'maxrss' : 0, 'reads' : 0, 'writes' : 0 }
+
+        for t in self._tools() :
+            for k,v in t.usage.iteritems() :
+                usage[k] = max(usage[k], v) if k == 'maxrss' else usage[k] + v
+
+        inputs = {}
+
+        for k,seqs in self.inputs().iteritems() :
+            count, total, minimum, maximum, mean, sd = sequence_stats(seqs)
+            inputs[k] = { 'count' : count, 'total' : total, 'min' : minimum, 'max' : maximum, 'mean' : mean, 'sd' : sd }
+
+        tmp = {
+            'time'          : time.time(),
+            'job'           : self.jobtype,
+            'name'          : self.name,
+            'state'         : 'RETRY' if self.state == Job.QUEUED else self.state_str(),
+            'returncode'    : self.returncode,
+            'reason'        : self.reason,
+            'attempt'       : self.attempts,
+            'speculative'   : self.race is not None,
+            'threads'       : self.threads,
+            'predicted'     : self.predicted,
+            'wall'          : self.elapsed,
+            'inputs'        : inputs
+        }
+
+        tmp.update(usage)
+
+        if self.scratch :
+            tmp['scratch'] = self.scratch.report()
+
+        return tmp
+
+    # bytes of scratch space the job is expected to use
+    def scratch_size(self) :
+        return SCRATCH_FACTOR * sum([ len(s) for seqs in self.inputs().values() for s in seqs ])
+
+    # a new directory for the job's files, called from _run() so it is
+    # on the machine the job is running on (see glutton/scratch.py)
+    def _scratch(self) :
+        self.scratch = scratch_manager().new(self.scratch_size())
+        return self.scratch
+
+    # _run() in a process from pool, the callback is still called from this process
+    def _run_in(self, pool) :
+        ret, job = pool.apply_async(_run_job, (self,)).get()
+
+        self.__dict__.update(job.__getstate__())
+
+        return ret
+
+    # for running a job on a different machine to the one that created it, 
+    # programs can be installed somewhere else and shared files copied to
+    # somewhere else (mapping is original filename -> copy), time limits 
+    # given on this machine replace the ones the job was created with
+    def localise(self, mapping) :
+        for v in self._tools() :
+            v.binary_location = get_binary_path(v.name)
+            v.timeout = get_job_timeout(v.name) or v.timeout
+
+        relocate(self, mapping)
+
+    # the contents of the files _run() created, so that the callback can be 
+    # called on a different machine (see restore_files())
+    def output_files(self) :
+        return dict([ (f, open(f).read()) for f in self._get_filenames() if f and isfile(f) ])
+
+    # write files from output_files() to directory, as if _run() had created them there
+    def restore_files(self, files, directory) :
+        mapping = {}
+
+        for fname,data in files.iteritems() :
+            mapping[fname] = join(directory, basename(fname))
+
+            with open(mapping[fname], 'w') as f :
+                f.write(data)
+
+        relocate(self, mapping)
+
+    # run locally, in a process from pool or by a worker on another machine
+    # (see glutton/remote.py)
+    def run(self, pool=None, remote=None) :
         self.start()
+
+        for t in self._tools() :
+            t.reset_usage()
         
-        ret = self._run()
+        start_time = time.time()
+
+        try :
+            self.prepare()
+
+        except JobError, je :
+            self.log.error("could not prepare %s (%s)" % (str(self), str(je)))
+            ret = 1
+
+        else :
+            if remote :
+                ret = remote.run_job(self)
+            elif pool :
+                ret = self._run_in(pool)
+            else :
+                ret = self._run()
+
+        self.elapsed = time.time() - start_time
+        self.attempts += 1
+        self.returncode = ret
+
+        if not self._report(ret) :
+            self.end(Job.FAIL)
+            self.cleanup()
+            return
+
+        # the queue puts the job back (see WorkQueue._requeue())
+        if self._retry(ret) :
+            self.state = Job.QUEUED
+            self.reason = self._reason(ret)
+            self.cleanup()
+            return
+
         #try :
         #    ret = self._run()
 
@@ -70,12 +372,20 @@ class Job(object) :
         #    self.cleanup()
         #    return
 
+        self.finish(ret)
+
+    # set the state from _run()'s return code and call the callback, this is
+    # separate so jobs run elsewhere can be finished here (see glutton/batch.py)
+    def finish(self, ret) :
+        self.reason = None
+
         if ret == 0 :
             self.end(Job.SUCCESS)
         elif ret == -2 : # SIGINT = 130
             self.end(Job.TERMINATED)
         else :
             self.end(Job.FAIL)
+            self.reason = self._reason(ret)
 
         if not self.terminated() :
             self.callback(self)
@@ -94,6 +404,9 @@ class Job(object) :
                 self.log.debug("deleting %s" % f)
                 rm_f(f)
 
+        if self.scratch :
+            self.scratch.remove()
+
     @abstractmethod
     def _run(self) :
         pass
@@ -116,6 +429,16 @@ class PrankJob(Job) :
     def input(self) :
         return self.sequences
 
+    @property
+    def name(self) :
+        return getattr(self.sequences, 'id', None)
+
+    def inputs(self) :
+        return { 'sequences' : self.sequences }
+
+    def features(self) :
+        return len(self.sequences), sum([ len(s) for s in self.sequences ])
+
     @property
     def tree(self) :
         return self.prank.tree
@@ -128,21 +451,13 @@ class PrankJob(Job) :
         return [self.infile] + self.prank.output_filenames(self.infile)
 
     def _run(self) :
-        global DEBUG
+        scratch = self._scratch()
 
-        self.infile = tmpfasta(self.sequences)
-        start_time = time.time()
+        self.infile = tmpfasta(self.sequences, scratch.path('input.fasta'))
+        scratch.measure('input')
 
         result = self.prank.run(self.infile, self.infile)
-
-        elapsed_time = time.time() - start_time
-        q_count, q_sum, q_min, q_max, q_mean, q_sd = fasta_stats(self.infile)
-
-        if DEBUG :
-            threadsafe_io('prank_stats.txt', "%d %d %d %d %d %.3f %.3f %d" % \
-                                            (result, \
-                                             q_count, q_sum, q_min, q_max, q_mean, q_sd, \
-                                             elapsed_time))
+        scratch.measure('output')
 
         return result
 
@@ -161,20 +476,40 @@ class BlastJob(Job) :
     def input(self) :
         return self.queries
 
+    def inputs(self) :
+        return { 'queries' : self.queries }
+
     @property
     def results(self) :
         return self.blastx.results
 
+    def max_threads(self) :
+        return openmp_num_threads()
+
+    # the database fasta file and the files makeblastdb created
+    def shared_files(self) :
+        return [ self.database ] + glob(self.database + '.p*')
+
     def _get_filenames(self) :
         return [self.query_fname, self.out_fname]
 
     def _run(self) :
         global DEBUG
 
-        self.query_fname = tmpfasta(self.queries)
-        self.out_fname = tmpfile()
+        # queries and results go through pipes if the program supports it
+        if self.blastx.streams :
+            self.query_fname = self.out_fname = None
+            result = self.blastx.run_stream(self.queries, self.database, self.threads)
+
+        else :
+            scratch = self._scratch()
+
+            self.query_fname = tmpfasta(self.queries, scratch.path('queries.fasta'))
+            self.out_fname = scratch.path('results.csv')
+            scratch.measure('input')
 
-        result = self.blastx.run(self.query_fname, self.database, self.out_fname)
+            result = self.blastx.run(self.query_fname, self.database, self.out_fname, self.threads)
+            scratch.measure('output')
 
         q = dict([ (q.id, len(q)) for q in self.input ])
 
@@ -196,13 +531,18 @@ class BlastJob(Job) :
         return result
 
 class PaganJob(Job) :
-    def __init__(self, callback, queries, genefamily_id, alignment, tree, identity, overlap) :
+    # the job only has the ids of the contigs and gene family until it is 
+    # prepared, then source.load() returns the contigs (on the right strand), 
+    # the reference alignment and tree (see glutton/aligner.py)
+    def __init__(self, callback, source, genefamily_id, query_ids, identity, overlap) :
         super(PaganJob, self).__init__(callback)
 
-        self._queries = queries
+        self.source = source
+        self.query_ids = query_ids
+        self._queries = None
         self._genefamily = genefamily_id
-        self._alignment = alignment
-        self._tree = tree
+        self._alignment = None
+        self._tree = None
         self.identity = identity
         self.overlap = overlap
 
@@ -221,6 +561,33 @@ class PaganJob(Job) :
     def genefamily(self) :
         return self._genefamily
 
+    @property
+    def name(self) :
+        return self._genefamily
+
+    def inputs(self) :
+        if self._queries is None :
+            return {}
+
+        return { 'queries' : self._queries, 'alignment' : self._alignment }
+
+    def prepare(self) :
+        if not self.source :
+            return
+
+        self._queries, self._alignment, self._tree = self.source.load(self._genefamily, self.query_ids)
+        self.source = None
+
+    # only once the job has been prepared, the reference's length is without
+    # gaps, like GluttonDB._family_length(), so the aligner can predict the
+    # cost of a job without reading its alignment
+    def features(self) :
+        return len(self._queries) + len(self._alignment), sum([ len(s) for s in self._queries ]) + sum([ len(s.sequence.replace('-', '')) for s in self._alignment ])
+
+    # pagan places each query in a separate thread
+    def max_threads(self) :
+        return min(len(self.query_ids), openmp_num_threads())
+
     @property
     def nucleotide_alignment(self) :
         return self.pagan.nucleotide_alignment
@@ -234,35 +601,27 @@ class PaganJob(Job) :
         return [self.query_fname, self.alignment_fname, self.tree_fname] + self.pagan.output_filenames(self.out_fname)
 
     def _run(self) :
-        global DEBUG
+        scratch = self._scratch()
 
-        self.query_fname     = tmpfasta_orfs(self._queries, strand=True)
+        self.query_fname     = tmpfasta_orfs(self._queries, strand=True, fname=scratch.path('queries.fasta'))
         #self.query_fname     = tmpfasta(self._queries)
-        self.out_fname       = tmpfile()
-        self.alignment_fname = tmpfasta(self._alignment) # tmpfasta_kill_n(self._alignment)
-        
-        self.tree_fname = tmpfile(self._tree) if self._tree else None
-        
+        self.out_fname       = scratch.path('out')
+        self.alignment_fname = tmpfasta(self._alignment, scratch.path('reference.fasta')) # tmpfasta_kill_n(self._alignment)
         
-        start_time = time.time()
+        self.tree_fname = scratch.write('tree', self._tree) if self._tree else None
         
+        scratch.measure('input')
+
         result = self.pagan.run(self.query_fname, 
                                 self.out_fname, 
                                 self.alignment_fname, 
                                 self.tree_fname,
                                 self.identity,
-                                self.overlap)
-        
-        elapsed_time = time.time() - start_time
-        q_count, q_sum, q_min, q_max, q_mean, q_sd = fasta_stats(self.query_fname)
-        a_count, a_sum, a_min, a_max, a_mean, a_sd = fasta_stats(self.alignment_fname)
+                                self.overlap,
+                                self.threads,
+                                scratch.mkdir('pagan'))
+
+        scratch.measure('output')
 
-        if DEBUG :
-            threadsafe_io('pagan_stats.txt', "%s %d %d %d %d %d %.3f %.3f %d %d %d %d %.3f %.3f %d" % \
-                                            (self._genefamily, result, \
-                                             q_count, q_sum, q_min, q_max, q_mean, q_sd, \
-                                             a_count, a_sum, a_min, a_max, a_mean, a_sd, \
-                                             elapsed_time))
-        
         return result
 
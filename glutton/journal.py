@@ -0,0 +1,133 @@
+import os
+import json
+import errno
+
+from os.path import join, basename
+
+from glutton.utils import get_log, rm_f, check_dir
+
+
+# an append-only record of progress, so that finished work is not lost if
+# glutton is killed before the progress files are written
+#
+# each process appends to its own journal (appends from different machines
+# to the same file are not safe on NFS) and reads the others' incrementally,
+# records are one json value per line, a line that was only partly written
+# is ignored
+#
+# journals are removed once their records are in a snapshot (see
+# GluttonInformation.write_progress_files()), the owner starts a new one
+# with a higher sequence number, so that other processes reading it can
+# tell the difference between a new journal and one that has grown
+
+JOURNAL_EXT = '.journal'
+
+class Journal(object) :
+    def __init__(self, directory, owner) :
+        self.directory = directory
+        self.owner = owner
+        self.log = get_log()
+
+        self.seq = 0
+        self.f = None
+        self.records = 0    # in the current journal
+
+        self.offsets = {}   # other journals -> bytes read so far
+
+        check_dir(self.directory, create=True)
+
+    @property
+    def fname(self) :
+        return join(self.directory, "%s.%d%s" % (self.owner, self.seq, JOURNAL_EXT))
+
+    # the owner of a journal, from its filename
+    @staticmethod
+    def owner_of(fname) :
+        return basename(fname)[:-len(JOURNAL_EXT)].rsplit('.', 1)[0]
+
+    # only the last record is synced, records are written in order so
+    # all the records before it are on disk too
+    def append(self, records, sync=True) :
+        if not self.f :
+            self.f = open(self.fname, 'a')
+
+        for r in records :
+            self.f.write(json.dumps(r, separators=(',', ':')) + '\n')
+
+        self.records += len(records)
+
+        if sync :
+            self.sync()
+
+    def sync(self) :
+        if self.f :
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    # once the records are in a snapshot
+    def rotate(self) :
+        self.close()
+        rm_f(self.fname)
+
+        self.seq += 1
+        self.records = 0
+
+    def close(self) :
+        if self.f :
+            self.f.close()
+            self.f = None
+
+    # everyone else's journals
+    def others(self) :
+        return [ join(self.directory, f) for f in os.listdir(self.directory) \
+                    if f.endswith(JOURNAL_EXT) and (self.owner_of(f) != self.owner) ]
+
+    # records added to other journals since the last time this was called
+    def read_new(self) :
+        records = []
+        current = self.others()
+
+        for fname in current :
+            records += self._read(fname)
+
+        # journals that have been removed, their records are in the snapshot
+        for fname in set(self.offsets) - set(current) :
+            del self.offsets[fname]
+
+        return records
+
+    def _read(self, fname) :
+        offset = self.offsets.get(fname, 0)
+
+        try :
+            with open(fname) as f :
+                f.seek(offset)
+                data = f.read()
+
+        except IOError, ioe :
+            if ioe.errno != errno.ENOENT :
+                raise
+
+            return []
+
+        # the last line might not be finished yet
+        end = data.rfind('\n') + 1
+        self.offsets[fname] = offset + end
+
+        records = []
+
+        for line in data[:end].splitlines() :
+            try :
+                records.append(json.loads(line))
+
+            except ValueError :
+                self.log.warn("ignoring corrupt record in %s" % fname)
+
+        return records
+
+    def remove(self, fnames) :
+        rm_f(fnames)
+
+        for fname in fnames :
+            self.offsets.pop(fname, None)
+
@@ -0,0 +1,287 @@
+import os
+import json
+import time
+import errno
+import socket
+import threading
+
+from os.path import join
+
+from glutton.utils import get_log, tmpfile, rm_f, check_dir
+
+
+# leases let several glutton processes share a project directory (possibly
+# from different machines, using a shared filesystem) without doing the same
+# work twice
+#
+# a lease is a file, created by hard linking a temporary file into place (this
+# is atomic, even on NFS), containing who owns it and, once the work is done,
+# the result, the owner touches the file regularly and if it has not been
+# touched for longer than the lease time anyone else can break the lease and
+# take the work over
+#
+# to avoid depending on the clocks of different machines agreeing, times are
+# all file modification times on the shared filesystem
+
+LEASE_EXT = '.lease'
+LEASE_TIME = 600
+
+class LeaseError(Exception) :
+    pass
+
+class LeaseManager(object) :
+    def __init__(self, directory, duration=LEASE_TIME) :
+        self.directory = directory
+        self.duration = duration
+        self.owner = "%s:%d:%s" % (socket.gethostname(), os.getpid(), os.urandom(4).encode('hex'))
+        self.log = get_log()
+
+        self.held = set()
+        self.lock = threading.Lock()
+        self.renewer = None
+        self.stopped = threading.Event()
+
+        check_dir(self.directory, create=True)
+
+        self.clock = join(self.directory, '.clock-%s' % self.owner)
+
+    def _fname(self, name) :
+        return join(self.directory, name + LEASE_EXT)
+
+    # the current time according to the filesystem
+    def _now(self) :
+        with open(self.clock, 'w') :
+            pass
+
+        return os.stat(self.clock).st_mtime
+
+    def _read(self, fname) :
+        try :
+            return json.loads(open(fname).read())
+
+        except IOError, ioe :
+            if ioe.errno != errno.ENOENT :
+                raise
+
+        except ValueError :
+            self.log.warn("%s is corrupt" % fname)
+
+        return None
+
+    def _write(self, result=None) :
+        return tmpfile(json.dumps({ 'owner' : self.owner, 'result' : result }), directory=self.directory)
+
+    # returns True if the lease was acquired, False if someone else has it
+    # or has already done the work (see result())
+    def acquire(self, name) :
+        fname = self._fname(name)
+        tmp = self._write()
+
+        try :
+            while True :
+                try :
+                    os.link(tmp, fname)
+                    break
+
+                except OSError, ose :
+                    if ose.errno != errno.EEXIST :
+                        raise
+
+                if not self._break_if_expired(fname) :
+                    return False
+
+        finally :
+            rm_f(tmp)
+
+        self.lock.acquire()
+        self.held.add(name)
+        self.lock.release()
+
+        self._start_renewer()
+
+        return True
+
+    # returns True if there is no lease (any more), only one process can rename
+    # an expired lease out of the way, so only one will take it over (the
+    # lease that was renamed is checked, in case it is not the one that was
+    # read)
+    def _break_if_expired(self, fname) :
+        try :
+            mtime = os.stat(fname).st_mtime
+
+        except OSError, ose :
+            if ose.errno != errno.ENOENT :
+                raise
+
+            return True
+
+        lease = self._read(fname)
+
+        if not lease :
+            return True
+
+        if (lease['result'] is not None) or ((self._now() - mtime) < self.duration) :
+            return False
+
+        stale = "%s.%s" % (fname, self.owner)
+
+        try :
+            os.rename(fname, stale)
+
+        except OSError, ose :
+            if ose.errno != errno.ENOENT :
+                raise
+
+            return True
+
+        # someone else could have broken the lease and taken it (or the owner
+        # renewed it) between reading it and renaming it, if so put it back
+        if not self._same_lease(stale, lease, mtime) :
+            try :
+                os.link(stale, fname)
+
+            except OSError, ose :
+                if ose.errno != errno.EEXIST :
+                    raise
+
+            rm_f(stale)
+
+            return False
+
+        self.log.info("lease %s held by %s has expired" % (fname, lease['owner']))
+        rm_f(stale)
+
+        return True
+
+    def _same_lease(self, fname, lease, mtime) :
+        try :
+            current_mtime = os.stat(fname).st_mtime
+
+        except OSError, ose :
+            if ose.errno != errno.ENOENT :
+                raise
+
+            return False
+
+        current = self._read(fname)
+
+        return (current is not None) and (current['owner'] == lease['owner']) and (current_mtime == mtime)
+
+    # True if someone holds the lease and has renewed it recently
+    def active(self, name) :
+        try :
+            mtime = os.stat(self._fname(name)).st_mtime
+
+        except OSError, ose :
+            if ose.errno != errno.ENOENT :
+                raise
+
+            return False
+
+        return (self._now() - mtime) < self.duration
+
+    def holding(self, name) :
+        self.lock.acquire()
+
+        try :
+            return name in self.held
+
+        finally :
+            self.lock.release()
+
+    # blocks until the lease is acquired, for using a lease as a lock
+    def wait(self, name, interval=1) :
+        while not self.acquire(name) :
+            time.sleep(interval)
+
+    def release(self, name) :
+        self.lock.acquire()
+
+        try :
+            if name not in self.held :
+                return
+
+            self.held.remove(name)
+
+        finally :
+            self.lock.release()
+
+        rm_f(self._fname(name))
+
+    # record the result in the lease, so other processes can see it,
+    # completed leases do not expire
+    def complete(self, name, result) :
+        self.lock.acquire()
+
+        try :
+            if name not in self.held :
+                return
+
+            self.held.remove(name)
+
+        finally :
+            self.lock.release()
+
+        os.rename(self._write(result), self._fname(name))
+
+    # the result of someone else's lease, or None if it is not finished
+    def result(self, name) :
+        lease = self._read(self._fname(name))
+        return lease['result'] if lease else None
+
+    # name -> result for every completed lease
+    def completed(self) :
+        tmp = {}
+
+        for f in os.listdir(self.directory) :
+            if not f.endswith(LEASE_EXT) :
+                continue
+
+            lease = self._read(join(self.directory, f))
+
+            if lease and (lease['result'] is not None) :
+                tmp[f[:-len(LEASE_EXT)]] = lease['result']
+
+        return tmp
+
+    # remove completed leases, once their results have been saved elsewhere
+    def remove(self, names) :
+        rm_f([ self._fname(name) for name in names ])
+
+    def _start_renewer(self) :
+        if self.renewer :
+            return
+
+        self.renewer = threading.Thread(target=self._renew)
+        self.renewer.setDaemon(True)
+        self.renewer.start()
+
+    def _renew(self) :
+        while not self.stopped.is_set() :
+            time.sleep(self.duration / 3.0)
+
+            self.lock.acquire()
+            held = list(self.held)
+            self.lock.release()
+
+            for name in held :
+                try :
+                    os.utime(self._fname(name), None)
+
+                except OSError, ose :
+                    if ose.errno != errno.ENOENT :
+                        raise
+
+                    self.log.warn("lost lease %s" % name)
+
+                    self.lock.acquire()
+                    self.held.discard(name)
+                    self.lock.release()
+
+    def stop(self) :
+        self.stopped.set()
+
+        for name in list(self.held) :
+            self.release(name)
+
+        rm_f(self.clock)
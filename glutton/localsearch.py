@@ -1,14 +1,101 @@
 import subprocess
 import os
 import threading
+import collections
 import sys
 
-from glutton.utils import get_log, tmpfile, openmp_num_threads, rm_f
+from glutton.utils import get_log, tmpfile, openmp_num_threads, rm_f, num_threads, get_emit_jobs
 from glutton.blast import Blast
 from glutton.job import BlastJob
-from glutton.queue import WorkQueue
+from glutton.batch import work_queue
 
 
+# blastx batches are cut by the number of residues in them rather than the
+# number of contigs (a batch of full length transcripts takes much longer 
+# than one of fragments), contigs are dealt out longest then shortest so 
+# every batch has a similar mix of lengths
+#
+# batches are cut as workers become free and get smaller towards the end,
+# each is at most 1 / (GUIDED * workers) of the residues left, so the last
+# ones finish at about the same time, but not smaller than that fraction of
+# a full batch or so small that blastx's start up time (estimated from the 
+# batches that have finished) is more than MAX_OVERHEAD of the time a batch 
+# takes
+GUIDED = 2
+MAX_OVERHEAD = 0.1
+
+# seconds between checks that the queue is still running while waiting
+# for a batch to finish
+SLOT_WAIT = 1.0
+
+class ResidueBatcher(object) :
+    def __init__(self, queries, batch_size, workers) :
+        self.queries = collections.deque(sorted(queries, key=len))
+        self.remaining = sum([ len(q) for q in self.queries ])
+        self.workers = max(workers, 1)
+
+        # batch_size is the number of contigs in a batch on average
+        self.budget = batch_size * (self.remaining / float(len(self.queries))) if self.queries else 0
+
+        self.observations = []  # (residues, cpu seconds) of batches that have finished
+        self.longest = True     # take the longest contig next
+
+    def __len__(self) :
+        return len(self.queries)
+
+    def observe(self, residues, seconds) :
+        self.observations.append((residues, seconds))
+
+    # least squares fit of seconds = overhead + (residues * rate), None if 
+    # there is not enough data
+    def _fit(self) :
+        n = len(self.observations)
+
+        if n < 2 :
+            return None
+
+        mean_x = sum([ x for x,y in self.observations ]) / float(n)
+        mean_y = sum([ y for x,y in self.observations ]) / float(n)
+        sxx = sum([ (x - mean_x) ** 2 for x,y in self.observations ])
+
+        if not sxx :
+            return None
+
+        rate = sum([ (x - mean_x) * (y - mean_y) for x,y in self.observations ]) / sxx
+
+        if rate <= 0 :
+            return None
+
+        return max(mean_y - (rate * mean_x), 0.0), rate
+
+    # residues in the next batch
+    def size(self) :
+        share = float(GUIDED * self.workers)
+        size = max(min(self.budget, self.remaining / share), self.budget / share)
+        fit = self._fit()
+
+        if fit :
+            overhead, rate = fit
+            size = max(size, (overhead * (1.0 - MAX_OVERHEAD)) / (MAX_OVERHEAD * rate))
+
+        return min(size, self.budget)
+
+    def next(self) :
+        size = self.size()
+        batch = []
+        residues = 0
+
+        while self.queries and (not batch or residues < size) :
+            q = self.queries.pop() if self.longest else self.queries.popleft()
+            self.longest = not self.longest
+
+            batch.append(q)
+            residues += len(q)
+
+        self.remaining -= residues
+
+        return batch
+
 class All_vs_all_search(object) :
     def __init__(self, batch_size=100) :
         self.nucleotide = False
@@ -21,57 +108,115 @@ class All_vs_all_search(object) :
         self.gene_assignments = {}
         self.lock = threading.Lock()
         self.q = None
+        self.callback = None    # called with the gene assignments from each job
 
-        self.total_jobs = 0
-        self.complete_jobs = 0
-
-    def _batch(self, x) :
-        tmp = []
+        self.batcher = None
+        self.slots = None       # batches that can be queued before one finishes
+        self.max_slots = 0
+        self.slots_cv = threading.Condition()
 
-        for i in x :
-            tmp.append(i)
-            
-            if len(tmp) == self.batch_size :
-                yield tmp
-                tmp = []
-        
-        if not tmp :
-            raise StopIteration
-
-        yield tmp
+        self.total_jobs = 0     # contigs
+        self.complete_jobs = 0
 
-    def process(self, db, queries, nucleotide, min_hitidentity, min_hitlength, max_evalue) :
+    def _set_parameters(self, nucleotide, min_hitidentity, min_hitlength, max_evalue) :
         self.nucleotide = nucleotide
         self.min_hitidentity = min_hitidentity
         self.min_hitlength = min_hitlength
         self.max_evalue = max_evalue
 
+    def process(self, db, queries, nucleotide, min_hitidentity, min_hitlength, max_evalue, prebuilt=False, callback=None) :
+        self._set_parameters(nucleotide, min_hitidentity, min_hitlength, max_evalue)
+        self.callback = callback
+
         # we need to deal with the index files here because 
-        # all of the blastx jobs need them
-        self.cleanup_files += [db + i for i in [".phr",".pin",".psq"]]
+        # all of the blastx jobs need them (unless they were
+        # built with the reference and are kept next to it)
+        if not prebuilt :
+            self.cleanup_files += [db + i for i in [".phr",".pin",".psq"]]
 
-        # creates db + {phr,pin,psq} in same dir as db
-        self.log.info("creating blast db...")
-        Blast.makedb(db) # XXX THIS IS ALWAYS PROTEIN, BECAUSE WE WANT TO RUN BLASTX
+            # creates db + {phr,pin,psq} in same dir as db
+            self.log.info("creating blast db...")
+            Blast.makedb(db) # XXX THIS IS ALWAYS PROTEIN, BECAUSE WE WANT TO RUN BLASTX
 
         # queue up the jobs
         self.log.info("starting local alignments...")
-        self.q = WorkQueue()
+        self.q = work_queue()
 
         self.total_jobs = len(queries)
-        self.complete_jobs = -self.batch_size
-        self._progress()
+        self.complete_jobs = 0
+        self._progress(0)
+
+        self.batcher = ResidueBatcher(queries, self.batch_size, num_threads())
+
+        # jobs written by --emit-jobs are not run by this process, so they
+        # are all cut now
+        if not get_emit_jobs() :
+            self.slots = self.max_slots = 2 * num_threads()
+
+        while self.batcher :
+            if not self._wait_for_slot() :
+                break
 
-        for query in self._batch(queries) :
-            self.q.enqueue(BlastJob(self.job_callback, db, query, 'blastx'))
+            self.lock.acquire()
+            batch = self.batcher.next()
+            self.lock.release()
+
+            self.q.enqueue(BlastJob(self.job_callback, db, batch, 'blastx'))
 
         self.log.debug("waiting for job queue to drain...")
-        self.q.join()
 
-        rm_f(self.cleanup_files)
+        try :
+            # not if it was stopped while batches were still being queued
+            if self.q.running :
+                self.q.join()
+
+        finally :
+            rm_f(self.cleanup_files)
+
+        return self.gene_assignments
+
+    # finish blastx jobs written by align --emit-jobs, as if they had just been run
+    def collect(self, results, nucleotide, min_hitidentity, min_hitlength, max_evalue) :
+        self._set_parameters(nucleotide, min_hitidentity, min_hitlength, max_evalue)
+
+        self.total_jobs = sum([ len(job.input) for ret,job in results ])
+        self.complete_jobs = 0
+        self._progress(0)
+
+        for ret,job in results :
+            job.callback = self.job_callback
+            job.finish(ret)
 
         return self.gene_assignments
 
+    # block until another batch can be queued, a timed wait sleeps so signal
+    # handlers still run (an untimed wait cannot be interrupted), returns
+    # False if the queue has been stopped
+    def _wait_for_slot(self) :
+        if self.slots is None :
+            return True
+
+        self.slots_cv.acquire()
+
+        try :
+            while self.slots <= 0 :
+                if not self.q.running :
+                    return False
+
+                # a job ended without its callback being called
+                if self.q.idle() :
+                    self.slots = self.max_slots
+                    break
+
+                self.slots_cv.wait(SLOT_WAIT)
+
+            self.slots -= 1
+
+            return True
+
+        finally :
+            self.slots_cv.release()
+
     def stop(self) :
         if self.q :
             self.q.stop()
@@ -81,11 +226,8 @@ class All_vs_all_search(object) :
     def get_intermediate_results(self) :
         return self.gene_assignments
 
-    def _progress(self) :
-        self.complete_jobs += self.batch_size
-        
-        if self.complete_jobs > self.total_jobs :
-            self.complete_jobs = self.total_jobs
+    def _progress(self, contigs) :
+        self.complete_jobs += contigs
 
         sys.stderr.write("\rProgress: %d / %d blastx alignments " % (self.complete_jobs, self.total_jobs))
 
@@ -98,7 +240,18 @@ class All_vs_all_search(object) :
 
         self.lock.acquire()
 
-        self._progress()
+        self._progress(len(job.input))
+
+        if self.slots is not None :
+            self.slots_cv.acquire()
+            self.slots = min(self.slots + 1, self.max_slots)
+            self.slots_cv.notify()
+            self.slots_cv.release()
+
+        if self.batcher and job.success() and job.elapsed :
+            self.batcher.observe(sum([ len(q) for q in job.input ]), job.elapsed * job.threads)
+
+        assignments = {}
 
         if job.success() :
             qlen = dict([ (q.id, len(q)) for q in job.input ])
@@ -108,16 +261,22 @@ class All_vs_all_search(object) :
                 strand = '+' if br.qstart < br.qend else '-'
 
                 if (br.qseqid in self.gene_assignments) or \
+                        (br.qseqid in assignments) or \
                         (self.max_evalue < br.evalue) or \
                         (self.min_hitidentity > br.pident) or \
                         (self.min_hitlength > br.length) :
                     continue
 
-                self.gene_assignments[br.qseqid] = (br.sseqid, strand)
+                assignments[br.qseqid] = (br.sseqid, strand)
 
         for q in job.input :
-            if q.id not in self.gene_assignments :
-                self.gene_assignments[q.id] = None
+            if (q.id not in self.gene_assignments) and (q.id not in assignments) :
+                assignments[q.id] = None
+
+        self.gene_assignments.update(assignments)
+
+        if self.callback :
+            self.callback(assignments)
 
         self.lock.release()
 
@@ -11,19 +11,29 @@ import os
 import glutton
 import glutton.subcommands
 
-from glutton.utils import tmpdir, set_threads, num_threads, set_tmpdir, set_verbosity, setup_logging, get_log, duration_str, check_dir
+from glutton.utils import tmpdir, set_threads, num_threads, set_tmpdir, set_verbosity, setup_logging, get_log, duration_str, check_dir, \
+                          set_executor, EXECUTORS, set_listen, set_emit_jobs, set_job_timeouts, set_retries, set_speculate, set_metrics, get_scratch, set_scratch
 from glutton.ensembl_sql import custom_database
 from glutton.ensembl_downloader import set_ensembl_download_method, ENSEMBL_METHODS
 from glutton.assembler_output import supported_assemblers
+from glutton.metrics import default_metrics_fname, METRICS_DIR
+from glutton.remote import authkey, RemoteError
 
 
 commands = {
     'list'      : glutton.subcommands.list_command,
     'build'     : glutton.subcommands.build_command,
     'check'     : glutton.subcommands.check_command,
+    'compact'   : glutton.subcommands.compact_command,
+    'merge'     : glutton.subcommands.merge_command,
     'setup'     : glutton.subcommands.setup_command,
     'align'     : glutton.subcommands.align_command,
-    'scaffold'  : glutton.subcommands.scaffold_command
+    'scaffold'  : glutton.subcommands.scaffold_command,
+    'export'    : glutton.subcommands.export_command,
+    'worker'    : glutton.subcommands.worker_command,
+    'run-job'   : glutton.subcommands.run_job_command,
+    'collect'   : glutton.subcommands.collect_command,
+    'stats'     : glutton.subcommands.stats_command
 }
 
 def handle_args(args) :
@@ -42,8 +52,12 @@ def handle_args(args) :
     def add_generic_options(par) :
         par.add_argument('--tmpdir', type=str, default=tmpdir(),
                          help='temporary directory')
+        par.add_argument('--scratch', type=str, default=get_scratch(), metavar='DIR',
+                         help='directory on a fast filesystem (e.g. memory) for the files jobs create, --tmpdir is used when it is short of space')
         par.add_argument('--threads', type=int, default=num_threads(),
                          help='number of threads')
+        par.add_argument('--executor', default='thread', metavar='EXECUTOR', choices=EXECUTORS,
+                         help='run jobs in threads or in a pool of processes, options are %s' % ', '.join(EXECUTORS))
         par.add_argument('-v', '--verbose',  action='count', default=2, 
                          help='set verbosity, can be set multiple times e.g.: -vvv')
 
@@ -84,12 +98,92 @@ def handle_args(args) :
             raise argparse.ArgumentTypeError("%s is negative" % v)
         return x
     
+    def check_compression_level(v) :
+        x = int(v)
+        if x < 0 or x > 9 :
+            raise argparse.ArgumentTypeError("%s is not in the range [0,9]" % v)
+        return x
+
+    def check_positive_float(v) :
+        x = float(v)
+        if x <= 0.0 :
+            raise argparse.ArgumentTypeError("%s is zero or less" % v)
+        return x
+
+    def check_shard(v) :
+        try :
+            i,n = [ int(x) for x in v.split('/') ]
+
+        except ValueError :
+            raise argparse.ArgumentTypeError("%s is not of the form i/N" % v)
+
+        if n < 1 or i < 1 or i > n :
+            raise argparse.ArgumentTypeError("%s is not a valid shard, i must be in the range [1,N]" % v)
+
+        return i,n
+
     def check_greater_than_zero(v) :
         x = int(v)
         if x < 1 :
             raise argparse.ArgumentTypeError("%s is zero or less" % v)
         return x
 
+    def check_non_negative_float(v) :
+        x = float(v)
+        if x < 0.0 :
+            raise argparse.ArgumentTypeError("%s is negative" % v)
+        return x
+
+    def check_job_timeout(v) :
+        program,sep,seconds = v.rpartition('=')
+
+        try :
+            seconds = int(seconds)
+
+        except ValueError :
+            raise argparse.ArgumentTypeError("%s is not of the form [PROGRAM=]SECONDS" % v)
+
+        if seconds < 1 :
+            raise argparse.ArgumentTypeError("%s is zero or less" % v)
+
+        return (program.lower() if sep else None), seconds
+
+    def check_address(v) :
+        host,sep,port = v.rpartition(':')
+
+        try :
+            port = int(port)
+
+        except ValueError :
+            raise argparse.ArgumentTypeError("%s is not of the form HOST:PORT" % v)
+
+        if not sep or port < 0 or port > 65535 :
+            raise argparse.ArgumentTypeError("%s is not of the form HOST:PORT" % v)
+
+        return host,port
+
+    def add_listen_options(par) :
+        par.add_argument('--listen', type=check_address, metavar='HOST:PORT',
+                         help='also run jobs on remote workers that connect to HOST:PORT (see worker command)')
+
+    def add_job_options(par) :
+        par.add_argument('--job-timeout', type=check_job_timeout, action='append', default=[], metavar='[PROGRAM=]SECONDS',
+                         help='kill programs (e.g. prank, pagan, blastx) that run for longer than SECONDS, can be given once per program, without PROGRAM it applies to the rest')
+        par.add_argument('--retries', type=check_non_negative, default=0, metavar='N',
+                         help='run jobs that fail (other than by timing out) up to N more times (default: 0, failures are not retried)')
+        par.add_argument('--retry-delay', type=check_greater_than_zero, default=30, metavar='SECONDS',
+                         help='wait SECONDS before retrying a job, doubling after each attempt')
+        par.add_argument('--speculate', type=check_non_negative_float, default=0.0, metavar='FACTOR',
+                         help='when there are idle cores, start a copy of any job that has run for FACTOR times longer than predicted and use whichever finishes first (0 to disable)')
+        par.add_argument('--metrics', type=str, nargs='?', const=METRICS_DIR, metavar='FILE',
+                         help='append a record of each job run to FILE (without FILE: a new file in %s, see stats command)' % METRICS_DIR)
+
+    def add_emit_options(par) :
+        par.add_argument('--emit-jobs', type=str, metavar='DIR',
+                         help='write jobs to DIR for a batch scheduler instead of running them (see run-job and collect commands)')
+        par.add_argument('--chunk-time', type=check_greater_than_zero, default=3600, metavar='SECONDS',
+                         help='with --emit-jobs, group jobs into bundles predicted to take SECONDS each')
+
 
     subparsers = parser.add_subparsers(help='subcommands')
 
@@ -121,9 +215,20 @@ def handle_args(args) :
                               help='download sequences and homology information, then exit')
     parser_build.add_argument('-m', '--method', default='biomart', metavar='METHOD', choices=ENSEMBL_METHODS,
                              help='specific download method, options are %s' % ', '.join(ENSEMBL_METHODS))
+    parser_build.add_argument('--cache', type=str, metavar='DIR',
+                              help='reuse prank alignments from previous builds stored in DIR')
+    parser_build.add_argument('--cache-size', type=check_positive_float, default=10.0, metavar='GB',
+                              help='maximum size of alignment cache, least recently used alignments are removed first')
+    parser_build.add_argument('--from', type=str, dest='previous', metavar='GLTFILE',
+                              help='reuse alignments from an existing database (e.g. a previous release) for unchanged gene families')
+    parser_build.add_argument('--shard', type=check_shard, metavar='i/N',
+                              help='only align the i-th of N slices of the gene families, combine shards with the merge command')
 
     add_database_options(parser_build)
     add_generic_options(parser_build)
+    add_listen_options(parser_build)
+    add_emit_options(parser_build)
+    add_job_options(parser_build)
 
     # check options
     parser_check = subparsers.add_parser('check', 
@@ -133,6 +238,30 @@ def handle_args(args) :
                               help='show which gene families have not been aligned')
 
     
+    # compact options
+    parser_compact = subparsers.add_parser('compact', formatter_class=fmt,
+                              help='remove stale files from %s database and reorder by gene family' % glutton.__name__)
+    parser_compact.add_argument('gltfile')
+    parser_compact.add_argument('-o', '--output', type=str, dest='compact_output',
+                              help='output filename (default: overwrite GLTFILE)')
+    parser_compact.add_argument('--alignment-compression', type=check_compression_level, metavar='LEVEL',
+                              help='compression level for alignments, 0 (stored) to 9 (default: unchanged)')
+    parser_compact.add_argument('--tree-compression', type=check_compression_level, metavar='LEVEL',
+                              help='compression level for trees, 0 (stored) to 9 (default: unchanged)')
+    parser_compact.add_argument('--data-compression', type=check_compression_level, metavar='LEVEL',
+                              help='compression level for manifest and index files, 0 (stored) to 9 (default: unchanged)')
+
+
+    # merge options
+    parser_merge = subparsers.add_parser('merge', formatter_class=fmt,
+                              help='combine %s databases built with --shard' % glutton.__name__)
+    parser_merge.add_argument('shards', nargs='+', metavar='SHARD',
+                              help='shard files, one for each of 1/N ... N/N')
+    parser_merge.add_argument('-o', '--output', type=str, required=True,
+                              help='output filename')
+    add_generic_options(parser_merge)
+
+    
     default_project_dir = './glutton_out'
 
     # setup options
@@ -185,14 +314,20 @@ def handle_args(args) :
     parser_align.add_argument('-x', '--length', type=check_non_negative, default=200,
                               help='minimum contig length for gene assignment step')
     parser_align.add_argument('-B', '--batchsize', type=check_greater_than_zero, default=100,
-                              help='batch size for gene assignment step')
+                              help='average number of contigs in each batch for gene assignment step (batches are cut by total length)')
 
     parser_align.add_argument('-i', '--identity', type=check_zero_one, default=0.3,
                               help='minimum alignment identity')
     parser_align.add_argument('-o', '--overlap', type=check_zero_one, default=0.1,
                               help='minimum alignment overlap')
+
+    parser_align.add_argument('--lease-time', type=check_greater_than_zero, default=600, metavar='SECONDS',
+                              help='gene families claimed by a process that has not been heard from for this long are aligned by another (several align commands can share a project)')
     
     add_generic_options(parser_align)
+    add_listen_options(parser_align)
+    add_emit_options(parser_align)
+    add_job_options(parser_align)
 
 
     # scaffold options
@@ -218,6 +353,62 @@ def handle_args(args) :
     add_generic_options(parser_scaf)
 
 
+    # export options
+    parser_export = subparsers.add_parser('export', formatter_class=fmt,
+                             help='write the alignments from align as separate files (.protein, .nucleotide, .queries, .reference and .tree)')
+    parser_export.add_argument('families', nargs='*', metavar='FAMILY',
+                             help='gene families to export (default: all of them)')
+    parser_export.add_argument('-p', '--project', type=str, default=default_project_dir,
+                             help='project directory (default=%s)' % default_project_dir)
+    parser_export.add_argument('-o', '--output', type=str, required=True, metavar='DIR',
+                             help='directory to write files to')
+
+    add_generic_options(parser_export)
+
+
+    # worker options
+    parser_worker = subparsers.add_parser('worker', formatter_class=fmt,
+                              help='run jobs for build or align on another machine (set GLUTTON_AUTHKEY on both)')
+    parser_worker.add_argument('-c', '--connect', type=check_address, required=True, metavar='HOST:PORT',
+                              help='address given to build or align with --listen')
+    parser_worker.add_argument('--timeout', type=check_greater_than_zero, default=600, metavar='SECONDS',
+                              help='exit after being unable to connect for SECONDS')
+
+    add_generic_options(parser_worker)
+
+
+    # run-job options
+    parser_runjob = subparsers.add_parser('run-job', formatter_class=fmt,
+                              help='run a bundle of jobs written by build or align with --emit-jobs')
+    parser_runjob.add_argument('bundle', metavar='BUNDLE',
+                              help='bundle of jobs (DIR/N.jobs)')
+
+    add_generic_options(parser_runjob)
+    add_job_options(parser_runjob)
+
+
+    # collect options
+    parser_collect = subparsers.add_parser('collect', formatter_class=fmt,
+                              help='add the results of bundles run with run-job to the database or project')
+    parser_collect.add_argument('directory', metavar='DIR',
+                              help='directory given to --emit-jobs')
+
+    add_generic_options(parser_collect)
+
+
+    # stats options
+    parser_stats = subparsers.add_parser('stats', formatter_class=fmt,
+                              help='summarise the jobs run by build, align and run-job')
+    parser_stats.add_argument('metrics_files', nargs='*', metavar='FILE',
+                              help='metrics files (default: all of the files in %s)' % METRICS_DIR)
+    parser_stats.add_argument('-n', '--top', type=check_greater_than_zero, default=10, metavar='N',
+                              help='show the N slowest jobs')
+    parser_stats.add_argument('-i', '--interval', type=check_greater_than_zero, default=600, metavar='SECONDS',
+                              help='show throughput in intervals of SECONDS')
+    parser_stats.add_argument('-v', '--verbose',  action='count', default=2, 
+                              help='set verbosity, can be set multiple times e.g.: -vvv')
+
+
     return parser.parse_args(args)
 
 # the reason i have used hasattr is becuase not all the parsers for
@@ -234,6 +425,29 @@ def generic_options(args) :
     if hasattr(args, 'threads') :
         set_threads(args.threads)
 
+    if hasattr(args, 'executor') :
+        set_executor(args.executor)
+
+    if hasattr(args, 'listen') :
+        if args.listen :
+            try :
+                authkey()
+
+            except RemoteError, re :
+                print >> stderr, "ERROR: %s" % str(re)
+                exit(1)
+
+        set_listen(args.listen)
+
+    if hasattr(args, 'emit_jobs') :
+        set_emit_jobs(args.emit_jobs, args.chunk_time)
+
+    if hasattr(args, 'job_timeout') :
+        set_job_timeouts(args.job_timeout)
+        set_retries(args.retries, args.retry_delay)
+        set_speculate(args.speculate)
+        set_metrics(default_metrics_fname(argv[1]) if args.metrics == METRICS_DIR else args.metrics)
+
     # tmpdir
     if hasattr(args, 'tmpdir') :
         try :
@@ -244,6 +458,14 @@ def generic_options(args) :
             print >> stderr, "ERROR: %s does not exist..." % args.tmpdir 
             exit(1)
 
+    # scratch
+    if hasattr(args, 'scratch') :
+        if args.scratch and not os.path.isdir(args.scratch) :
+            print >> stderr, "ERROR: %s does not exist..." % args.scratch
+            exit(1)
+
+        set_scratch(args.scratch)
+
     # gltfile
     if hasattr(args, 'gltfile') and args.gltfile :
         if not os.path.isfile(args.gltfile) :
@@ -257,6 +479,17 @@ def generic_options(args) :
             print >> stderr, "ERROR: you must specify either the species or an existing GLT file..."
             exit(1)
 
+    if hasattr(args, 'shards') :
+        for fname in args.shards :
+            if not os.path.isfile(fname) :
+                print >> stderr, "ERROR: %s does not exist..." % fname
+                exit(1)
+
+    if hasattr(args, 'previous') and args.previous :
+        if not os.path.isfile(args.previous) :
+            print >> stderr, "ERROR: %s does not exist..." % args.previous
+            exit(1)
+
     if hasattr(args, 'reference') and args.reference :
         if not os.path.isfile(args.reference) :
             print >> stderr, "ERROR: %s does not exist..." % args.reference
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import glob
+import threading
+import collections
+
+from os.path import join, dirname, isdir
+
+from glutton.utils import get_log, get_metrics, duration_str
+from glutton.table import pretty_print_table
+
+
+# every time a job is run the work queue appends a record of it to the metrics
+# file (one json object per line), see Job.metrics() for what is recorded, the
+# stats command summarises one or more of these files
+#
+# nothing is recorded unless --metrics is given, without a filename each run
+# of a command that runs jobs writes its own file to METRICS_DIR in the
+# current directory
+
+METRICS_DIR = 'glutton_metrics'
+METRICS_EXT = '.jsonl'
+
+class MetricsError(Exception) :
+    pass
+
+def default_metrics_fname(command) :
+    return join(METRICS_DIR, "%s-%s-%d%s" % (command, time.strftime('%Y%m%d-%H%M%S'), os.getpid(), METRICS_EXT))
+
+# the file is only created once there is something to write to it
+class MetricsWriter(object) :
+    def __init__(self, fname) :
+        self.fname = fname
+        self.f = None
+        self.lock = threading.Lock()
+
+    def write(self, record) :
+        self.lock.acquire()
+
+        try :
+            if not self.f :
+                if dirname(self.fname) and not isdir(dirname(self.fname)) :
+                    os.makedirs(dirname(self.fname))
+
+                self.f = open(self.fname, 'a')
+
+            self.f.write(json.dumps(record, sort_keys=True, separators=(',', ':')) + '\n')
+            self.f.flush()
+
+        finally :
+            self.lock.release()
+
+# build and align use more than one work queue, they all write to the same file
+_writers = {}
+_writers_lock = threading.Lock()
+
+def metrics_writer() :
+    fname = get_metrics()
+
+    if not fname :
+        return None
+
+    _writers_lock.acquire()
+
+    try :
+        if fname not in _writers :
+            _writers[fname] = MetricsWriter(fname)
+
+        return _writers[fname]
+
+    finally :
+        _writers_lock.release()
+
+def metrics_files() :
+    return sorted(glob.glob(join(METRICS_DIR, '*' + METRICS_EXT)))
+
+# records from the files, sorted by the time the job finished, a line that
+# was only partly written (e.g. glutton was killed) is ignored
+def read_metrics(fnames) :
+    log = get_log()
+    records = []
+
+    for fname in fnames :
+        try :
+            f = open(fname)
+
+        except IOError, ioe :
+            raise MetricsError("could not read %s (%s)" % (fname, str(ioe)))
+
+        with f :
+            for lineno,line in enumerate(f, start=1) :
+                try :
+                    records.append(json.loads(line))
+
+                except ValueError :
+                    log.warn("ignoring corrupt record on line %d of %s" % (lineno, fname))
+
+    records.sort(key=lambda r : r['time'])
+
+    return records
+
+def _input_size(r) :
+    return sum([ i['total'] for i in r['inputs'].values() ])
+
+def _mb(kb) :
+    return "%.1f" % (kb / 1024.0)
+
+def _seconds(s) :
+    return "%.1f" % s
+
+def _by_jobtype(records) :
+    data = []
+    jobtypes = collections.defaultdict(list)
+
+    for r in records :
+        jobtypes[r['job']].append(r)
+
+    for jobtype in sorted(jobtypes) :
+        rs = jobtypes[jobtype]
+        wall = sum([ r['wall'] for r in rs ])
+        cpu = sum([ r['cpu'] for r in rs ])
+
+        data.append((jobtype,
+                     len(rs),
+                     len([ r for r in rs if r['state'] == 'SUCCESS' ]),
+                     len([ r for r in rs if r['state'] == 'FAIL' and not r['speculative'] ]),
+                     len([ r for r in rs if r['attempt'] > 1 ]),
+                     _seconds(wall),
+                     _seconds(cpu),
+                     "%.2f" % (cpu / wall if wall else 0.0),
+                     _mb(max([ r['maxrss'] for r in rs ]))))
+
+    pretty_print_table(('job', 'runs', 'succeeded', 'failed', 'retries', 'wall (s)', 'cpu (s)', 'cpu/wall', 'max rss (mb)'), data)
+
+def _slowest(records, top) :
+    data = []
+
+    for r in sorted(records, key=lambda r : r['wall'], reverse=True)[:top] :
+        data.append((r['job'],
+                     r['name'] or '-',
+                     r['state'] if not r['reason'] else "%s (%s)" % (r['state'], r['reason']),
+                     _seconds(r['wall']),
+                     _seconds(r['predicted']) if r['predicted'] else '-',
+                     _seconds(r['cpu']),
+                     _mb(r['maxrss']),
+                     r['threads'],
+                     _input_size(r)))
+
+    pretty_print_table(('job', 'name', 'state', 'wall (s)', 'predicted (s)', 'cpu (s)', 'max rss (mb)', 'threads', 'residues'), data)
+
+# files and bytes jobs wrote to their scratch directories in each phase
+# (see Scratch.measure()) and how many jobs had them on the fast filesystem
+def _scratch(records) :
+    data = []
+    jobtypes = collections.defaultdict(list)
+
+    for r in records :
+        if r.get('scratch') :
+            jobtypes[r['job']].append(r['scratch'])
+
+    for jobtype in sorted(jobtypes) :
+        rs = jobtypes[jobtype]
+        phases = sorted(set([ p for s in rs for p in s if p != 'fast' ]))
+
+        for phase in phases :
+            ps = [ s[phase] for s in rs if phase in s ]
+
+            data.append((jobtype,
+                         phase,
+                         len(ps),
+                         sum([ p['files'] for p in ps ]),
+                         _mb(sum([ p['bytes'] for p in ps ]) / 1024.0),
+                         _mb(max([ p['bytes'] for p in ps ]) / 1024.0),
+                         len([ s for s in rs if s['fast'] ])))
+
+    if data :
+        pretty_print_table(('job', 'phase', 'jobs', 'files', 'written (mb)', 'max (mb)', 'fast'), data)
+
+# jobs and residues finished in each interval, and the average number of
+# jobs running at once
+def _throughput(records, interval) :
+    start = min([ r['time'] - r['wall'] for r in records ])
+    end = max([ r['time'] for r in records ])
+
+    num_intervals = int((end - start) / interval) + 1
+    finished = [0] * num_intervals
+    residues = [0] * num_intervals
+    busy = [0.0] * num_intervals
+
+    for r in records :
+        i = int((r['time'] - start) / interval)
+        finished[i] += 1
+        residues[i] += _input_size(r)
+
+        # the time the job was running in each interval it overlaps
+        t = r['time'] - r['wall']
+
+        for j in range(int((t - start) / interval), i + 1) :
+            busy[j] += max(0.0, min(r['time'], start + ((j + 1) * interval)) - max(t, start + (j * interval)))
+
+    data = []
+
+    for i in range(num_intervals) :
+        data.append(("+%s" % duration_str(i * interval),
+                     finished[i],
+                     residues[i],
+                     "%.1f" % (residues[i] / float(interval)),
+                     "%.2f" % (busy[i] / interval)))
+
+    pretty_print_table(('from start', 'jobs finished', 'residues', 'residues/s', 'jobs running'), data)
+
+def summarise(records, top=10, interval=600) :
+    if not records :
+        print "no jobs recorded"
+        return
+
+    _by_jobtype(records)
+    _slowest(records, top)
+    _scratch(records)
+    _throughput(records, interval)
@@ -0,0 +1,224 @@
+import os
+import json
+import errno
+import threading
+
+from os.path import join, getsize
+
+from glutton.utils import get_log, check_dir
+
+
+# the files pagan creates for each gene family are appended to a pack file
+# instead of being copied into the alignments directory, large projects
+# would otherwise have hundreds of thousands of small files
+#
+# like the journals (see glutton/journal.py), each process appends to its own
+# pack, the data for a result is written before its line in the pack's index
+# (one json value per line: name, extension -> [offset, length]), so a result
+# is only seen once all of it is on disk, a line that was only partly written
+# or refers to data past the end of the pack is ignored
+#
+# results are named after their gene family, if a family was aligned more
+# than once (e.g. by a process whose lease expired) only one copy is used
+
+PACK_DIR = 'packs'
+PACK_EXT = '.pack'
+INDEX_EXT = '.index'
+PACK_NAME = 'glutton%s'
+
+# in the order they are written to the pack
+ALIGNMENT_EXTS = ('protein', 'nucleotide', 'queries', 'reference', 'tree')
+
+class PackError(Exception) :
+    pass
+
+# packs from a previous run, e.g. when the project's progress files are
+# discarded because the reference changed
+def remove_packs(directory) :
+    if not os.path.isdir(directory) :
+        return
+
+    for f in os.listdir(directory) :
+        if f.endswith(PACK_EXT) or f.endswith(INDEX_EXT) :
+            os.remove(join(directory, f))
+
+class PackWriter(object) :
+    def __init__(self, directory, owner) :
+        self.directory = directory
+        self.owner = owner
+        self.log = get_log()
+
+        self.lock = threading.Lock()
+        self.pack = None
+        self.index = None
+
+        check_dir(self.directory, create=True)
+
+    @property
+    def pack_fname(self) :
+        return join(self.directory, self.owner + PACK_EXT)
+
+    @property
+    def index_fname(self) :
+        return join(self.directory, self.owner + INDEX_EXT)
+
+    # files is extension -> filename, the result is on disk once this returns
+    # (unless sync is False)
+    def append(self, name, files, sync=True) :
+        self.lock.acquire()
+
+        try :
+            if not self.pack :
+                self.pack = open(self.pack_fname, 'ab')
+                self.index = open(self.index_fname, 'a')
+
+            self.pack.seek(0, os.SEEK_END)
+            offset = self.pack.tell()
+            entry = {}
+
+            for ext in ALIGNMENT_EXTS :
+                if ext not in files :
+                    continue
+
+                with open(files[ext], 'rb') as f :
+                    data = f.read()
+
+                self.pack.write(data)
+                entry[ext] = [ offset, len(data) ]
+                offset += len(data)
+
+            self.pack.flush()
+
+            if sync :
+                os.fsync(self.pack.fileno())
+
+            self.index.write(json.dumps([ name, entry ], separators=(',', ':')) + '\n')
+            self.index.flush()
+
+            if sync :
+                os.fsync(self.index.fileno())
+
+        finally :
+            self.lock.release()
+
+    def close(self) :
+        self.lock.acquire()
+
+        try :
+            if self.pack :
+                self.pack.close()
+                self.index.close()
+                self.pack = self.index = None
+
+        finally :
+            self.lock.release()
+
+# every pack in the directory, results can be read by name (random access)
+# or one after the other in the order they are in each pack (streaming)
+class PackReader(object) :
+    def __init__(self, directory) :
+        self.directory = directory
+        self.log = get_log()
+
+        self.entries = {}   # name -> (pack filename, extension -> (offset, length))
+        self.files = {}     # pack filename -> open file
+
+        if os.path.isdir(self.directory) :
+            for f in sorted(os.listdir(self.directory)) :
+                if f.endswith(INDEX_EXT) :
+                    self._read_index(join(self.directory, f))
+
+    def _read_index(self, index_fname) :
+        pack_fname = index_fname[:-len(INDEX_EXT)] + PACK_EXT
+
+        try :
+            size = getsize(pack_fname)
+            data = open(index_fname).read()
+
+        except (OSError, IOError), e :
+            if e.errno != errno.ENOENT :
+                raise
+
+            self.log.warn("ignoring %s, could not find %s" % (index_fname, pack_fname))
+            return
+
+        # the last line might not be finished yet
+        for line in data[:data.rfind('\n') + 1].splitlines() :
+            try :
+                name, entry = json.loads(line)
+
+            except ValueError :
+                self.log.warn("ignoring corrupt record in %s" % index_fname)
+                continue
+
+            if any([ (offset + length) > size for offset,length in entry.values() ]) :
+                self.log.warn("ignoring %s in %s, the pack is truncated" % (name, index_fname))
+                continue
+
+            self.entries[name] = (pack_fname, entry)
+
+    def __contains__(self, name) :
+        return name in self.entries
+
+    def __len__(self) :
+        return len(self.entries)
+
+    def names(self) :
+        return self.entries.keys()
+
+    def extensions(self, name) :
+        return self.entries[name][1].keys()
+
+    def _open(self, pack_fname) :
+        if pack_fname not in self.files :
+            self.files[pack_fname] = open(pack_fname, 'rb')
+
+        return self.files[pack_fname]
+
+    # the contents of one file of a result, None if the result does not have it
+    def read(self, name, ext) :
+        pack_fname, entry = self.entries[name]
+
+        if ext not in entry :
+            return None
+
+        offset, length = entry[ext]
+
+        f = self._open(pack_fname)
+        f.seek(offset)
+
+        return f.read(length)
+
+    # (name, contents) for every result with a file with the extension, in
+    # the order they are stored in so each pack is read from start to end
+    def stream(self, ext) :
+        order = sorted([ (pack_fname, entry[ext][0], name) for name,(pack_fname,entry) in self.entries.iteritems() if ext in entry ])
+
+        for pack_fname, offset, name in order :
+            yield name, self.read(name, ext)
+
+    # write results out as separate files (name.extension), as they were
+    # before packs, returns the number of files written
+    def export(self, directory, names=None) :
+        missing = [ name for name in (names or []) if name not in self.entries ]
+
+        if missing :
+            raise PackError("not found in %s: %s" % (self.directory, ' '.join(missing)))
+
+        check_dir(directory, create=True)
+        count = 0
+
+        for name in sorted(names if names is not None else self.entries) :
+            for ext in self.extensions(name) :
+                with open(join(directory, "%s.%s" % (name, ext)), 'wb') as f :
+                    f.write(self.read(name, ext))
+
+                count += 1
+
+        return count
+
+    def close(self) :
+        for f in self.files.values() :
+            f.close()
+
+        self.files = {}
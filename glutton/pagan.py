@@ -36,8 +36,9 @@ class Pagan(ExternalTool) :
     def output_filenames(self, outfile) :
         return [ outfile + i for i in ('.codon.fas', '.fas', '') ] if outfile else []
 
-    def run(self, queries_fname, out_fname, alignment_fname, tree_fname=None, min_identity=0.5, min_overlap=0.1) :
-        tmpdir = tempfile.mkdtemp()
+    # temp_dir is removed by the caller, otherwise a temporary directory is made
+    def run(self, queries_fname, out_fname, alignment_fname, tree_fname=None, min_identity=0.5, min_overlap=0.1, threads=1, temp_dir=None) :
+        tmpdir = temp_dir or tempfile.mkdtemp()
         
         parameters = [
                       "--ref-seqfile",  alignment_fname,
@@ -49,7 +50,7 @@ class Pagan(ExternalTool) :
                       "--min-query-overlap", str(min_overlap),
                       "--min-query-identity", str(min_identity),
                       "--translate",
-                      "--threads", "1"
+                      "--threads", str(threads)
                      ]
 
         if tree_fname :
@@ -61,6 +62,8 @@ class Pagan(ExternalTool) :
 
         returncode, output = self._execute(parameters, self.output_filenames(out_fname))
 
+        if temp_dir :
+            return returncode
 
         rm_f(glob(join(tmpdir, "q*.fas")) + glob(join(tmpdir, "t*.fas")))
 
@@ -1,37 +1,100 @@
 import sys
 import threading
-import Queue
+import heapq
 import time
 import itertools
 import os
+import errno
+import fcntl
 import signal
+import multiprocessing
 
 from glutton.job import Job, JobError
-from glutton.utils import get_log, num_threads
+from glutton.base import kill_running_programs
+from glutton.remote import Coordinator, RemoteError
+from glutton.utils import get_log, num_threads, get_executor, get_listen, duration_str, get_retries, get_speculate
+from glutton.costmodel import makespan
+from glutton.metrics import metrics_writer
 
 
 class WorkQueueError(Exception) :
     pass
 
+# put on the queue by join() (after all the jobs) and stop() (before them)
+# to tell the worker threads to exit, they are left on the queue for the next
+# worker to see
+_END  = (float('inf'),  -1, None)
+_STOP = (float('-inf'), -1, None)
+
+# jobs are not copied (see _speculate()) until they have run for at least this 
+# long, however short they were predicted to be
+SPECULATE_MIN = 60
+
+# a handler rather than SIG_IGN, because SIG_IGN would be inherited by the 
+# programs the jobs run, stop() sends SIGINT to each worker process to kill 
+# the programs it is running
+def _init_worker_process() :
+    signal.signal(signal.SIGINT, lambda signum, frame : kill_running_programs())
+
 class WorkQueue(object):
-    def __init__(self, qtimeout=1, maxsize=0):
+    def __init__(self, maxsize=0, costmodel=None):
 
         if maxsize == 0 :
             maxsize = num_threads() * 2
 
         self.log = get_log()
 
-        self.q = Queue.Queue(maxsize)
+        # jobs with the largest predicted cost are run first, callers should 
+        # also enqueue in that order as only maxsize jobs are queued at a time
+        #
+        # the lock is reentrant because stop() is called from signal handlers,
+        # which can interrupt the main thread while it is in enqueue()
+        self.q = []
+        self.maxsize = maxsize
+        self.num_queued = 0
+        self.cv = threading.Condition(threading.RLock())
+        self.costmodel = costmodel
+        self.metrics = metrics_writer()
+        self.dispatched = []        # predicted cost of each job, in the order they started
+        self.enqueue_counter = itertools.count()
+        self.start_time = None
+
+        # each worker runs one job at a time, but jobs can use more than one
+        # core, so the number of cores in use is tracked separately
+        self.cores = num_threads()
+        self.cores_free = self.cores
+        self.cores_waiting = 0
+        self.running_jobs = {}      # id(job) -> (predicted end time, threads)
+        self.cores_cv = threading.Condition()
+
+        self.pool = self._init_pool(num_threads()) if get_executor() == 'process' else None
         self.workers = self._init_workers(num_threads())
-        self.q_timeout = qtimeout
+        self.workers_alive = len(self.workers)
+        self.remotes = []           # connections to workers on other machines
+        self.remote_running = 0
         self.running = False
         self.no_more_jobs = False
+        self.producer_waiting = False
+
+        # the main thread cannot wait on a lock and still handle ctrl-C, so it 
+        # waits by reading from a pipe that worker threads write to instead
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        fcntl.fcntl(self.wakeup_w, fcntl.F_SETFL, fcntl.fcntl(self.wakeup_w, fcntl.F_GETFL) | os.O_NONBLOCK)
         
         self.jobs_completed = 0
         self.jobs_counter = itertools.count(start=1)
 
+        # failed jobs are put back on the queue after a delay, and idle workers
+        # can race copies of jobs that are taking much longer than predicted
+        self.retries, self.retry_delay = get_retries()
+        self.retrying = []          # timers that will put a job back on the queue
+        self.speculate = get_speculate()
+        self.active = {}            # id(job) -> (start time, job) for jobs running in this process
+
         self.start()
 
+        self.coordinator = Coordinator(get_listen(), self) if get_listen() else None
+
 #    def _introspect_cores(self) :
 #        return cpu_count()
 
@@ -50,111 +113,538 @@ class WorkQueue(object):
 
         return tmp
 
+    # each worker thread hands its job to the pool and waits, so callbacks
+    # are still called from the worker threads in this process
+    #
+    # this needs to be created before any threads are started, the processes 
+    # are forked and only the calling thread exists in the children
+    def _init_pool(self, numworkers) :
+        self.log.info("queue using %d process%s" % (numworkers, "" if numworkers == 1 else "es"))
+
+        return multiprocessing.Pool(numworkers, _init_worker_process)
+
+    def _close_pool(self, terminate=False) :
+        if not self.pool :
+            return
+
+        if terminate :
+            self.pool.terminate()
+        else :
+            self.pool.close()
+
+        self.pool.join()
+        self.pool = None
+
     def start(self):
         self.running = True
+        self.start_time = time.time()
         
         for t in self.workers:
             t.start()
     
         self.log.debug("queue started")
 
-    # block until the currently running jobs complete
+    # block until the currently running jobs complete, the programs they are
+    # running are sent SIGINT so this should not take long
     def stop(self):
         self.log.debug("queue stopping...")
         
         if not self.running :
             return
 
+        self._put(_STOP)
+        self._close_coordinator()
+
+        self.cv.acquire()
+
+        for t in self.retrying :
+            t.cancel()
+
+        self.retrying = []
+        self.cv.release()
+
+        self.cores_cv.acquire()
         self.running = False
+        self.cores_cv.notify_all()
+        self.cores_cv.release()
 
-        for t in self.workers:
-            while True :
-                t.join(0.5)
+        if self.pool :
+            for p in self.pool._pool :
+                try :
+                    os.kill(p.pid, signal.SIGINT)
+
+                except OSError :
+                    pass
+        else :
+            kill_running_programs()
+
+        self.cv.acquire()
 
-                if not t.is_alive() :
-                    break
+        for r in self.remotes :
+            r.abort()
 
-                self.log.debug("%s did not exit, resending SIGINT to process group..." % t.name)
-                os.killpg(0, signal.SIGINT)
+        self.cv.release()
+
+        self._wait_for_workers()
+        self._close_pool(terminate=True)
+
+        if self.costmodel :
+            self.costmodel.save()
     
         self.log.debug("queue stopped")
 
+    # block until all the jobs have been run
     def join(self) :
-        # calling join causes the calling thread to try and 
-        # acquire the lock in self.q, so poll instead so the
-        # user can still do a ctrl-C
         self.log.debug("queue joined")
-        self.no_more_jobs = True
 
-        #while True :
-        #    if self.q.empty() :
-        #        self.log.debug("queue is now empty")
-        #        break
-        #
-        #    time.sleep(1)
-        #
-        #self.q.join() # this makes ctrl-C impossible...
-        #self.log.debug("queue drained")
+        self.cv.acquire()
+        self.no_more_jobs = True
+        self.cv.release()
 
-        for t in self.workers:
-            while True :
-                t.join(0.5)
+        self._put(_END)
+        self._close_coordinator()
+        self._wait_for_workers()
+        self._close_pool()
 
-                if not t.is_alive() :
-                    break
+        self.running = False
 
         self.log.debug("queue drained")
 
+        self._report()
+
+    def _wait_for_workers(self) :
+        while True :
+            self.cv.acquire()
+            alive = self.workers_alive
+            self.cv.release()
+
+            if not alive :
+                break
+
+            self._sleep()
+
+        for t in self.workers :
+            t.join()
+
+        self._close_wakeup()
+
+    def _close_coordinator(self) :
+        if self.coordinator :
+            self.coordinator.close()
+            self.coordinator = None
+
+    # block the calling thread until a worker thread calls _wakeup(), this
+    # is a read so signal handlers still run while it is waiting
+    def _sleep(self) :
+        try :
+            os.read(self.wakeup_r, 4096)
+
+        except OSError, ose :
+            if ose.errno != errno.EINTR :
+                raise
+
+    def _wakeup(self) :
+        try :
+            os.write(self.wakeup_w, 'x')
+
+        except OSError, ose :
+            # the pipe is full, so there is already a wakeup to be read
+            if ose.errno != errno.EAGAIN :
+                raise
+
+    def _close_wakeup(self) :
+        if self.wakeup_r is None :
+            return
+
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+
+        self.wakeup_r = self.wakeup_w = None
+
+    def _report(self) :
+        elapsed = time.time() - self.start_time
+
+        if self.dispatched and (None not in self.dispatched) :
+            self.log.info("predicted makespan %s, actual %s (%d jobs, %d workers)" % \
+                (duration_str(makespan(self.dispatched, len(self.workers))), duration_str(elapsed), len(self.dispatched), len(self.workers)))
+
+        if self.costmodel :
+            self.costmodel.update()
+            self.costmodel.save()
+
     def size(self) :
-        return self.q.qsize()
+        return self.num_queued
+
+    # nothing is queued, running or waiting to be retried (or there are no
+    # workers left to run it)
+    def idle(self) :
+        self.cv.acquire()
+
+        try :
+            return not (self.num_queued or self.active or self.remote_running or self.retrying) or not self.workers_alive
+
+        finally :
+            self.cv.release()
+
+    # jobs get as many cores as they can use, up to an even share of the free
+    # cores between the jobs that are still to start, while jobs are still being
+    # enqueued this is a single core each, as it drains the last jobs get more
+    def _acquire_cores(self, work) :
+        self.cores_cv.acquire()
+
+        try :
+            self.cores_waiting += 1
+            threads = 0
+
+            while self.running :
+                if self.cores_free >= 1 :
+                    threads = self._plan_threads(work)
+
+                    if threads :
+                        break
+
+                self.cores_cv.wait()
+
+            self.cores_waiting -= 1
+
+            if threads :
+                self.cores_free -= threads
+                self.running_jobs[id(work)] = ((time.time() + (work.predicted / threads)) if work.predicted else None, threads)
+
+        finally :
+            self.cores_cv.release()
+
+        return threads
 
-    # block until the queue is drained
-#    def done(self) :
-#        self.no_more_jobs = True
-#
-#        for t in self.workers :
-#            t.join()
-#
-#        self.log.debug("queue drained")
+    # number of threads to start work with now, or 0 if it would finish sooner
+    # by waiting for running jobs to free up their cores (only considered for
+    # the last job, using the cost model's predictions and assuming the job
+    # scales linearly)
+    def _plan_threads(self, work) :
+        # until the caller has enqueued everything the queue could be empty
+        # just because the workers are keeping up
+        if not self.no_more_jobs :
+            return 1
+
+        pending = self.num_queued + self.cores_waiting - 1
+        share = max(1, min(work.max_threads(), self.cores_free / (pending + 1)))
+
+        if pending or (not work.predicted) or (share == work.max_threads()) :
+            return share
+
+        running = sorted(self.running_jobs.values())
+
+        if None in [ end for end,threads in running ] :
+            return share
+
+        now = time.time()
+        cores = self.cores_free
+        best = now + (work.predicted / share)
+
+        for end,threads in running :
+            cores += threads
+
+            if (max(end, now) + (work.predicted / min(work.max_threads(), cores))) < best :
+                return 0
+
+        return share
+
+    def _release_cores(self, work) :
+        self.cores_cv.acquire()
+        self.cores_free += work.threads
+        del self.running_jobs[id(work)]
+        self.cores_cv.notify_all()
+        self.cores_cv.release()
 
     def enqueue(self, j):
         self.log.debug("enqueuing %s" % str(j))
         
         assert isinstance(j, Job)
 
+        j.retries = self.retries
+
+        # most expensive first, then in the order they were enqueued
+        self._put((-(j.predicted or 0.0), self.enqueue_counter.next(), j), block=True)
+
+    def _put(self, item, block=False) :
         while True :
+            self.cv.acquire()
+
             try :
-                self.q.put(j, timeout=3600)
+                # (if every worker thread has died, nothing will make room)
+                if (not block) or (not self.running) or (not self.workers_alive) or (self.num_queued < self.maxsize) :
+                    heapq.heappush(self.q, item)
+
+                    self.producer_waiting = False
+
+                    if item[-1] is not None :
+                        self.num_queued += 1
+                        self.cv.notify()
+                    else :
+                        self.cv.notify_all()
+
+                    return
+
+                self.producer_waiting = True
+
+            finally :
+                self.cv.release()
+
+            self._sleep()
+
+    def _get(self) :
+        self.cv.acquire()
+
+        try :
+            while (not self.q) or (self.q[0] is _END) :
+                # while a remote worker is running a job, it could fail and
+                # the job be put back on the queue, the same for jobs that
+                # are waiting to be retried
+                if self.q and not (self.remote_running or self.retrying) :
+                    copy,timeout = self._speculate()
+
+                    if copy :
+                        return copy
+
+                    # nothing running could become a straggler
+                    if timeout is None :
+                        break
+
+                    self.cv.wait(timeout)
+                else :
+                    self.cv.wait()
+
+            if self.q[0][-1] is None :
+                return None
+
+            item = heapq.heappop(self.q)
+            self.num_queued -= 1
+
+            if self.producer_waiting :
+                self._wakeup()
+
+            return item[-1]
+
+        finally :
+            self.cv.release()
+
+    # called by the coordinator for each connection from a remote worker
+    def add_remote_worker(self, remote) :
+        self.cv.acquire()
+
+        try :
+            if not self.running :
+                remote.close()
+                return
+
+            t = threading.Thread(target=self._consume_remote, args=(remote,))
+            t.setDaemon(True)
+
+            self.remotes.append(remote)
+            self.workers.append(t)
+            self.workers_alive += 1
+
+        finally :
+            self.cv.release()
+
+        self.log.info("remote worker %s connected" % str(remote))
+
+        t.start()
+
+    def _consume_remote(self, remote) :
+        try :
+            self._run_remote_jobs(remote)
+
+        finally :
+            remote.close()
+
+            self.cv.acquire()
+            self.remotes.remove(remote)
+            self.workers_alive -= 1
+            self.cv.release()
+
+            self._wakeup()
+
+        self.log.debug("remote worker %s disconnected" % str(remote))
+
+    def _run_remote_jobs(self, remote) :
+        while True :
+            work = self._get()
+
+            if not work :
+                break
+
+            work.threads = 1
+
+            self.cv.acquire()
+            self.remote_running += 1
+            self.cv.release()
+
+            self.log.debug("starting %s on %s" % (str(work), str(remote)))
+            self.dispatched.append(work.predicted)
+
+            try :
+                work.run(remote=remote)
+
+            except RemoteError, re :
+                if self.running :
+                    self.log.warn("%s, running %s again" % (str(re), str(work)))
+                    work.state = Job.QUEUED
+                    self._put((-(work.predicted or 0.0), self.enqueue_counter.next(), work))
+
                 break
 
-            except Queue.Full :
-                pass
+            finally :
+                remote.cleanup()
+
+                self.cv.acquire()
+                self.remote_running -= 1
+                self.cv.notify_all()
+                self.cv.release()
+
+            self._record(work)
+
+            if work.state == Job.QUEUED :
+                self._requeue(work)
+                continue
+
+            if not self._job_done(work) :
+                break
 
     def _consume_queue(self):
         self.log.debug("threading starting...")
 
-        while self.running :
+        try :
+            self._run_jobs()
+
+        finally :
+            self.cv.acquire()
+            self.workers_alive -= 1
+            self.cv.release()
+
+            self._wakeup()
+
+        self.log.debug("thread exiting...")
+
+    def _run_jobs(self) :
+        while True :
+            work = self._get()
+
+            if not work :
+                self.log.debug("no more jobs...")
+                break
+
+            work.threads = self._acquire_cores(work)
+
+            if not work.threads :
+                break
+
+            self.log.debug("starting %s (%d thread%s)" % (str(work), work.threads, "" if work.threads == 1 else "s"))
+            self.dispatched.append(work.predicted)
+
+            self.cv.acquire()
+            self.active[id(work)] = (time.time(), work)
+            self.cv.release()
+
             try :
-                self.log.debug("q.get()")
-                work = self.q.get(timeout=self.q_timeout)
+                work.run(self.pool)
 
-            except Queue.Empty, qe:
-                if self.no_more_jobs :
-                    self.log.debug("no more jobs...")
-                    break
+            finally :
+                self._release_cores(work)
 
-                continue
+                # workers waiting to copy stragglers check if there is anything left to do
+                self.cv.acquire()
+                del self.active[id(work)]
+                self.cv.notify_all()
+                self.cv.release()
 
-            self.log.debug("starting %s" % str(work))
-            work.run()
+            self._record(work)
+
+            if work.state == Job.QUEUED :
+                self._requeue(work)
+                continue
 
-            if work.terminated() :
-                self.log.warn("job was terminated, bailing out...")
+            if not self._job_done(work) :
                 break
 
-            self.log.debug("completed %s %s" % (str(work), work.state_str()))
-            self.q.task_done()
-            self.jobs_completed = self.jobs_counter.next()
+    # every run of every job, including ones that will be retried
+    def _record(self, work) :
+        if self.metrics :
+            self.metrics.write(work.metrics())
 
-        self.log.debug("thread exiting...")
+    # a copy of a job that has been running for speculate times longer than 
+    # predicted, or None and how long until a running job could become one 
+    # (None if none can), called with cv held
+    def _speculate(self) :
+        if not self.speculate :
+            return None, None
+
+        now = time.time()
+        timeout = None
+
+        for start,work in self.active.values() :
+            if work.race or (not work.predicted) :
+                continue
+
+            limit = max(SPECULATE_MIN, self.speculate * work.predicted / work.threads)
+
+            if (now - start) < limit :
+                timeout = min(timeout, start + limit - now) if timeout is not None else (start + limit - now)
+                continue
+
+            copy = work.speculate()
+
+            if copy :
+                self.log.warn("%s has run for %s (predicted %s), starting a copy" % \
+                    (str(work), duration_str(now - start), duration_str(work.predicted / work.threads)))
+                return copy, None
+
+        return None, timeout
+
+    # put a failed job back on the queue, waiting longer after each attempt
+    def _requeue(self, work) :
+        delay = self.retry_delay * (2 ** (work.attempts - 1))
+
+        self.log.warn("%s failed, running it again in %s (attempt %d of %d)" % \
+            (str(work), duration_str(delay), work.attempts + 1, self.retries + 1))
+
+        def _put() :
+            self.cv.acquire()
+
+            try :
+                if t not in self.retrying :
+                    return
+
+                self.retrying.remove(t)
+                self._put((-(work.predicted or 0.0), self.enqueue_counter.next(), work))
+
+            finally :
+                self.cv.release()
+
+        t = threading.Timer(delay, _put)
+        t.setDaemon(True)
+
+        self.cv.acquire()
+        self.retrying.append(t)
+        self.cv.release()
+
+        t.start()
+
+    # returns False if the worker should stop
+    def _job_done(self, work) :
+        # multithreaded run times would skew the model, as would the run
+        # times of jobs that were racing each other
+        if self.costmodel and work.success() and (work.threads == 1) and (not work.race) :
+            features = work.features()
+
+            if features :
+                self.costmodel.add(work.jobtype, features, work.elapsed)
+
+        if work.terminated() :
+            self.log.warn("job was terminated, bailing out...")
+            return False
+
+        self.log.debug("completed %s %s" % (str(work), work.state_str()))
+        self.jobs_completed = self.jobs_counter.next()
 
+        return True
@@ -0,0 +1,396 @@
+import os
+import time
+import socket
+import hashlib
+import tempfile
+import threading
+
+from multiprocessing.connection import Listener, Client, AuthenticationError
+from os.path import join, basename, dirname
+
+from glutton.base import kill_running_programs
+from glutton.utils import get_log, tmpdir, rm_f
+
+
+# jobs can be run on other machines by starting 'glutton worker --connect HOST:PORT'
+# on them and running build or align with '--listen HOST:PORT'
+#
+# each worker opens one connection per thread, the work queue on the other end
+# treats each connection as another worker thread: it sends a job (pickled, the
+# same as for the process pool), the worker runs it and sends back the job's
+# state and the files it created, these are written to a local directory so
+# the callbacks can read them as if the job had been run locally
+#
+# files the job needs that are not part of the job (e.g. the blast database)
+# are fetched by the worker the first time they are needed and kept
+#
+# busy or not, workers send a heartbeat every HEARTBEAT seconds, if a worker
+# is not heard from for HEARTBEAT_TIMEOUT seconds its job is put back on the
+# queue for someone else to run
+
+HEARTBEAT = 10
+HEARTBEAT_TIMEOUT = 3 * HEARTBEAT
+RECONNECT = 5
+
+class RemoteError(Exception) :
+    pass
+
+# all messages are authenticated with a shared key, anyone that has it can
+# run programs on the workers (and jobs are unpickled on both sides), so 
+# there is no default
+def authkey() :
+    key = os.environ.get('GLUTTON_AUTHKEY')
+
+    if not key :
+        raise RemoteError("GLUTTON_AUTHKEY must be set to the same secret on the coordinator and the workers")
+
+    return key
+
+def _signature(fname) :
+    st = os.stat(fname)
+    return fname, st.st_size, st.st_mtime
+
+# coordinator side of a connection to a worker thread
+class RemoteWorker(object) :
+    def __init__(self, conn) :
+        self.conn = conn
+        self.log = get_log()
+        self.job_dir = None
+
+        if not self.conn.poll(HEARTBEAT_TIMEOUT) :
+            raise RemoteError("worker did not say hello")
+
+        msg = self.conn.recv()
+
+        if msg[0] != 'hello' :
+            raise RemoteError("worker did not say hello")
+
+        self.name = "%s:%d" % (msg[1], msg[2])
+
+    def __str__(self) :
+        return self.name
+
+    # returns the return code and updates the job, as job._run() would
+    def run_job(self, job) :
+        try :
+            return self._run_job(job)
+
+        except (EOFError, IOError, socket.error), e :
+            raise RemoteError("lost connection to %s (%s)" % (self.name, str(e)))
+
+    def _run_job(self, job) :
+        shared = [ _signature(f) for f in job.shared_files() ]
+        self.conn.send(('job', job, shared))
+
+        while True :
+            if not self.conn.poll(HEARTBEAT_TIMEOUT) :
+                raise RemoteError("no heartbeat from %s for %d seconds" % (self.name, HEARTBEAT_TIMEOUT))
+
+            msg = self.conn.recv()
+
+            if msg[0] == 'heartbeat' :
+                continue
+
+            # only the files the job needs are served
+            elif msg[0] == 'fetch' :
+                if msg[1] not in [ s[0] for s in shared ] :
+                    self.log.warn("%s asked for %s, which is not needed by %s" % (self.name, msg[1], str(job)))
+                    self.conn.send(('error', "%s is not a file needed by the job" % msg[1]))
+                    continue
+
+                with open(msg[1], 'rb') as f :
+                    self.conn.send(('file', f.read()))
+
+            elif msg[0] == 'result' :
+                break
+
+        ret, state, files = msg[1:]
+
+        self.job_dir = tempfile.mkdtemp(prefix='glutton', dir=tmpdir())
+
+        job.__dict__.update(state)
+        job.restore_files(files, self.job_dir)
+
+        return ret
+
+    # after the job has deleted its files
+    def cleanup(self) :
+        if not self.job_dir :
+            return
+
+        rm_f([ join(self.job_dir, f) for f in os.listdir(self.job_dir) ])
+        os.rmdir(self.job_dir)
+
+        self.job_dir = None
+
+    # wake up the thread waiting in run_job()
+    def abort(self) :
+        try :
+            socket.fromfd(self.conn.fileno(), socket.AF_INET, socket.SOCK_STREAM).shutdown(socket.SHUT_RDWR)
+
+        except (socket.error, IOError, OSError) :
+            pass
+
+    def close(self) :
+        try :
+            self.conn.send(('done',))
+
+        except (EOFError, IOError, socket.error) :
+            pass
+
+        self.conn.close()
+
+# accepts connections from workers and hands them to a work queue
+class Coordinator(object) :
+    def __init__(self, address, queue) :
+        self.queue = queue
+        self.log = get_log()
+        self.closed = False
+
+        try :
+            self.listener = Listener(address, authkey=authkey())
+
+        except socket.error, se :
+            raise RemoteError("could not listen on %s:%d (%s)" % (address[0], address[1], str(se)))
+
+        self.log.info("accepting remote workers on %s:%d" % self.listener.address)
+
+        self.thread = threading.Thread(target=self._accept)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _accept(self) :
+        while True :
+            try :
+                conn = self.listener.accept()
+
+            except (AuthenticationError, EOFError, IOError, socket.error), e :
+                if self.closed :
+                    break
+
+                self.log.warn("rejected connection from remote worker (%s)" % str(e))
+                continue
+
+            if self.closed :
+                conn.close()
+                break
+
+            try :
+                self.queue.add_remote_worker(RemoteWorker(conn))
+
+            except (RemoteError, EOFError, IOError, socket.error), e :
+                self.log.warn(str(e))
+                conn.close()
+
+    # accept() does not return when the listener is closed, so connect to it
+    def close(self) :
+        if self.closed :
+            return
+
+        self.closed = True
+
+        host,port = self.listener.address
+
+        try :
+            Client(('127.0.0.1' if host in ('', '0.0.0.0') else host, port), authkey=authkey()).close()
+
+        except (AuthenticationError, EOFError, IOError, socket.error) :
+            pass
+
+        self.thread.join()
+        self.listener.close()
+
+# files fetched from the coordinator, shared by all the threads in a worker,
+# files from the same directory are kept together so that a blast database
+# can still be found from the name of its fasta file
+class SharedFiles(object) :
+    def __init__(self) :
+        self.directory = tempfile.mkdtemp(prefix='glutton', dir=tmpdir())
+        self.files = {}     # coordinator's filename -> (signature, local filename)
+        self.lock = threading.Lock()
+
+    def get(self, signature, fetch) :
+        fname = signature[0]
+
+        self.lock.acquire()
+
+        try :
+            if fname in self.files and self.files[fname][0] == signature :
+                return self.files[fname][1]
+
+            d = join(self.directory, hashlib.sha1(dirname(fname)).hexdigest())
+
+            if not os.path.isdir(d) :
+                os.makedirs(d)
+
+            local = join(d, basename(fname))
+
+            data = fetch(fname)
+
+            with open(local, 'wb') as f :
+                f.write(data)
+
+            self.files[fname] = (signature, local)
+
+            return local
+
+        finally :
+            self.lock.release()
+
+    def cleanup(self) :
+        for signature,local in self.files.values() :
+            rm_f(local)
+
+        for d in os.listdir(self.directory) :
+            os.rmdir(join(self.directory, d))
+
+        os.rmdir(self.directory)
+
+# worker side of a connection
+class WorkerThread(object) :
+    def __init__(self, address, shared) :
+        self.address = address
+        self.shared = shared
+        self.log = get_log()
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _send(self, msg) :
+        self.lock.acquire()
+
+        try :
+            self.conn.send(msg)
+
+        finally :
+            self.lock.release()
+
+    def _fetch(self, fname) :
+        self._send(('fetch', fname))
+        msg = self.conn.recv()
+
+        if msg[0] == 'error' :
+            raise RemoteError(msg[1])
+
+        return msg[1]
+
+    def _heartbeat(self, conn) :
+        while True :
+            time.sleep(HEARTBEAT)
+
+            self.lock.acquire()
+
+            try :
+                if self.conn is not conn :
+                    break
+
+                conn.send(('heartbeat',))
+
+            except (IOError, socket.error) :
+                # the coordinator has gone, so there is no one to
+                # send the results of what is running to
+                self.log.warn("lost connection to %s:%d" % self.address)
+                kill_running_programs()
+                break
+
+            finally :
+                self.lock.release()
+
+    # run jobs until the coordinator has not been available for timeout seconds
+    def run(self, timeout) :
+        last_connected = time.time()
+
+        while True :
+            try :
+                conn = Client(self.address, authkey=authkey())
+
+            except (EOFError, IOError, socket.error), e :
+                if (time.time() - last_connected) > timeout :
+                    self.log.info("could not connect to %s:%d for %d seconds, exiting..." % (self.address[0], self.address[1], timeout))
+                    break
+
+                time.sleep(RECONNECT)
+                continue
+
+            except AuthenticationError :
+                self.log.error("%s:%d rejected the authentication key (see GLUTTON_AUTHKEY)" % self.address)
+                break
+
+            self.log.debug("connected to %s:%d" % self.address)
+
+            self.conn = conn
+
+            heartbeat = threading.Thread(target=self._heartbeat, args=(conn,))
+            heartbeat.setDaemon(True)
+            heartbeat.start()
+
+            try :
+                self._send(('hello', socket.gethostname(), os.getpid()))
+                self._serve()
+
+            except (EOFError, IOError, socket.error), e :
+                self.log.warn("lost connection to %s:%d (%s)" % (self.address[0], self.address[1], str(e)))
+
+            self.lock.acquire()
+            self.conn = None
+            self.lock.release()
+
+            conn.close()
+
+            last_connected = time.time()
+
+    def _serve(self) :
+        while True :
+            msg = self.conn.recv()
+
+            if msg[0] == 'done' :
+                break
+
+            job, shared = msg[1:]
+
+            self._send(self._run_job(job, shared))
+
+    def _run_job(self, job, shared) :
+        try :
+            job.localise(dict([ (s[0], self.shared.get(s, self._fetch)) for s in shared ]))
+
+        except RemoteError, re :
+            self.log.error("%s failed (%s)" % (str(job), str(re)))
+            return ('result', 1, job.__getstate__(), {})
+
+        self.log.debug("running %s" % str(job))
+
+        try :
+            ret = job._run()
+
+        except Exception, e :
+            self.log.error("%s failed (%s)" % (str(job), str(e)))
+            ret = 1
+
+        files = job.output_files()
+        job.cleanup()
+
+        return ('result', ret, job.__getstate__(), files)
+
+def worker(address, threads, timeout) :
+    log = get_log()
+
+    # raises RemoteError if there is no key
+    authkey()
+
+    shared = SharedFiles()
+
+    log.info("connecting to %s:%d with %d thread%s" % (address[0], address[1], threads, "" if threads == 1 else "s"))
+
+    workers = [ WorkerThread(address, shared) for _ in range(threads) ]
+
+    # the first runs in this thread, so that it is still interrupted by ctrl-C
+    for w in workers[1:] :
+        t = threading.Thread(target=w.run, args=(timeout,))
+        t.setDaemon(True)
+        t.start()
+
+    try :
+        workers[0].run(timeout)
+
+    finally :
+        shared.cleanup()
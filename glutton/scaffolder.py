@@ -1,8 +1,9 @@
 from sys import exit, stderr, stdout
 from glob import glob
 from os import abort
-from os.path import join, getsize, exists
+from os.path import join, getsize, exists, basename
 from collections import defaultdict
+from cStringIO import StringIO
 
 import re
 import operator
@@ -15,6 +16,7 @@ from glutton.utils import get_log, check_dir
 from glutton.info import GluttonInformation, GluttonParameters
 from glutton.db import GluttonDB
 from glutton.assembler_output import AssemblerOutput
+from glutton.pack import PackReader, PACK_DIR
 
 
 #from pycallgraph import PyCallGraph
@@ -328,6 +330,10 @@ class Scaffolder(object) :
         if pending != 0 :
             self.log.warn("%d alignments were not run!" % pending)
 
+        if failures != 0 :
+            reasons = self.info.failure_reasons()
+            self.log.warn("%d alignments failed (%s)" % (failures, ', '.join([ "%s: %d" % (r, reasons[r]) for r in sorted(reasons) ])))
+
         self.assembler = AssemblerOutput(assembler_name)
 
         # e.g. query39806_orf1
@@ -358,11 +364,11 @@ class Scaffolder(object) :
     # read the alignment file and return a dictionary keyed on the gene name
     #   - there might be multiple orfs for a single query sequence, so keep a track of the best one
     #@profile
-    def read_alignment(self, fname) :
+    def read_alignment(self, fname, f) :
         tmp = defaultdict(dict)
         genes = []
 
-        for s in SeqIO.parse(fname, 'fasta') :
+        for s in SeqIO.parse(f, 'fasta') :
             if not s.description.startswith('query') :
                 gene_id     = s.description
                 gene_name   = self.db.get_genename_from_geneid(gene_id)
@@ -777,16 +783,18 @@ class Scaffolder(object) :
         counter = -1
         aligned_contigs = defaultdict(set)
 
-        alignment_files = glob(join(self.alignments_dir, 'glutton*.nucleotide'))
+        # projects aligned before pack files have an alignment file per gene family
+        pack = PackReader(join(self.alignments_dir, PACK_DIR))
+        alignment_files = [ f for f in glob(join(self.alignments_dir, 'glutton*.nucleotide')) if basename(f)[:-len('.nucleotide')] not in pack ]
 
         complete_files = 0
-        total_files = len(alignment_files)
+        total_files = len([ name for name in pack.names() if 'nucleotide' in pack.extensions(name) ]) + len(alignment_files)
 
         stderr.write("\rINFO processed %d / %d alignments " % (complete_files, total_files))
         stderr.flush()
 
-        for fname in alignment_files :
-            contigs, genes = self.read_alignment(fname)
+        for fname, f in self._alignments(pack, alignment_files) :
+            contigs, genes = self.read_alignment(fname, f)
             merged_contigs = defaultdict(dict)
 
             # for each gene, merge the contigs from the same input file
@@ -881,10 +889,22 @@ class Scaffolder(object) :
         stderr.write("\rINFO processed %d / %d alignments \n" % (complete_files, total_files))
         stderr.flush()
 
+        pack.close()
+
         self.log.info("created %d multiple sequence alignments" % (counter + 1))
 
         return aligned_contigs
 
+    # (name, file) for each nucleotide alignment, packed alignments are read
+    # in the order they were written
+    def _alignments(self, pack, alignment_files) :
+        for name, data in pack.stream('nucleotide') :
+            yield name, StringIO(data)
+
+        for fname in alignment_files :
+            with open(fname) as f :
+                yield fname, f
+
     def write_alignment(self, fname, alignment) :
         self.remove_common_gaps(alignment)
         with open(fname, 'w') as f :
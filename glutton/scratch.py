@@ -0,0 +1,227 @@
+import os
+import errno
+import shutil
+import socket
+import tempfile
+import threading
+import atexit
+
+from os.path import join, isdir
+
+from glutton.utils import get_log, get_scratch, tmpdir
+
+
+# each job gets its own scratch directory for the files it writes and the
+# programs it runs create, the files in it have fixed names (no mkstemp()
+# for each one) and it is removed in one go when the job is cleaned up
+#
+# directories are on the fast filesystem given to --scratch (by default
+# /dev/shm, i.e. memory) unless there is not enough space for what the job
+# is expected to need, then they are in tmpdir()
+#
+# each process puts its job directories inside one of its own, named with
+# the host and pid, directories left by processes that are no longer running
+# (e.g. killed with SIGKILL) are removed the next time glutton starts a job
+
+SCRATCH_PREFIX = 'glutton-scratch-'
+
+# space the fast filesystem must have left once a job's expected
+# usage is taken into account, as a fraction of its size
+SCRATCH_RESERVE = 0.2
+
+class ScratchError(Exception) :
+    pass
+
+# a job's directory, files and bytes are counted when measure() is called,
+# e.g. after the job writes its input files and after the program is run
+class Scratch(object) :
+    def __init__(self, directory, fast) :
+        self.directory = directory
+        self.fast = fast
+        self.phases = []    # (phase, files, bytes) created since the previous phase
+        self.files = 0
+        self.bytes = 0
+
+    def path(self, name) :
+        return join(self.directory, name)
+
+    def write(self, name, contents) :
+        with open(self.path(name), 'w') as f :
+            f.write(contents)
+
+        return self.path(name)
+
+    def mkdir(self, name) :
+        os.mkdir(self.path(name))
+        return self.path(name)
+
+    def measure(self, phase) :
+        files = 0
+        size = 0
+
+        for root, dirs, fnames in os.walk(self.directory) :
+            for f in fnames :
+                try :
+                    size += os.lstat(join(root, f)).st_size
+                    files += 1
+
+                except OSError :
+                    pass
+
+        self.phases.append((phase, files - self.files, size - self.bytes))
+        self.files = files
+        self.bytes = size
+
+    # for the metrics, phase -> { files, bytes }
+    def report(self) :
+        tmp = { 'fast' : self.fast }
+
+        for phase, files, size in self.phases :
+            tmp[phase] = { 'files' : files, 'bytes' : size }
+
+        return tmp
+
+    def remove(self) :
+        if not self.directory :
+            return
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = None
+
+class ScratchManager(object) :
+    def __init__(self, fast_dir, slow_dir) :
+        self.fast_dir = fast_dir
+        self.slow_dir = slow_dir
+        self.log = get_log()
+
+        self.lock = threading.Lock()
+        self.roots = {}     # parent directory -> our directory in it
+
+        self.hostname = socket.gethostname()
+        self.cleaned = False
+
+    def _root_name(self, pid) :
+        return "%s%s-%d" % (SCRATCH_PREFIX, self.hostname, pid)
+
+    def _root(self, parent) :
+        if parent not in self.roots :
+            root = join(parent, self._root_name(os.getpid()))
+
+            if not isdir(root) :
+                os.mkdir(root)
+
+            self.roots[parent] = root
+
+        return self.roots[parent]
+
+    def _has_space(self, size) :
+        try :
+            st = os.statvfs(self.fast_dir)
+
+        except OSError :
+            return False
+
+        return ((st.f_bavail * st.f_frsize) - size) >= (SCRATCH_RESERVE * st.f_blocks * st.f_frsize)
+
+    # a new directory for a job expected to write size bytes
+    def new(self, size=0) :
+        self.lock.acquire()
+
+        try :
+            if not self.cleaned :
+                self.cleanup_stale()
+                self.cleaned = True
+
+            fast = bool(self.fast_dir) and self._has_space(size)
+
+            try :
+                directory = tempfile.mkdtemp(dir=self._root(self.fast_dir if fast else self.slow_dir))
+
+            except OSError, ose :
+                raise ScratchError("could not create scratch directory (%s)" % str(ose))
+
+            return Scratch(directory, fast)
+
+        finally :
+            self.lock.release()
+
+    # remove directories left by processes on this host that have exited
+    def cleanup_stale(self) :
+        prefix = SCRATCH_PREFIX + self.hostname + '-'
+        removed = 0
+
+        for parent in set([ self.fast_dir, self.slow_dir ]) :
+            if not parent or not isdir(parent) :
+                continue
+
+            for f in os.listdir(parent) :
+                if not f.startswith(prefix) :
+                    continue
+
+                try :
+                    pid = int(f[len(prefix):])
+
+                except ValueError :
+                    continue
+
+                if (pid == os.getpid()) or _alive(pid) :
+                    continue
+
+                shutil.rmtree(join(parent, f), ignore_errors=True)
+                removed += 1
+
+        if removed :
+            self.log.info("removed %d scratch director%s left by glutton processes that are no longer running" % (removed, "y" if removed == 1 else "ies"))
+
+    def close(self) :
+        self.lock.acquire()
+
+        try :
+            for root in self.roots.values() :
+                shutil.rmtree(root, ignore_errors=True)
+
+            self.roots = {}
+
+        finally :
+            self.lock.release()
+
+def _alive(pid) :
+    try :
+        os.kill(pid, 0)
+
+    except OSError, ose :
+        return ose.errno == errno.EPERM
+
+    return True
+
+_manager = None
+_manager_pid = None
+_manager_lock = threading.Lock()
+
+# one per process, processes in a pool are forked after the parent's is
+# created, so they need their own
+def scratch_manager() :
+    global _manager, _manager_pid
+
+    _manager_lock.acquire()
+
+    try :
+        if _manager_pid != os.getpid() :
+            _manager = ScratchManager(get_scratch(), tmpdir())
+            _manager_pid = os.getpid()
+
+            # the directories of processes from a pool are removed too,
+            # they have exited by the time this is called
+            atexit.register(_close, _manager)
+
+        return _manager
+
+    finally :
+        _manager_lock.release()
+
+def _close(manager) :
+    if _manager_pid != os.getpid() :
+        return
+
+    manager.close()
+    manager.cleanup_stale()
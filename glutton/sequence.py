@@ -0,0 +1,111 @@
+import re
+import string
+import binascii
+
+
+# sequences are stored with 2 bits per base (A=0, C=1, G=2, T=3), anything that
+# is not one of these (N, other IUPAC codes, lowercase, gaps etc) is kept in a
+# side-table of (position, run) pairs, for ensembl CDS sequences this is almost
+# always empty
+#
+# packing and unpacking avoid looping over bases in python, digits are
+# converted to a byte string via a base 4 integer and bytes are converted
+# back to bases with a lookup table
+
+_BASES = 'ACGT'
+_other_regex = re.compile('[^ACGT]+')
+
+_TO_DIGITS = ''.join([ str(_BASES.index(chr(i))) if chr(i) in _BASES else '0' for i in range(256) ])
+_UNPACK = dict([ (chr(b), ''.join([ _BASES[(b >> shift) & 3] for shift in (6, 4, 2, 0) ])) for b in range(256) ])
+
+_COMPLEMENT = string.maketrans('ACGTUNRYKMSWBDHVacgtunrykmswbdhv', 'TGCAANYRMKSWVHDBtgcaanyrmkswvhdb')
+
+class PackedSequence(object) :
+    __slots__ = ('data', 'length', 'runs')
+
+    def __init__(self, s='') :
+        s = str(s)
+
+        self.length = len(s)
+        self.data = self._pack(s)
+        self.runs = tuple([ (m.start(), m.group()) for m in _other_regex.finditer(s) ]) or None
+
+    def _pack(self, s) :
+        if not s :
+            return ''
+
+        digits = s.translate(_TO_DIGITS)
+
+        if len(digits) % 4 :
+            digits += '0' * (4 - (len(digits) % 4))
+
+        return binascii.unhexlify('%0*x' % (len(digits) / 2, int(digits, 4)))
+
+    def __str__(self) :
+        s = ''.join(map(_UNPACK.__getitem__, self.data))[:self.length]
+
+        if not self.runs :
+            return s
+
+        tmp = []
+        prev = 0
+
+        for start,run in self.runs :
+            tmp.append(s[prev:start])
+            tmp.append(run)
+            prev = start + len(run)
+
+        tmp.append(s[prev:])
+
+        return ''.join(tmp)
+
+    def __repr__(self) :
+        return "PackedSequence('%s')" % str(self)
+
+    def __len__(self) :
+        return self.length
+
+    def __getitem__(self, i) :
+        if isinstance(i, slice) :
+            return str(self)[i]
+
+        if i < 0 :
+            i += self.length
+
+        if not (0 <= i < self.length) :
+            raise IndexError('sequence index out of range')
+
+        if self.runs :
+            for start,run in self.runs :
+                if start <= i < (start + len(run)) :
+                    return run[i - start]
+
+        return _UNPACK[self.data[i >> 2]][i & 3]
+
+    def __getslice__(self, i, j) :
+        return str(self)[i:j]
+
+    def __iter__(self) :
+        return iter(str(self))
+
+    def __eq__(self, other) :
+        if isinstance(other, PackedSequence) :
+            return (self.length, self.data, self.runs) == (other.length, other.data, other.runs)
+
+        return str(self) == other
+
+    def __ne__(self, other) :
+        return not self.__eq__(other)
+
+    def __hash__(self) :
+        return hash(str(self))
+
+    def __getstate__(self) :
+        return (self.data, self.length, self.runs)
+
+    def __setstate__(self, state) :
+        self.data, self.length, self.runs = state
+
+    def reverse_complement(self) :
+        return PackedSequence(str(self).translate(_COMPLEMENT)[::-1])
+
@@ -1,14 +1,20 @@
 from sys import stderr, exit
 import os
 import signal
+import time
 
-from glutton.utils import get_log
+from glutton.utils import get_log, num_threads
+from glutton.base import kill_running_programs
+from glutton.remote import worker, RemoteError
+from glutton.batch import BatchError, JobsEmitted, BatchResults, write_manifest, run_bundle
+from glutton.metrics import MetricsError, read_metrics, metrics_files, summarise, METRICS_DIR
 from glutton.ensembl_downloader import EnsemblDownloader, EnsemblDownloadError
 from glutton.table import pretty_print_table
-from glutton.db import GluttonDB, GluttonDBBuildError
+from glutton.db import GluttonDB, GluttonDBBuildError, GluttonDBFileError, GluttonDBError
 from glutton.aligner import Aligner
 from glutton.scaffolder import Scaffolder
 from glutton.info import GluttonParameters
+from glutton.pack import PackReader, PackError, PACK_DIR, PACK_NAME
 
 
 def list_command(args) :
@@ -59,12 +65,31 @@ def build_command(args) :
               args.release, 
               args.database,
               True, #not args.protein, 
-              args.download)
+              args.download,
+              args.cache,
+              int(args.cache_size * 1e9),
+              args.previous,
+              args.shard)
 
     except GluttonDBBuildError, nmgfe :
         log.fatal(nmgfe.message)
         exit(1)
 
+    except RemoteError, re :
+        log.fatal(str(re))
+        exit(1)
+
+    except BatchError, be :
+        log.fatal(str(be))
+        exit(1)
+
+    except JobsEmitted, je :
+        write_manifest(je.directory, 'build', { 'fname'      : os.path.abspath(gdb.filename),
+                                                'cache_dir'  : os.path.abspath(args.cache) if args.cache else None,
+                                                'cache_size' : int(args.cache_size * 1e9) })
+        _emitted(je)
+        return 0
+
     log.info("built database %s" % gdb.filename)
     
     return 0
@@ -72,6 +97,52 @@ def build_command(args) :
 def check_command(args) :
     return 0 if GluttonDB(args.gltfile).sanity_check(human_readable_summary=True, suppress_errmsg=True, show_all=args.show) else 1        
 
+def compact_command(args) :
+    log = get_log()
+    dst = args.compact_output if args.compact_output else args.gltfile
+
+    def _open_time(fname) :
+        start_time = time.time()
+        gdb = GluttonDB(fname)
+        return gdb, time.time() - start_time
+
+    before_size = os.path.getsize(args.gltfile)
+    gdb, before_time = _open_time(args.gltfile)
+
+    try :
+        gdb.compact(dst, args.alignment_compression, args.tree_compression, args.data_compression)
+
+    except GluttonDBFileError, gdfe :
+        log.fatal(str(gdfe))
+        exit(1)
+
+    after_size = os.path.getsize(dst)
+    gdb, after_time = _open_time(dst)
+
+    print ""
+    print "Filename:", dst
+    print ""
+    print "Size: %.1f MB -> %.1f MB (saved %.1f MB)" % (before_size / 1e6, after_size / 1e6, (before_size - after_size) / 1e6)
+    print "Open time: %.3fs -> %.3fs (saved %.3fs)" % (before_time, after_time, before_time - after_time)
+    print ""
+
+    return 0
+
+def merge_command(args) :
+    log = get_log()
+    gdb = GluttonDB()
+
+    try :
+        gdb.merge(args.output, args.shards)
+
+    except (GluttonDBError, GluttonDBFileError), e :
+        log.fatal(str(e))
+        exit(1)
+
+    log.info("merged %d shards into %s" % (len(args.shards), gdb.filename))
+
+    return 0
+
 def align_command(args) :
     #contigs = zip(args.contigs, args.label, args.species, args.bam) if args.contigs else []
 
@@ -83,7 +154,8 @@ def align_command(args) :
                     args.evalue,
                     args.batchsize,
                     args.identity,
-                    args.overlap)
+                    args.overlap,
+                    args.lease_time)
 
     def _cleanup(signal, frame) :
         print >> stderr, "Killed by user, cleaning up..."
@@ -93,7 +165,112 @@ def align_command(args) :
 
     signal.signal(signal.SIGINT, _cleanup)
 
-    align.align()
+    try :
+        align.align()
+
+    except (RemoteError, BatchError, GluttonDBError), e :
+        get_log().fatal(str(e))
+        exit(1)
+
+    except JobsEmitted, je :
+        write_manifest(je.directory, 'align', { 'top_level_directory' : os.path.abspath(args.project),
+                                                'reference_fname'     : os.path.abspath(args.reference),
+                                                'min_length'          : args.length,
+                                                'min_hitidentity'     : args.hitidentity,
+                                                'min_hitlength'       : args.hitlength,
+                                                'max_evalue'          : args.evalue,
+                                                'batch_size'          : args.batchsize,
+                                                'min_alignidentity'   : args.identity,
+                                                'min_alignoverlap'    : args.overlap,
+                                                'lease_time'          : args.lease_time })
+        _emitted(je)
+
+    return 0
+
+def _emitted(je) :
+    log = get_log()
+
+    log.info(str(je))
+    log.info("run each bundle with 'glutton run-job %s/N.jobs' (N = 1 to %d), then 'glutton collect %s'" % \
+        (je.directory, je.num_bundles, je.directory))
+
+def run_job_command(args) :
+    # programs are not in our process group, so do not see the ctrl-C
+    def _cleanup(signal, frame) :
+        kill_running_programs()
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGINT, _cleanup)
+
+    try :
+        run_bundle(args.bundle)
+
+    except BatchError, be :
+        get_log().fatal(str(be))
+        exit(1)
+
+    return 0
+
+def collect_command(args) :
+    log = get_log()
+
+    try :
+        results = BatchResults(args.directory)
+
+        if results.command == 'build' :
+            GluttonDB(results.arguments['fname']).collect(results, results.arguments['cache_dir'], results.arguments['cache_size'])
+
+        elif results.command == 'align' :
+            Aligner(**results.arguments).collect(results)
+
+    except (BatchError, GluttonDBBuildError), e :
+        log.fatal(str(e))
+        exit(1)
+
+    results.cleanup()
+
+    log.info("collected %d results from %d bundles" % (len(results), len(results.bundles)))
+
+    if results.not_run :
+        log.warn("%d bundles in %s have not been run" % (results.not_run, args.directory))
+
+    return 0
+
+def stats_command(args) :
+    log = get_log()
+    fnames = args.metrics_files or metrics_files()
+
+    if not fnames :
+        log.fatal("no metrics files given and none found in %s" % METRICS_DIR)
+        exit(1)
+
+    try :
+        records = read_metrics(fnames)
+
+    except MetricsError, me :
+        log.fatal(str(me))
+        exit(1)
+
+    log.info("read %d records from %d file%s" % (len(records), len(fnames), "" if len(fnames) == 1 else "s"))
+
+    summarise(records, args.top, args.interval)
+
+    return 0
+
+def worker_command(args) :
+    # programs are not in our process group, so do not see the ctrl-C
+    def _cleanup(signal, frame) :
+        kill_running_programs()
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGINT, _cleanup)
+
+    try :
+        worker(args.connect, num_threads(), args.timeout)
+
+    except RemoteError, re :
+        get_log().fatal(str(re))
+        exit(1)
 
     return 0
 
@@ -118,6 +295,30 @@ def scaffold_command(args) :
 
     return 0
 
+def export_command(args) :
+    log = get_log()
+    pack = PackReader(os.path.join(args.project, 'alignments', PACK_DIR))
+
+    if not len(pack) :
+        log.fatal("no alignments found in %s" % args.project)
+        exit(1)
+
+    names = [ PACK_NAME % famid for famid in args.families ] if args.families else None
+
+    try :
+        count = pack.export(args.output, names)
+
+    except PackError, pe :
+        log.fatal(str(pe))
+        exit(1)
+
+    finally :
+        pack.close()
+
+    log.info("wrote %d files for %d alignments to %s" % (count, len(names) if names else len(pack), args.output))
+
+    return 0
+
 def setup_command(args) :
     if args.setupcmd == 'add' :
         gp = GluttonParameters(args.project, create=True)
@@ -94,8 +94,108 @@ def set_threads(t) :
     global _glutton_threads
     _glutton_threads = t
 
-def tmpfasta(seq) :
-    fname = tmpfile()
+# 'thread' runs jobs in the worker threads, 'process' hands them to a 
+# pool of processes so the python side of each job is not limited by the GIL
+EXECUTORS = ('thread', 'process')
+
+_glutton_executor = 'thread'
+
+def get_executor() :
+    global _glutton_executor
+    return _glutton_executor
+
+def set_executor(e) :
+    global _glutton_executor
+
+    assert e in EXECUTORS
+
+    _glutton_executor = e
+
+# (host, port) that work queues accept remote workers on, see glutton/remote.py
+_glutton_listen = None
+
+def get_listen() :
+    global _glutton_listen
+    return _glutton_listen
+
+def set_listen(address) :
+    global _glutton_listen
+    _glutton_listen = address
+
+# (directory, seconds per bundle) if build and align should write their jobs
+# to a directory instead of running them, see glutton/batch.py
+_glutton_emit_jobs = None
+
+def get_emit_jobs() :
+    global _glutton_emit_jobs
+    return _glutton_emit_jobs
+
+def set_emit_jobs(directory, chunk_time) :
+    global _glutton_emit_jobs
+    _glutton_emit_jobs = (directory, chunk_time) if directory else None
+
+# wall-clock limits in seconds for the programs jobs run, by program name
+# (e.g. 'prank', 'pagan', 'blastx'), None applies to any program not listed
+_glutton_job_timeouts = {}
+
+def get_job_timeout(name) :
+    global _glutton_job_timeouts
+    return _glutton_job_timeouts.get(name, _glutton_job_timeouts.get(None))
+
+def set_job_timeouts(timeouts) :
+    global _glutton_job_timeouts
+    _glutton_job_timeouts = dict(timeouts)
+
+# how many times a failed job is run again and how long to wait before the
+# first retry (doubling each time), see glutton/queue.py
+_glutton_retries = (0, 30)
+
+def get_retries() :
+    global _glutton_retries
+    return _glutton_retries
+
+def set_retries(retries, delay) :
+    global _glutton_retries
+    _glutton_retries = (retries, delay)
+
+# jobs still running after this many times their predicted run time have a
+# copy started on an idle core, 0 to disable, see glutton/queue.py
+_glutton_speculate = 0
+
+def get_speculate() :
+    global _glutton_speculate
+    return _glutton_speculate
+
+def set_speculate(factor) :
+    global _glutton_speculate
+    _glutton_speculate = factor
+
+# directory on a fast filesystem for the files jobs create, None to use
+# tmpdir(), see glutton/scratch.py
+_glutton_scratch = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+
+def get_scratch() :
+    global _glutton_scratch
+    return _glutton_scratch
+
+def set_scratch(directory) :
+    global _glutton_scratch
+    _glutton_scratch = directory
+
+# JSON-lines file that a record of each job run is appended to, see glutton/metrics.py
+_glutton_metrics = None
+
+def get_metrics() :
+    global _glutton_metrics
+    return _glutton_metrics
+
+def set_metrics(fname) :
+    global _glutton_metrics
+    _glutton_metrics = fname
+
+# fname is for callers that have their own directory, see glutton/scratch.py
+def tmpfasta(seq, fname=None) :
+    fname = fname or tmpfile()
     
     with open(fname, 'w') as f :
         if isinstance(seq, list) :
@@ -106,6 +206,11 @@ def tmpfasta(seq) :
 
     return fname
 
+# fasta formatted records one at a time, e.g. for writing to a program's stdin
+def fasta_records(seqs) :
+    for s in seqs :
+        yield s.format('fasta')
+
 def tmpfasta_kill_n(seq) :
     fname = tmpfile()
 
@@ -122,6 +227,9 @@ def tmpfasta_kill_n(seq) :
 
 # returns count, total, min, max, mean, pop sd
 def _stats(dat) :
+    if not dat :
+        return 0, 0, 0, 0, 0.0, 0.0
+
     dat.sort()
 
     count = float(len(dat))
@@ -131,16 +239,12 @@ def _stats(dat) :
 
     return len(dat), sum(dat), dat[0], dat[-1], mean, sd
 
-def fasta_stats(fname) :
-    data = []
-    
-    for s in SeqIO.parse(fname, 'fasta') :
-        data.append(len(s))
-
-    return _stats(data)
+# the same for the lengths of sequences in memory
+def sequence_stats(seqs) :
+    return _stats([ len(s) for s in seqs ])
 
-def tmpfasta_orfs(seq, strand=False) :
-    fname = tmpfile()
+def tmpfasta_orfs(seq, strand=False, fname=None) :
+    fname = fname or tmpfile()
 
     tmp = []
     if isinstance(seq, list) :